@@ -0,0 +1,49 @@
+"""
+Listagens paginadas do painel administrativo (usuários e product keys)
+
+Busca por prefixo e ordenação só em colunas indexadas, para que cada página
+custe uma busca no índice em vez de carregar a tabela inteira.
+"""
+
+DEFAULT_PER_PAGE = 25
+MAX_PER_PAGE = 100
+
+
+def listing_args(args, prefix):
+    """Página, itens por página, busca e ordenação vindos da query string
+
+    prefix separa os parâmetros de listagens na mesma página (ex.: user_page, key_page).
+    """
+    def get(name, default=''):
+        return args.get(f'{prefix}_{name}', default)
+
+    try:
+        page = max(int(get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    try:
+        per_page = min(max(int(get('per_page', DEFAULT_PER_PAGE)), 1), MAX_PER_PAGE)
+    except ValueError:
+        per_page = DEFAULT_PER_PAGE
+
+    return {
+        'page': page,
+        'per_page': per_page,
+        'q': get('q').strip(),
+        'sort': get('sort', 'created_at'),
+        'order': 'asc' if get('order') == 'asc' else 'desc',
+    }
+
+
+def prefix_filter(column, prefix):
+    """column LIKE 'prefix%' como faixa, que usa o índice da coluna"""
+    upper_bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return (column >= prefix) & (column < upper_bound)
+
+
+def apply_sort(query, sortable, sort, order, tiebreaker):
+    """Ordena por uma das colunas permitidas (padrão: a primeira), com tiebreaker para desempate"""
+    column = sortable.get(sort, next(iter(sortable.values())))
+    if order == 'asc':
+        return query.order_by(column.asc(), tiebreaker.asc())
+    return query.order_by(column.desc(), tiebreaker.desc())
@@ -0,0 +1,189 @@
+"""
+Estimativa de custo das consultas e controle de admissão por usuário
+
+O custo é uma estimativa (limite superior) de linhas visitadas, calculada a
+partir do EXPLAIN QUERY PLAN e das estatísticas do sqlite_stat1 geradas pelo
+ANALYZE na ativação. O controlador limita consultas simultâneas por usuário,
+reserva parte da capacidade para consultas baratas e atende a fila de forma
+justa entre usuários.
+"""
+import itertools
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# A partir deste custo (linhas visitadas) a consulta é considerada cara
+EXPENSIVE_COST = int(os.environ.get('EXPENSIVE_QUERY_COST', 1000000))
+
+_PLAN_TABLE = re.compile(r'^(SCAN|SEARCH) (\S+)')
+_PLAN_INDEX = re.compile(r'USING (?:COVERING )?INDEX (\S+)')
+_PLAN_CONSTRAINTS = re.compile(r'\((.*)\)\s*$')
+
+
+class AdmissionRejected(Exception):
+    """A consulta não foi admitida: limite do usuário ou instância saturada"""
+
+
+def _table_rows(conn, table, stats):
+    if table in stats.get(None, {}):
+        return stats[None][table]
+    try:
+        return conn.execute(f"SELECT MAX(rowid) FROM {table}").fetchone()[0] or 0
+    except sqlite3.OperationalError:
+        return 0
+
+
+def _load_stats(conn):
+    """sqlite_stat1 como {None: {tabela: linhas}, índice: [linhas, linhas por valor...]}"""
+    stats = {None: {}}
+    try:
+        rows = conn.execute("SELECT tbl, idx, stat FROM sqlite_stat1").fetchall()
+    except sqlite3.OperationalError:
+        return stats
+
+    for table, index, stat in rows:
+        numbers = [int(n) for n in stat.split() if n.isdigit()]
+        if not numbers:
+            continue
+        stats[None][table] = max(stats[None].get(table, 0), numbers[0])
+        if index:
+            stats[index] = numbers
+    return stats
+
+
+def _step_rows(conn, detail, aliases, stats):
+    """Linhas visitadas por execução de um passo do plano"""
+    match = _PLAN_TABLE.match(detail)
+    if not match:
+        return None
+    kind, name = match.groups()
+    table = aliases.get(name, name)
+    total = _table_rows(conn, table, stats)
+
+    if kind == 'SCAN':
+        return max(total, 1)
+
+    if 'INTEGER PRIMARY KEY' in detail:
+        return 1
+
+    index = _PLAN_INDEX.search(detail)
+    constraints = _PLAN_CONSTRAINTS.search(detail)
+    if not index or not constraints:
+        return max(total // 10, 1)
+
+    terms = constraints.group(1).split(' AND ')
+    equalities = sum(1 for term in terms if term.endswith('=?') and not term.endswith(('<=?', '>=?')))
+    index_stats = stats.get(index.group(1))
+
+    if equalities and index_stats and len(index_stats) > 1:
+        # stat = "linhas, linhas por valor da 1ª coluna, das 2 primeiras..."
+        rows = index_stats[min(equalities, len(index_stats) - 1)]
+    elif equalities:
+        rows = total // 10
+    else:
+        # Só faixas (<, >): mesma heurística do SQLite, ~1/4 das linhas
+        rows = total // 4
+    return max(rows, 1)
+
+
+def estimate_cost(conn, query, params, aliases=None, limit=None):
+    """Estimativa (limite superior) de linhas visitadas pela consulta
+
+    Passos de primeiro nível formam os laços aninhados do JOIN, então suas
+    linhas se multiplicam; subconsultas são somadas uma vez. Com limit, os
+    laços param depois de limit linhas, a menos que o plano precise ordenar
+    o resultado inteiro (USE TEMP B-TREE).
+    """
+    aliases = aliases or {}
+    stats = _load_stats(conn)
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+    if limit is not None and (limit < 0 or any('USE TEMP B-TREE' in detail for *_, detail in plan)):
+        limit = None
+
+    cost = 0
+    loop_rows = 1
+    for _, parent, _, detail in plan:
+        rows = _step_rows(conn, detail, aliases, stats)
+        if rows is None:
+            continue
+        if parent == 0:
+            loop_rows *= rows
+            cost += loop_rows if limit is None else min(loop_rows, limit)
+        else:
+            cost += rows
+    return cost
+
+
+class AdmissionController:
+    """Limita consultas simultâneas por usuário e na instância, com fila justa
+
+    Consultas caras só usam parte da capacidade (expensive_share) para que
+    as baratas continuem sendo atendidas quando a instância está ocupada.
+    Na fila, a vez é de quem tem menos consultas em andamento (depois, de
+    quem chegou primeiro).
+    """
+
+    def __init__(self, capacity, per_user_limit=2, expensive_share=0.5, max_wait=5.0):
+        self.capacity = capacity
+        self.per_user_limit = per_user_limit
+        self.expensive_capacity = max(1, int(capacity * expensive_share))
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._active = {}
+        self._running = 0
+        self._running_expensive = 0
+        self._waiting = []
+        self._sequence = itertools.count()
+
+    def _can_run(self, user_id, expensive):
+        if self._active.get(user_id, 0) >= self.per_user_limit:
+            return False
+        if self._running >= self.capacity:
+            return False
+        return not expensive or self._running_expensive < self.expensive_capacity
+
+    def _is_next(self, ticket):
+        eligible = [t for t in self._waiting if self._can_run(t[1], t[2])]
+        if not eligible:
+            return False
+        return min(eligible, key=lambda t: (self._active.get(t[1], 0), t[0])) is ticket
+
+    @contextmanager
+    def admit(self, user_id, cost):
+        """Reserva uma vaga para a consulta ou levanta AdmissionRejected"""
+        expensive = cost >= EXPENSIVE_COST
+        ticket = (next(self._sequence), user_id, expensive)
+        deadline = time.monotonic() + self.max_wait
+
+        with self._cond:
+            self._waiting.append(ticket)
+            try:
+                while not self._is_next(ticket):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        if self._active.get(user_id, 0) >= self.per_user_limit:
+                            raise AdmissionRejected('Você já tem consultas em andamento, aguarde a conclusão')
+                        raise AdmissionRejected('Servidor ocupado com consultas pesadas, tente novamente em instantes')
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting.remove(ticket)
+
+            self._active[user_id] = self._active.get(user_id, 0) + 1
+            self._running += 1
+            self._running_expensive += expensive
+            # Outra consulta da fila pode ter ficado elegível
+            self._cond.notify_all()
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active[user_id] -= 1
+                if not self._active[user_id]:
+                    del self._active[user_id]
+                self._running -= 1
+                self._running_expensive -= expensive
+                self._cond.notify_all()
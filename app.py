@@ -1,20 +1,82 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file
+import time
+_startup_started = time.perf_counter()
+
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file, Response
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import sqlite3
-import pandas as pd
 import os
 import secrets
 import string
-from datetime import datetime
+from datetime import datetime, timedelta
 import tempfile
+import shutil
+import json
+import threading
+import uuid
+from export_formats import validate_export_format, export_filename, export_mimetype, write_export, copy_export_rows
+from http_responses import json_response, not_modified, make_etag, columnar
+from lead_query import build_query, MAX_RESULTS, TABLE_ALIASES
+from lead_database import CONTACT_FLAGS, prepare_database, prepared_steps
+from count_estimates import approximate_count, sample_rows, reservoir_sample
+from reference_cache import get_reference_tables, decode_rows, DecodingCursor
+from cnpj_enrichment import parse_cnpjs, read_cnpj_file, enrich_to_file, MAX_ENRICH_CNPJS
+from contact_lookup import parse_contacts, read_contact_file, lookup_to_file, MAX_LOOKUP_CONTACTS
+from query_executor import lead_executor, QueryTimeout, QueryRejected
+from admission import AdmissionController, AdmissionRejected, estimate_cost
+from lead_backend import ServerBackend, load_into_server, dialect_of, connect as connect_lead_database
+from cloud_sql_config import get_pool_settings
+from subscriptions import load_filter_data, write_delta
+from lead_update import apply_update
+from admin_listing import listing_args, prefix_filter, apply_sort
+from product_keys import bulk_create_keys, keys_csv, MAX_KEYS_PER_REQUEST
+from shared_cache import create_cache, cache_key, get_or_compute, invalidate
+from export_store import ExportStore
+from model_schema import sync_schema
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'sua-chave-secreta-aqui'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///sistema.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///sistema.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'uploads'
+# Arquivos exportados: validade do link de download e limite de disco
+app.config['EXPORT_FOLDER'] = os.path.abspath(os.environ.get('EXPORT_FOLDER', os.path.join('exports', 'artifacts')))
+app.config['EXPORT_TTL_HOURS'] = float(os.environ.get('EXPORT_TTL_HOURS', 24))
+app.config['EXPORT_MAX_BYTES'] = int(os.environ.get('EXPORT_MAX_BYTES', 2 * 1024 ** 3))
+# Intervalo mínimo (segundos) entre rodadas de descarte
+app.config['EXPORT_EVICT_INTERVAL'] = float(os.environ.get('EXPORT_EVICT_INTERVAL', 60))
+# Prazos (segundos) das consultas na base de empresas
+app.config['LEAD_QUERY_TIMEOUT'] = float(os.environ.get('LEAD_QUERY_TIMEOUT', 10))
+app.config['LEAD_EXPORT_TIMEOUT'] = float(os.environ.get('LEAD_EXPORT_TIMEOUT', 60))
+app.config['LEAD_DELTA_TIMEOUT'] = float(os.environ.get('LEAD_DELTA_TIMEOUT', 600))
+# Validade dos deltas das assinaturas ainda não baixados
+app.config['DELTA_TTL_HOURS'] = float(os.environ.get('DELTA_TTL_HOURS', 30 * 24))
+
+# Admissão das consultas: limite por usuário e espera máxima na fila
+admission_controller = AdmissionController(
+    capacity=lead_executor.max_workers,
+    per_user_limit=int(os.environ.get('LEAD_QUERIES_PER_USER', 2)),
+    max_wait=float(os.environ.get('ADMISSION_MAX_WAIT', 5)),
+)
+
+export_store = ExportStore(app.config['EXPORT_FOLDER'])
+
+# Cache compartilhado entre instâncias (Redis/memcached; em memória sem SHARED_CACHE_URL)
+shared_cache = create_cache(os.environ.get('SHARED_CACHE_URL'))
+app.config['CACHE_RESULT_TTL'] = int(os.environ.get('CACHE_RESULT_TTL', 600))
+app.config['CACHE_STATS_TTL'] = int(os.environ.get('CACHE_STATS_TTL', 3600))
+app.config['CACHE_ENTITLEMENT_TTL'] = int(os.environ.get('CACHE_ENTITLEMENT_TTL', 60))
+# Intervalo (segundos) entre leituras do carimbo de versão da base ativa
+app.config['CACHE_VERSION_CHECK'] = float(os.environ.get('CACHE_VERSION_CHECK', 2))
+
+# Base de empresas em servidor MySQL/PostgreSQL (compartilhada entre instâncias);
+# sem LEAD_DATABASE_URL as consultas usam o arquivo SQLite ativo
+lead_server = (ServerBackend(os.environ['LEAD_DATABASE_URL'], **get_pool_settings())
+               if os.environ.get('LEAD_DATABASE_URL') else None)
 
 db = SQLAlchemy(app)
 
@@ -25,22 +87,30 @@ class User(db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(200), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    # Versão do saldo e dos filtros salvos: muda a cada alteração (ETag do bootstrap)
+    ledger_version = db.Column(db.Integer, default=0)
+    ledger_updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class ProductKey(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     key_value = db.Column(db.String(50), unique=True, nullable=False)
     total_leads = db.Column(db.Integer, nullable=False)
     remaining_leads = db.Column(db.Integer, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
     activated_at = db.Column(db.DateTime, nullable=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+def new_version_stamp():
+    return uuid.uuid4().hex
 
 class DatabaseConfig(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     database_path = db.Column(db.String(500), nullable=False)
     is_active = db.Column(db.Boolean, default=True)
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Carimbo trocado a cada ativação: invalida o cache compartilhado em todas as instâncias
+    version = db.Column(db.String(32), default=new_version_stamp)
 
 class SavedFilter(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -49,6 +119,55 @@ class SavedFilter(db.Model):
     filter_data = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    @property
+    def filters(self):
+        return load_filter_data(self.filter_data)
+
+class FilterSubscription(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    saved_filter_id = db.Column(db.Integer, db.ForeignKey('saved_filter.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    columns = db.Column(db.Text, nullable=False)
+    export_format = db.Column(db.String(20), default='csv')
+    # Versão da base usada como referência para o próximo delta
+    database_path = db.Column(db.String(500), nullable=False)
+    is_active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    saved_filter = db.relationship('SavedFilter')
+
+class DeltaExport(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    subscription_id = db.Column(db.Integer, db.ForeignKey('filter_subscription.id'), nullable=False)
+    database_config_id = db.Column(db.Integer, db.ForeignKey('database_config.id'), nullable=False)
+    # sha256 do conteúdo: nome do arquivo no export_store
+    content_hash = db.Column(db.String(64), nullable=False, index=True)
+    file_name = db.Column(db.String(200), nullable=False)
+    size_bytes = db.Column(db.Integer, nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    # Linhas já pagas (as primeiras do arquivo) e o momento do primeiro débito
+    charged_rows = db.Column(db.Integer, default=0)
+    charged_at = db.Column(db.DateTime, nullable=True)
+    subscription = db.relationship('FilterSubscription')
+
+class ExportArtifact(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    # Identificador do link de download (não sequencial)
+    token = db.Column(db.String(64), unique=True, nullable=False, default=lambda: secrets.token_urlsafe(24))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    # sha256 do conteúdo: nome do arquivo no export_store
+    content_hash = db.Column(db.String(64), nullable=False, index=True)
+    file_name = db.Column(db.String(200), nullable=False)
+    export_format = db.Column(db.String(20), nullable=False)
+    size_bytes = db.Column(db.Integer, nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+    # Downloads depois do primeiro (gratuitos)
+    download_count = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_access_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
 # Funções utilitárias
 def generate_product_key():
     return ''.join(secrets.choice(string.ascii_uppercase + string.digits) for _ in range(16))
@@ -59,6 +178,117 @@ def get_current_database():
         return config.database_path
     return 'data/empresas_teste.db'  # Banco padrão
 
+def get_lead_source():
+    """Origem das consultas de leads: o servidor configurado ou o arquivo SQLite ativo"""
+    return lead_server or get_current_database()
+
+# Última leitura do carimbo de versão: (válida até, versão, ativada em)
+_database_version = (0.0, None, None)
+
+def get_database_version():
+    """Carimbo da base ativa para ETags e chaves do cache compartilhado
+
+    Relido do banco a cada CACHE_VERSION_CHECK segundos, então uma ativação
+    feita em outra instância é vista por todas em poucos segundos.
+    """
+    return get_database_stamp()[0]
+
+def get_database_stamp():
+    """(carimbo, data de ativação) da base ativa"""
+    global _database_version
+    expires, version, activated_at = _database_version
+    if version is not None and time.monotonic() < expires:
+        return version, activated_at
+    
+    config = DatabaseConfig.query.filter_by(is_active=True).first()
+    if config and config.version:
+        version = config.version
+    else:
+        # Configurações anteriores ao carimbo: identificação pelo arquivo
+        db_path = config.database_path if config else get_current_database()
+        try:
+            mtime = int(os.path.getmtime(db_path))
+        except OSError:
+            mtime = 0
+        version = f"{config.id if config else 0}-{mtime}"
+    activated_at = config.uploaded_at if config else None
+    _database_version = (time.monotonic() + app.config['CACHE_VERSION_CHECK'], version, activated_at)
+    return version, activated_at
+
+def reset_database_version():
+    """Força a releitura do carimbo nesta instância (logo após uma ativação)"""
+    global _database_version
+    _database_version = (0.0, None, None)
+
+def plan_type(total_leads):
+    if total_leads >= 50000:
+        return 'Premium'
+    elif total_leads >= 10000:
+        return 'Professional'
+    elif total_leads >= 2000:
+        return 'Standard'
+    return 'Básico'
+
+def load_entitlements(user_id):
+    """Saldo e plano do usuário lidos da product key no banco"""
+    product_key = ProductKey.query.filter_by(user_id=user_id).first()
+    return {
+        'remaining_leads': product_key.remaining_leads if product_key else 0,
+        'total_leads': product_key.total_leads if product_key else 0,
+        'plan_type': plan_type(product_key.total_leads) if product_key else None,
+    }
+
+def get_entitlements(user_id):
+    """Saldo e plano do usuário, do cache compartilhado (só para exibição)
+
+    Débitos e verificações de saldo continuam lendo a product key no banco.
+    """
+    return get_or_compute(shared_cache, f'entitlements:{user_id}',
+                          app.config['CACHE_ENTITLEMENT_TTL'], lambda: load_entitlements(user_id))
+
+@event.listens_for(ProductKey, 'after_insert')
+@event.listens_for(ProductKey, 'after_update')
+def _product_key_changed(mapper, connection, target):
+    # Invalidado só depois do commit, para não regravar o valor antigo no meio da transação
+    if target.user_id is not None:
+        session = Session.object_session(target)
+        session.info.setdefault('entitlements_changed', set()).add(target.user_id)
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_entitlements(session):
+    changed = session.info.pop('entitlements_changed', None)
+    if changed:
+        invalidate(shared_cache, *(f'entitlements:{user_id}' for user_id in changed))
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_entitlement_changes(session):
+    session.info.pop('entitlements_changed', None)
+
+@event.listens_for(Session, 'before_flush')
+def _bump_ledger_versions(session, flush_context, instances):
+    # Saldo ou filtros salvos alterados: nova versão do usuário no mesmo flush
+    changed = {
+        obj.user_id for obj in list(session.new) + list(session.deleted)
+        if isinstance(obj, (ProductKey, SavedFilter)) and obj.user_id is not None
+    }
+    for obj in session.dirty:
+        if isinstance(obj, (ProductKey, SavedFilter)) and session.is_modified(obj):
+            # Chave transferida: o dono anterior também muda
+            history = inspect(obj).attrs.user_id.history
+            changed.update(user_id for user_id in (obj.user_id, *history.deleted) if user_id is not None)
+    with session.no_autoflush:
+        for user_id in changed:
+            user = session.get(User, user_id)
+            if user is not None:
+                user.ledger_version = (user.ledger_version or 0) + 1
+                user.ledger_updated_at = datetime.utcnow()
+
+def get_decode_tables(data, db_path):
+    """Tabelas de referência em memória quando o cliente pede códigos decodificados"""
+    if not data.get('decode'):
+        return None
+    return get_reference_tables(db_path, get_database_version())
+
 def get_table_columns(db_path):
     """Retorna colunas de todas as tabelas com labels amigáveis"""
     try:
@@ -118,51 +348,281 @@ def get_table_columns(db_path):
             's.opcao_simples': 'Optante Simples'
         }
 
-def query_database(db_path, filters, selected_columns):
+def plan_query(db_path, filters, selected_columns, limit=MAX_RESULTS):
+    """Monta a consulta e estima seu custo (EXPLAIN + sqlite_stat1) antes de executá-la"""
+    conn = connect_lead_database(db_path)
     try:
-        conn = sqlite3.connect(db_path)
+        query, params = build_query(filters, selected_columns, limit=limit, features=prepared_steps(conn),
+                                    dialect=dialect_of(conn))
+        if lead_server is not None and db_path is lead_server:
+            # No servidor o custo é limitado pelo statement timeout
+            return query, params, 0
+        aliases = {alias: table for table, alias in TABLE_ALIASES.items()}
+        return query, params, estimate_cost(conn, query, params, aliases, limit=limit)
+    finally:
+        conn.close()
+
+def run_lead_query(user_id, cost, db_path, fn, timeout):
+    """Executa fn(conn) no executor depois de admitida pelo controle por usuário"""
+    with admission_controller.admit(user_id, cost):
+        return lead_executor.run(db_path, fn, timeout)
+
+def preview_query(user_id, db_path, filters, selected_columns, preview_limit=50, reference_tables=None,
+                  count_mode='auto', sample=False):
+    """Retorna colunas, linhas da prévia, total e a estimativa usada no total (ou None)
+
+    count_mode 'exact' conta as linhas da consulta (limitada a MAX_RESULTS);
+    'auto' usa histogramas/amostra quando a prévia enche, sem varrer o resultado.
+    sample troca as primeiras linhas por linhas aleatórias do resultado.
+    """
+    query, params, cost = plan_query(db_path, filters, selected_columns)
+    
+    def run(conn):
+        cursor = conn.execute(query, params)
+        columns = [description[0] for description in cursor.description]
+        rows = cursor.fetchmany(preview_limit)
+        # Resultado lido até o fim (sem o corte do LIMIT): o total já é conhecido
+        matched, complete = len(rows), len(rows) < preview_limit
         
-        # Construir query SQL com JOINs
-        if selected_columns:
-            # Adicionar CNPJ completo se selecionado
-            select_parts = []
-            for col in selected_columns:
-                if col == 'cnpj_completo':
-                    select_parts.append("(e.cnpj_basico || est.cnpj_ordem || est.cnpj_dv) as cnpj_completo")
-                else:
-                    select_parts.append(col)
-            columns_str = ', '.join(select_parts)
+        if sample and not complete:
+            sampled = sample_rows(conn, filters, selected_columns, prepared_steps(conn), preview_limit)
+            if sampled is not None:
+                rows = sampled
+            else:
+                # Filtro seletivo: reservoir sobre o resultado, limitado a MAX_RESULTS linhas
+                rows, matched = reservoir_sample(cursor, rows, preview_limit)
+                complete = matched < MAX_RESULTS
+        
+        estimate = None
+        if complete:
+            count = matched
         else:
-            columns_str = 'e.cnpj_basico, e.razao_social, est.nome_fantasia, est.uf, s.opcao_simples'
+            if count_mode == 'auto':
+                estimate = approximate_count(conn, filters, prepared_steps(conn))
+            if estimate:
+                # A prévia já mostra preview_limit linhas
+                count = max(estimate['count'], preview_limit)
+            else:
+                count = conn.execute(f"SELECT COUNT(*) FROM ({query}) AS preview", params).fetchone()[0]
+        
+        if reference_tables:
+            rows = decode_rows(columns, rows, reference_tables)
         
-        query = f"""
-        SELECT {columns_str}
+        return columns, rows, count, estimate
+    
+    return run_lead_query(user_id, cost, db_path, run, app.config['LEAD_QUERY_TIMEOUT'])
+
+def export_query(user_id, db_path, filters, selected_columns, limit, filepath, export_format, reference_tables=None):
+    """Executa a query e grava o resultado direto do cursor no arquivo de exportação"""
+    query, params, cost = plan_query(db_path, filters, selected_columns, limit=min(limit, MAX_RESULTS))
+    
+    def run(conn):
+        cursor = conn.stream(query, params)
+        if reference_tables:
+            cursor = DecodingCursor(cursor, reference_tables)
+        return write_export(cursor, filepath, export_format)
+    
+    return run_lead_query(user_id, cost, db_path, run, app.config['LEAD_EXPORT_TIMEOUT'])
+
+def database_stats(conn):
+    """Totais e distribuições da base para o dashboard"""
+    stats = {}
+    cursor = conn.cursor()
+    
+    # Total de empresas
+    cursor.execute("SELECT COUNT(*) FROM empresas")
+    stats['total_companies'] = cursor.fetchone()[0]
+    
+    # Distribuição por estado
+    cursor.execute("""
+        SELECT est.uf, COUNT(*) as count
         FROM empresas e
         JOIN estabelecimento est ON e.cnpj_basico = est.cnpj_basico
-        JOIN simples s ON e.cnpj_basico = s.cnpj_basico
-        WHERE 1=1
-        """
-        
-        params = []
-        
-        # Adicionar filtros
-        for column, value in filters.items():
-            if value and value.strip():
-                if column == 'cnpj_completo':
-                    query += " AND (e.cnpj_basico || est.cnpj_ordem || est.cnpj_dv) LIKE ?"
-                else:
-                    query += f" AND {column} LIKE ?"
-                params.append(f"%{value.strip()}%")
+        GROUP BY est.uf
+        ORDER BY count DESC
+        LIMIT 10
+    """)
+    stats['state_distribution'] = {row[0]: row[1] for row in cursor.fetchall()}
+    
+    # Distribuição do Simples Nacional
+    cursor.execute("""
+        SELECT s.opcao_simples, COUNT(*) as count
+        FROM simples s
+        GROUP BY s.opcao_simples
+    """)
+    simples_data = cursor.fetchall()
+    stats['simples_distribution'] = {
+        'optante': next((row[1] for row in simples_data if row[0] == 'S'), 0),
+        'nao_optante': next((row[1] for row in simples_data if row[0] == 'N'), 0)
+    }
+    
+    # Estabelecimentos contatáveis: histograma das flags ou contagem pelo índice de cada flag
+    steps = prepared_steps(conn)
+    if 'contact_columns' in steps:
+        contacts = {}
+        if 'count_estimates' in steps:
+            rows = conn.execute("SELECT column_name, count FROM lead_histogram WHERE value = '1' AND column_name IN "
+                                f"({', '.join('?' for _ in CONTACT_FLAGS)})", [f"est.{flag}" for flag in CONTACT_FLAGS])
+            contacts = {column.split('.', 1)[1]: int(count) for column, count in rows.fetchall()}
+        for flag in CONTACT_FLAGS:
+            if flag not in contacts:
+                contacts[flag] = conn.execute(f"SELECT COUNT(*) FROM estabelecimento WHERE {flag} = 1").fetchone()[0]
+        stats['contact_distribution'] = contacts
+    
+    return stats
+
+def store_export(user_id, filepath, filename, export_format, row_count):
+    """Move o arquivo exportado para o export_store e registra o artefato (commit de quem chama)"""
+    content_hash, size = export_store.commit(filepath)
+    artifact = ExportArtifact(
+        user_id=user_id,
+        content_hash=content_hash,
+        file_name=filename,
+        export_format=export_format,
+        size_bytes=size,
+        row_count=row_count,
+        expires_at=datetime.utcnow() + timedelta(hours=app.config['EXPORT_TTL_HOURS'])
+    )
+    db.session.add(artifact)
+    return artifact
+
+def artifact_response(artifact):
+    """Download do artefato com o link de re-download nos headers"""
+    response = send_file(export_store.path(artifact.content_hash), as_attachment=True,
+                         download_name=artifact.file_name, mimetype=export_mimetype(artifact.export_format))
+    response.headers['X-Export-Url'] = url_for('download_export', token=artifact.token)
+    response.headers['X-Export-Expires'] = artifact.expires_at.isoformat() + 'Z'
+    return response
+
+# Momento (monotonic) da última rodada de descarte neste processo
+_last_export_eviction = 0.0
+
+def evict_exports(force=False):
+    """Descarta artefatos vencidos e, acima do limite de disco, os acessados há mais tempo
+
+    Os arquivos sem artefato vivo são apagados em seguida. Roda no máximo uma
+    vez a cada EXPORT_EVICT_INTERVAL segundos por processo.
+    """
+    global _last_export_eviction
+    if not force and time.monotonic() - _last_export_eviction < app.config['EXPORT_EVICT_INTERVAL']:
+        return
+    _last_export_eviction = time.monotonic()
+    
+    ExportArtifact.query.filter(ExportArtifact.expires_at < datetime.utcnow()).delete()
+    DeltaExport.query.filter(DeltaExport.expires_at < datetime.utcnow()).delete()
+    
+    # Cada conteúdo ocupa o disco uma vez, mesmo com vários artefatos
+    artifacts = db.session.query(ExportArtifact.id, ExportArtifact.content_hash, ExportArtifact.size_bytes) \
+        .order_by(ExportArtifact.last_access_at).all()
+    references = {}
+    sizes = {}
+    for _, content_hash, size in artifacts:
+        references[content_hash] = references.get(content_hash, 0) + 1
+        sizes[content_hash] = size
+    used = sum(sizes.values())
+    
+    evicted = []
+    for artifact_id, content_hash, _ in artifacts:
+        if used <= app.config['EXPORT_MAX_BYTES']:
+            break
+        evicted.append(artifact_id)
+        references[content_hash] -= 1
+        if references[content_hash] == 0:
+            used -= sizes[content_hash]
+    if evicted:
+        ExportArtifact.query.filter(ExportArtifact.id.in_(evicted)).delete()
+    db.session.commit()
+    
+    referenced = {content_hash for content_hash, count in references.items() if count > 0}
+    # Deltas das assinaturas saem só pela validade, não pelo limite de disco
+    referenced.update(content_hash for (content_hash,) in db.session.query(DeltaExport.content_hash))
+    export_store.delete_unreferenced(referenced, tmp_max_age=app.config['EXPORT_TTL_HOURS'] * 3600)
+
+def activate_database(filepath):
+    """Torna filepath a base ativa e agenda os deltas das assinaturas"""
+    # Desativar banco anterior
+    DatabaseConfig.query.update({'is_active': False})
+    
+    # Adicionar novo banco
+    new_db = DatabaseConfig(database_path=filepath)
+    db.session.add(new_db)
+    db.session.commit()
+    reset_database_version()
+    
+    # As consultas do delta podem levar minutos: rodam fora da requisição do admin
+    threading.Thread(target=run_subscription_deltas, args=(new_db.id,),
+                     name='subscription-deltas', daemon=True).start()
+    
+    return new_db
+
+# Uma rodada de deltas por vez neste processo (ativações seguidas entram em fila)
+_delta_lock = threading.Lock()
+
+def run_subscription_deltas(config_id):
+    with _delta_lock, app.app_context():
+        try:
+            compute_subscription_deltas(DatabaseConfig.query.get(config_id))
+        except Exception as e:
+            db.session.rollback()
+            print(f"Erro ao gerar deltas das assinaturas: {e}")
+
+def compute_subscription_deltas(new_config):
+    """Gera os deltas das assinaturas ativas contra a versão anterior de cada uma
+
+    Cada diferença roda no lead_executor com o prazo LEAD_DELTA_TIMEOUT. Se
+    falhar ou for recusada, a assinatura mantém a versão de referência e o
+    próximo delta cobre também esta.
+    """
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    
+    for subscription in FilterSubscription.query.filter_by(is_active=True).all():
+        if subscription.database_path == new_config.database_path:
+            continue
+        if not os.path.exists(subscription.database_path):
+            # Sem a versão anterior não há como comparar; o próximo delta parte desta
+            subscription.database_path = new_config.database_path
+            db.session.commit()
+            continue
         
-        # Limitar resultados para não sobrecarregar
-        query += " LIMIT 10000"
+        filename = export_filename(f'delta_{subscription.id}', timestamp, subscription.export_format)
+        filepath = export_store.new_path(filename)
+        previous_path = subscription.database_path
+        filters = subscription.saved_filter.filters
+        columns = json.loads(subscription.columns)
+        export_format = subscription.export_format
+        try:
+            row_count = lead_executor.run(
+                new_config.database_path,
+                lambda conn: write_delta(conn, previous_path, filters, columns, filepath, export_format),
+                timeout=app.config['LEAD_DELTA_TIMEOUT'])
+        except Exception as e:
+            print(f"Erro ao gerar delta da assinatura {subscription.id}: {e}")
+            export_store.discard(filepath)
+            continue
         
-        df = pd.read_sql_query(query, conn, params=params)
-        conn.close()
-        return df
-    except Exception as e:
-        print(f"Erro ao consultar banco: {e}")
-        return pd.DataFrame()
+        if row_count:
+            content_hash, size = export_store.commit(filepath)
+            db.session.add(DeltaExport(subscription_id=subscription.id, database_config_id=new_config.id,
+                                       content_hash=content_hash, file_name=filename, size_bytes=size,
+                                       row_count=row_count,
+                                       expires_at=datetime.utcnow() + timedelta(hours=app.config['DELTA_TTL_HOURS'])))
+        else:
+            export_store.discard(filepath)
+        subscription.database_path = new_config.database_path
+        # Gravado a cada assinatura: o objeto no store só é protegido do descarte pelo período de carência
+        db.session.commit()
+
+def query_error_response(error):
+    """Resposta para consultas não admitidas, recusadas pela fila ou canceladas pelo prazo"""
+    if isinstance(error, AdmissionRejected):
+        response = jsonify({'error': str(error)})
+        response.headers['Retry-After'] = '5'
+        return response, 429
+    if isinstance(error, QueryRejected):
+        response = jsonify({'error': 'Servidor ocupado, tente novamente em instantes'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    return jsonify({'error': 'A consulta excedeu o tempo limite. Use filtros mais específicos.'}), 504
 
 # Rotas
 @app.route('/')
@@ -253,13 +713,55 @@ def admin_dashboard():
         flash('Acesso negado!', 'error')
         return redirect(url_for('index'))
     
-    users = User.query.all()
-    product_keys = ProductKey.query.all()
+    # Totais agregados no banco, sem carregar as linhas
+    total_keys, active_keys = db.session.query(func.count(ProductKey.id), func.count(ProductKey.user_id)).one()
+    stats = {
+        'total_users': db.session.query(func.count(User.id)).scalar(),
+        'total_keys': total_keys,
+        'active_keys': active_keys
+    }
+    
+    # Usuários: busca por prefixo de nome ou email
+    user_args = listing_args(request.args, 'user')
+    users_query = User.query
+    if user_args['q']:
+        users_query = users_query.filter(prefix_filter(User.username, user_args['q']) |
+                                         prefix_filter(User.email, user_args['q']))
+    users_query = apply_sort(users_query, {'created_at': User.created_at, 'username': User.username},
+                             user_args['sort'], user_args['order'], User.id)
+    users = users_query.paginate(page=user_args['page'], per_page=user_args['per_page'], error_out=False)
+    
+    # Keys dos usuários da página em uma consulta (índice em user_id)
+    user_keys = {}
+    page_user_ids = [user.id for user in users.items]
+    if page_user_ids:
+        for key in ProductKey.query.filter(ProductKey.user_id.in_(page_user_ids)).order_by(ProductKey.id):
+            user_keys.setdefault(key.user_id, key)
+    
+    # Product keys: busca por prefixo da key e filtro de status
+    key_args = listing_args(request.args, 'key')
+    keys_query = ProductKey.query
+    if key_args['q']:
+        keys_query = keys_query.filter(prefix_filter(ProductKey.key_value, key_args['q'].upper()))
+    key_status = request.args.get('key_status', '')
+    if key_status == 'ativada':
+        keys_query = keys_query.filter(ProductKey.user_id.isnot(None))
+    elif key_status == 'disponivel':
+        keys_query = keys_query.filter(ProductKey.user_id.is_(None))
+    keys_query = apply_sort(keys_query, {'created_at': ProductKey.created_at, 'key_value': ProductKey.key_value},
+                            key_args['sort'], key_args['order'], ProductKey.id)
+    product_keys = keys_query.paginate(page=key_args['page'], per_page=key_args['per_page'], error_out=False)
+    
     database_config = DatabaseConfig.query.filter_by(is_active=True).first()
     
     return render_template('admin.html', 
+                         stats=stats,
                          users=users, 
+                         user_keys=user_keys,
+                         user_args=user_args,
                          product_keys=product_keys,
+                         key_args=key_args,
+                         key_status=key_status,
                          database_config=database_config)
 
 @app.route('/admin/generate-keys', methods=['POST'])
@@ -267,20 +769,26 @@ def generate_keys():
     if not session.get('is_admin'):
         return jsonify({'error': 'Acesso negado'}), 403
     
-    lead_count = int(request.form['lead_count'])
-    quantity = int(request.form['quantity'])
+    try:
+        lead_count = int(request.form['lead_count'])
+        quantity = int(request.form['quantity'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Quantidade inválida'}), 400
     
-    keys = []
-    for _ in range(quantity):
-        key = ProductKey(
-            key_value=generate_product_key(),
-            total_leads=lead_count,
-            remaining_leads=lead_count
-        )
-        db.session.add(key)
-        keys.append(key.key_value)
+    if not 1 <= quantity <= MAX_KEYS_PER_REQUEST or lead_count <= 0:
+        return jsonify({'error': f'Gere entre 1 e {MAX_KEYS_PER_REQUEST} keys por vez'}), 400
     
-    db.session.commit()
+    try:
+        keys = bulk_create_keys(db.session, ProductKey, quantity, lead_count)
+    except IntegrityError as e:
+        print(f"Erro ao gerar keys: {e}")
+        return jsonify({'error': 'Erro ao gerar keys'}), 500
+    
+    # Lotes grandes: lista de keys em CSV, enviada em streaming
+    if request.form.get('format') == 'csv':
+        filename = f"product_keys_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        return Response(keys_csv(keys, lead_count), mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename={filename}'})
     
     return jsonify({'success': True, 'keys': keys})
 
@@ -326,30 +834,45 @@ def export_data():
     selected_columns = data.get('columns', [])
     export_format = data.get('format', 'csv')
     
-    db_path = get_current_database()
-    df = query_database(db_path, filters, selected_columns)
+    try:
+        validate_export_format(export_format)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    if df.empty:
+    # Arquivo temporário no export_store
+    filename = export_filename('dados_exportados', datetime.now().strftime("%Y%m%d_%H%M%S"), export_format)
+    filepath = export_store.new_path(filename)
+    
+    # Exportar no máximo os leads disponíveis, direto do cursor
+    db_path = get_lead_source()
+    try:
+        leads_used = export_query(user_id, db_path, filters, selected_columns,
+                                  product_key.remaining_leads, filepath, export_format,
+                                  reference_tables=get_decode_tables(data, db_path))
+    except (QueryTimeout, QueryRejected, AdmissionRejected) as e:
+        export_store.discard(filepath)
+        return query_error_response(e)
+    except ValueError as e:
+        # Filtro, operador ou coluna inválidos
+        export_store.discard(filepath)
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        # Falha ao gravar o arquivo (disco, parquet/zstd): não é falta de resultado
+        print(f"Erro ao exportar dados: {e}")
+        export_store.discard(filepath)
+        return jsonify({'error': 'Erro ao exportar dados'}), 500
+    
+    if leads_used == 0:
+        export_store.discard(filepath)
         return jsonify({'error': 'Nenhum resultado encontrado'}), 400
     
-    # Reduzir leads disponíveis
-    leads_used = min(len(df), product_key.remaining_leads)
+    # Reduzir leads disponíveis; o arquivo fica disponível para novos downloads sem custo
     product_key.remaining_leads -= leads_used
+    artifact = store_export(user_id, filepath, filename, export_format, leads_used)
     db.session.commit()
+    evict_exports()
     
-    # Criar arquivo temporário
-    temp_dir = tempfile.mkdtemp()
-    
-    if export_format == 'xlsx':
-        filename = f'dados_exportados_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-        filepath = os.path.join(temp_dir, filename)
-        df.head(leads_used).to_excel(filepath, index=False)
-    else:
-        filename = f'dados_exportados_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-        filepath = os.path.join(temp_dir, filename)
-        df.head(leads_used).to_csv(filepath, index=False)
-    
-    return send_file(filepath, as_attachment=True, download_name=filename)
+    return artifact_response(artifact)
 
 @app.route('/save-filter', methods=['POST'])
 def save_filter():
@@ -363,14 +886,175 @@ def save_filter():
     saved_filter = SavedFilter(
         user_id=session['user_id'],
         filter_name=filter_name,
-        filter_data=str(filter_data)
+        filter_data=json.dumps(filter_data)
     )
-    
     db.session.add(saved_filter)
+    
+    # Assinatura: a cada nova versão da base, delta com as linhas novas ou alteradas
+    if data.get('subscribe'):
+        export_format = data.get('format', 'csv')
+        try:
+            validate_export_format(export_format)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        db.session.flush()
+        db.session.add(FilterSubscription(
+            saved_filter_id=saved_filter.id,
+            user_id=session['user_id'],
+            columns=json.dumps(data.get('columns', [])),
+            export_format=export_format,
+            database_path=get_current_database()
+        ))
+    
     db.session.commit()
     
     return jsonify({'success': True})
 
+@app.route('/api/subscriptions')
+def list_subscriptions():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Não autorizado'}), 401
+    
+    subscriptions = FilterSubscription.query.filter_by(user_id=session['user_id'], is_active=True).all()
+    result = []
+    for subscription in subscriptions:
+        deltas = DeltaExport.query.filter_by(subscription_id=subscription.id)\
+            .order_by(DeltaExport.created_at.desc()).all()
+        result.append({
+            'id': subscription.id,
+            'filter_name': subscription.saved_filter.filter_name,
+            'format': subscription.export_format,
+            'deltas': [{
+                'id': delta.id,
+                'row_count': delta.row_count,
+                'charged_rows': delta.charged_rows,
+                'created_at': delta.created_at.isoformat(),
+                'charged': delta.charged_rows >= delta.row_count
+            } for delta in deltas]
+        })
+    
+    return jsonify({'subscriptions': result})
+
+@app.route('/api/subscriptions/<int:subscription_id>/cancel', methods=['POST'])
+def cancel_subscription(subscription_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Não autorizado'}), 401
+    
+    subscription = FilterSubscription.query.filter_by(id=subscription_id, user_id=session['user_id']).first()
+    if not subscription:
+        return jsonify({'error': 'Assinatura não encontrada'}), 404
+    
+    subscription.is_active = False
+    db.session.commit()
+    
+    return jsonify({'success': True})
+
+@app.route('/api/deltas/<int:delta_id>/download', methods=['POST'])
+def download_delta(delta_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Não autorizado'}), 401
+    
+    user_id = session['user_id']
+    delta = DeltaExport.query.get(delta_id)
+    if not delta or delta.subscription.user_id != user_id:
+        return jsonify({'error': 'Exportação não encontrada'}), 404
+    if not export_store.exists(delta.content_hash):
+        return jsonify({'error': 'Arquivo da exportação não está mais disponível'}), 410
+    
+    # Cada linha é debitada uma vez; sem saldo para o delta inteiro, são pagas
+    # (e baixadas) as primeiras linhas que o saldo cobre
+    if delta.charged_rows < delta.row_count:
+        product_key = ProductKey.query.filter_by(user_id=user_id).first()
+        charge = min(product_key.remaining_leads if product_key else 0, delta.row_count - delta.charged_rows)
+        if charge <= 0 and delta.charged_rows == 0:
+            return jsonify({'error': 'Leads insuficientes'}), 400
+        if charge > 0:
+            product_key.remaining_leads -= charge
+            delta.charged_rows += charge
+            delta.charged_at = delta.charged_at or datetime.utcnow()
+            db.session.commit()
+    
+    export_format = delta.subscription.export_format
+    if delta.charged_rows >= delta.row_count:
+        return send_file(export_store.path(delta.content_hash), as_attachment=True,
+                         download_name=delta.file_name, mimetype=export_mimetype(export_format))
+    
+    # Download parcial: as linhas pagas viram uma exportação comum do usuário
+    filepath = export_store.new_path(delta.file_name)
+    try:
+        copy_export_rows(export_store.path(delta.content_hash), filepath, export_format, delta.charged_rows)
+    except Exception as e:
+        print(f"Erro ao exportar delta {delta.id}: {e}")
+        export_store.discard(filepath)
+        return jsonify({'error': 'Erro ao exportar dados'}), 500
+    artifact = store_export(user_id, filepath, delta.file_name, export_format, delta.charged_rows)
+    db.session.commit()
+    return artifact_response(artifact)
+
+@app.route('/api/exports')
+def list_exports():
+    """Exportações do usuário ainda disponíveis para novo download"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Não autorizado'}), 401
+    
+    artifacts = ExportArtifact.query.filter(
+        ExportArtifact.user_id == session['user_id'],
+        ExportArtifact.expires_at >= datetime.utcnow()
+    ).order_by(ExportArtifact.created_at.desc()).limit(20).all()
+    
+    return jsonify({'exports': [{
+        'file_name': artifact.file_name,
+        'row_count': artifact.row_count,
+        'size_bytes': artifact.size_bytes,
+        'created_at': artifact.created_at.isoformat(),
+        'expires_at': artifact.expires_at.isoformat(),
+        'url': url_for('download_export', token=artifact.token)
+    } for artifact in artifacts]})
+
+@app.route('/api/exports/<token>')
+def download_export(token):
+    """Novo download de uma exportação já paga, sem debitar leads"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Não autorizado'}), 401
+    
+    artifact = ExportArtifact.query.filter_by(token=token).first()
+    if not artifact or artifact.user_id != session['user_id']:
+        return jsonify({'error': 'Exportação não encontrada'}), 404
+    if artifact.expires_at < datetime.utcnow() or not export_store.exists(artifact.content_hash):
+        return jsonify({'error': 'Arquivo da exportação não está mais disponível'}), 410
+    
+    artifact.download_count += 1
+    artifact.last_access_at = datetime.utcnow()
+    db.session.commit()
+    export_store.counters['redownloads'] += 1
+    
+    return artifact_response(artifact)
+
+@app.route('/admin/export-metrics')
+def export_metrics():
+    """Uso de disco e taxa de reaproveitamento do armazenamento de exportações"""
+    if not session.get('is_admin'):
+        return jsonify({'error': 'Acesso negado'}), 403
+    
+    evict_exports()
+    artifacts, redownloads = db.session.query(
+        func.count(ExportArtifact.id), func.coalesce(func.sum(ExportArtifact.download_count), 0)).one()
+    files, disk_bytes = export_store.disk_usage()
+    downloads = artifacts + redownloads
+    
+    return jsonify({
+        'artifacts': artifacts,
+        'files': files,
+        'disk_bytes': disk_bytes,
+        'max_bytes': app.config['EXPORT_MAX_BYTES'],
+        'disk_usage': round(disk_bytes / app.config['EXPORT_MAX_BYTES'], 4),
+        # Downloads atendidos pelo armazenamento sem nova consulta nem cobrança
+        'redownloads': redownloads,
+        'hit_rate': round(redownloads / downloads, 4) if downloads else 0,
+        'process': dict(export_store.counters)
+    })
+
 @app.route('/admin/upload-database', methods=['POST'])
 def upload_database():
     if not session.get('is_admin'):
@@ -387,93 +1071,135 @@ def upload_database():
         # Criar diretório se não existir
         os.makedirs('uploads', exist_ok=True)
         
-        filename = secure_filename(file.filename)
+        # Nome único por versão: a anterior é mantida para o delta das assinaturas
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = secure_filename(f"{timestamp}_{file.filename}")
         filepath = os.path.join('uploads', filename)
         file.save(filepath)
         
-        # Desativar banco anterior
-        DatabaseConfig.query.update({'is_active': False})
+        # Materializar colunas derivadas e índices antes de ativar
+        try:
+            prepare_database(filepath)
+            if lead_server is not None:
+                load_into_server(filepath, lead_server)
+        except Exception as e:
+            print(f"Erro ao preparar banco: {e}")
+            return jsonify({'error': f'Erro ao preparar banco de dados: {e}'}), 400
         
-        # Adicionar novo banco
-        new_db = DatabaseConfig(database_path=filepath)
-        db.session.add(new_db)
-        db.session.commit()
+        activate_database(filepath)
         
         return jsonify({'success': True, 'message': 'Banco de dados atualizado com sucesso!'})
     
     return jsonify({'error': 'Formato de arquivo inválido'}), 400
 
-# APIs para o dashboard e sistema de filtros
-
-@app.route('/api/dashboard-stats')
-def dashboard_stats():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Não autorizado'}), 401
+@app.route('/admin/update-database', methods=['POST'])
+def update_database():
+    """Atualização incremental: aplica só a diferença da nova importação sobre a base ativa"""
+    if not session.get('is_admin'):
+        return jsonify({'error': 'Acesso negado'}), 403
     
-    user_id = session['user_id']
+    file = request.files.get('database')
+    if not file or file.filename == '':
+        return jsonify({'error': 'Nenhum arquivo selecionado'}), 400
+    if not file.filename.endswith('.db'):
+        return jsonify({'error': 'Formato de arquivo inválido'}), 400
     
-    # Buscar informações do usuário
-    product_key = ProductKey.query.filter_by(user_id=user_id).first()
+    os.makedirs('uploads', exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filepath = os.path.join('uploads', secure_filename(f"{timestamp}_{file.filename}"))
+    
+    temp_dir = tempfile.mkdtemp()
+    import_path = os.path.join(temp_dir, 'importacao.db')
+    file.save(import_path)
     
-    # Estatísticas básicas
+    try:
+        summary = apply_update(get_current_database(), import_path, filepath)
+        # Etapas ainda não aplicadas na versão ativa são feitas por completo
+        prepare_database(filepath)
+        if lead_server is not None:
+            load_into_server(filepath, lead_server)
+    except Exception as e:
+        print(f"Erro ao atualizar banco: {e}")
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        return jsonify({'error': f'Erro ao atualizar banco de dados: {e}'}), 400
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    
+    activate_database(filepath)
+    
+    return jsonify({'success': True, 'message': 'Banco de dados atualizado com sucesso!', 'changes': summary})
+
+# APIs para o dashboard e sistema de filtros
+
+def dashboard_payload(entitlements, saved_filters):
+    """Estatísticas do dashboard: saldo e plano do usuário mais os totais da base"""
     stats = {
-        'leads_remaining': product_key.remaining_leads if product_key else 0,
-        'total_leads': product_key.total_leads if product_key else 0,
+        'leads_remaining': entitlements['remaining_leads'],
+        'total_leads': entitlements['total_leads'],
         'exports_today': 0,  # Implementar contagem de exportações
-        'saved_filters': SavedFilter.query.filter_by(user_id=user_id).count(),
+        'saved_filters': saved_filters,
         'total_companies': 0
     }
     
-    # Definir tipo de plano
-    if product_key:
-        if product_key.total_leads >= 50000:
-            stats['plan_type'] = 'Premium'
-        elif product_key.total_leads >= 10000:
-            stats['plan_type'] = 'Professional'
-        elif product_key.total_leads >= 2000:
-            stats['plan_type'] = 'Standard'
-        else:
-            stats['plan_type'] = 'Básico'
+    if entitlements['plan_type']:
+        stats['plan_type'] = entitlements['plan_type']
     
-    # Buscar estatísticas do banco
+    # Estatísticas do banco: as mesmas para todos os usuários até a próxima ativação
     try:
-        db_path = get_current_database()
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        # Total de empresas
-        cursor.execute("SELECT COUNT(*) FROM empresas")
-        stats['total_companies'] = cursor.fetchone()[0]
-        
-        # Distribuição por estado
-        cursor.execute("""
-            SELECT est.uf, COUNT(*) as count
-            FROM empresas e
-            JOIN estabelecimento est ON e.cnpj_basico = est.cnpj_basico
-            GROUP BY est.uf
-            ORDER BY count DESC
-            LIMIT 10
-        """)
-        stats['state_distribution'] = {row[0]: row[1] for row in cursor.fetchall()}
-        
-        # Distribuição do Simples Nacional
-        cursor.execute("""
-            SELECT s.opcao_simples, COUNT(*) as count
-            FROM simples s
-            GROUP BY s.opcao_simples
-        """)
-        simples_data = cursor.fetchall()
-        stats['simples_distribution'] = {
-            'optante': next((row[1] for row in simples_data if row[0] == 'S'), 0),
-            'nao_optante': next((row[1] for row in simples_data if row[0] == 'N'), 0)
-        }
-        
-        conn.close()
+        db_path = get_lead_source()
+        stats.update(get_or_compute(
+            shared_cache, cache_key('stats', get_database_version()), app.config['CACHE_STATS_TTL'],
+            lambda: lead_executor.run(db_path, database_stats, app.config['LEAD_QUERY_TIMEOUT'])))
     except Exception as e:
         print(f"Erro ao buscar estatísticas: {e}")
     
+    return stats
+
+@app.route('/api/dashboard-stats')
+def dashboard_stats():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Não autorizado'}), 401
+    
+    user_id = session['user_id']
+    
+    # Saldo e plano do usuário (cache compartilhado)
+    stats = dashboard_payload(get_entitlements(user_id), SavedFilter.query.filter_by(user_id=user_id).count())
     return jsonify(stats)
 
+@app.route('/api/bootstrap')
+def bootstrap():
+    """Dados iniciais das páginas (estatísticas, saldo, plano e filtros salvos) numa só requisição
+
+    O ETag combina o carimbo da base ativa com a versão do saldo/filtros do
+    usuário: a revalidação custa uma leitura do usuário e quase sempre é 304.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Não autorizado'}), 401
+    
+    user = db.session.get(User, session['user_id'])
+    if user is None:
+        return jsonify({'error': 'Não autorizado'}), 401
+    
+    version, activated_at = get_database_stamp()
+    etag = make_etag('bootstrap', version, user.id, user.ledger_version, user.ledger_updated_at)
+    last_modified = max(filter(None, [activated_at, user.ledger_updated_at, user.created_at]), default=None)
+    cached = not_modified(etag, last_modified)
+    if cached:
+        return cached
+    
+    # Saldo lido do banco (não do cache): a resposta vale enquanto o ETag não mudar
+    entitlements = load_entitlements(user.id)
+    saved_filters = SavedFilter.query.filter_by(user_id=user.id).order_by(SavedFilter.created_at).all()
+    
+    payload = dashboard_payload(entitlements, len(saved_filters))
+    payload['remaining_leads'] = entitlements['remaining_leads']
+    payload['filters'] = [
+        {'id': saved_filter.id, 'name': saved_filter.filter_name, 'filters': saved_filter.filters}
+        for saved_filter in saved_filters
+    ]
+    return json_response(payload, etag=etag, last_modified=last_modified)
+
 @app.route('/api/preview', methods=['POST'])
 def preview_data():
     if 'user_id' not in session:
@@ -492,32 +1218,217 @@ def preview_data():
     data = request.get_json()
     filters = data.get('filters', {})
     selected_columns = data.get('columns', [])
+    shape = data.get('shape', 'records')
+    # 'exact' força a contagem das linhas (ex.: antes de uma exportação cobrada)
+    count_mode = 'exact' if data.get('count') == 'exact' else 'auto'
+    sample = bool(data.get('sample'))
+    
+    # O resultado só muda com a versão do banco e os parâmetros da consulta
+    version = get_database_version()
+    etag = make_etag(version, filters, selected_columns, shape, bool(data.get('decode')), count_mode, sample)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    
+    db_path = get_lead_source()
+    try:
+        # Mesma consulta já feita em qualquer instância nesta versão: sem ir ao banco
+        columns, rows, count, estimate = get_or_compute(
+            shared_cache,
+            cache_key('preview', version, filters, selected_columns, bool(data.get('decode')), count_mode, sample),
+            app.config['CACHE_RESULT_TTL'],
+            lambda: preview_query(user_id, db_path, filters, selected_columns,
+                                  reference_tables=get_decode_tables(data, db_path),
+                                  count_mode=count_mode, sample=sample))
+    except (QueryTimeout, QueryRejected, AdmissionRejected) as e:
+        return query_error_response(e)
+    except ValueError as e:
+        # Filtro, operador ou coluna inválidos
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Erro ao consultar banco: {e}")
+        columns, rows, count, estimate = [], [], 0, None
+        etag = None  # Não deixar o cliente reaproveitar uma resposta de erro
     
-    db_path = get_current_database()
-    df = query_database(db_path, filters, selected_columns)
+    if shape == 'columnar':
+        payload = columnar(columns, rows)
+    else:
+        payload = {'results': [dict(zip(columns, row)) for row in rows]}
     
-    # Limitar preview a 50 registros
-    preview_df = df.head(50)
+    payload['count'] = count
+    payload['preview_count'] = len(rows)
+    if estimate:
+        # Total estimado: margem de erro de 95% (0 quando vem do histograma)
+        payload['count_approximate'] = True
+        payload['count_error'] = estimate['error']
+        payload['count_method'] = estimate['method']
     
-    return jsonify({
-        'results': preview_df.to_dict('records'),
-        'count': len(df),
-        'preview_count': len(preview_df)
-    })
+    return json_response(payload, etag=etag)
 
 @app.route('/api/user-leads')
 def user_leads():
     if 'user_id' not in session:
         return jsonify({'error': 'Não autorizado'}), 401
     
-    user_id = session['user_id']
-    product_key = ProductKey.query.filter_by(user_id=user_id).first()
+    entitlements = get_entitlements(session['user_id'])
     
     return jsonify({
-        'remaining_leads': product_key.remaining_leads if product_key else 0,
-        'total_leads': product_key.total_leads if product_key else 0
+        'remaining_leads': entitlements['remaining_leads'],
+        'total_leads': entitlements['total_leads']
     })
 
+@app.route('/api/enrich', methods=['POST'])
+def enrich_cnpjs():
+    """Enriquecimento em lote: lista (JSON) ou arquivo de CNPJs básicos ou completos"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Não autorizado'}), 401
+    
+    # Verificar leads disponíveis
+    user_id = session['user_id']
+    product_key = ProductKey.query.filter_by(user_id=user_id).first()
+    
+    if not product_key or product_key.remaining_leads <= 0:
+        return jsonify({'error': 'Leads insuficientes'}), 400
+    
+    if 'file' in request.files:
+        values = read_cnpj_file(request.files['file'].stream)
+        selected_columns = [col for col in request.form.get('columns', '').split(',') if col]
+        export_format = request.form.get('format', 'csv')
+    else:
+        data = request.get_json() or {}
+        values = data.get('cnpjs', [])
+        selected_columns = data.get('columns', [])
+        export_format = data.get('format', 'csv')
+    
+    try:
+        validate_export_format(export_format)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    lookups, invalid = parse_cnpjs(values)
+    
+    if not lookups:
+        return jsonify({'error': 'Nenhum CNPJ válido informado'}), 400
+    
+    if len(lookups) > MAX_ENRICH_CNPJS:
+        return jsonify({'error': f'Envie no máximo {MAX_ENRICH_CNPJS} CNPJs por vez'}), 400
+    
+    # Arquivo temporário no export_store
+    filename = export_filename('cnpjs_enriquecidos', datetime.now().strftime("%Y%m%d_%H%M%S"), export_format)
+    filepath = export_store.new_path(filename)
+    
+    db_path = get_lead_source()
+    try:
+        # Cada CNPJ é uma busca pontual na chave primária
+        leads_used = run_lead_query(
+            user_id, len(lookups) * 4, db_path,
+            lambda conn: enrich_to_file(conn, lookups, selected_columns,
+                                        product_key.remaining_leads, filepath, export_format),
+            app.config['LEAD_EXPORT_TIMEOUT'])
+    except (QueryTimeout, QueryRejected, AdmissionRejected) as e:
+        export_store.discard(filepath)
+        return query_error_response(e)
+    except Exception as e:
+        print(f"Erro ao enriquecer CNPJs: {e}")
+        export_store.discard(filepath)
+        return jsonify({'error': 'Erro ao enriquecer CNPJs'}), 400
+    
+    if leads_used == 0:
+        export_store.discard(filepath)
+        return jsonify({'error': 'Nenhum CNPJ encontrado na base'}), 400
+    
+    # Só os CNPJs encontrados consomem leads
+    product_key.remaining_leads -= leads_used
+    artifact = store_export(user_id, filepath, filename, export_format, leads_used)
+    db.session.commit()
+    evict_exports()
+    
+    response = artifact_response(artifact)
+    response.headers['X-Enrich-Requested'] = str(len(lookups))
+    response.headers['X-Enrich-Invalid'] = str(invalid)
+    response.headers['X-Enrich-Matched'] = str(leads_used)
+    return response
+
+@app.route('/api/reverse-lookup', methods=['POST'])
+def reverse_lookup():
+    """Busca reversa em lote: empresas donas de telefones ou domínios de email (lista JSON ou arquivo)"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Não autorizado'}), 401
+    
+    # Verificar leads disponíveis
+    user_id = session['user_id']
+    product_key = ProductKey.query.filter_by(user_id=user_id).first()
+    
+    if not product_key or product_key.remaining_leads <= 0:
+        return jsonify({'error': 'Leads insuficientes'}), 400
+    
+    if 'file' in request.files:
+        values = read_contact_file(request.files['file'].stream)
+        selected_columns = [col for col in request.form.get('columns', '').split(',') if col]
+        export_format = request.form.get('format', 'csv')
+    else:
+        data = request.get_json() or {}
+        values = data.get('contacts', [])
+        selected_columns = data.get('columns', [])
+        export_format = data.get('format', 'csv')
+    
+    try:
+        validate_export_format(export_format)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    lookups, invalid = parse_contacts(values)
+    
+    if not lookups:
+        return jsonify({'error': 'Nenhum telefone ou domínio válido informado'}), 400
+    
+    if len(lookups) > MAX_LOOKUP_CONTACTS:
+        return jsonify({'error': f'Envie no máximo {MAX_LOOKUP_CONTACTS} contatos por vez'}), 400
+    
+    db_path = get_lead_source()
+    conn = connect_lead_database(db_path)
+    try:
+        ready = 'contact_lookup' in prepared_steps(conn)
+    finally:
+        conn.close()
+    if not ready:
+        return jsonify({'error': 'Base sem índices de contato; reative a base para habilitar a busca reversa'}), 400
+    
+    # Arquivo temporário no export_store
+    filename = export_filename('busca_reversa', datetime.now().strftime("%Y%m%d_%H%M%S"), export_format)
+    filepath = export_store.new_path(filename)
+    
+    try:
+        # Cada contato é uma busca pontual nos índices de telefone e domínio
+        leads_used = run_lead_query(
+            user_id, len(lookups) * 4, db_path,
+            lambda conn: lookup_to_file(conn, lookups, selected_columns,
+                                        product_key.remaining_leads, filepath, export_format),
+            app.config['LEAD_EXPORT_TIMEOUT'])
+    except (QueryTimeout, QueryRejected, AdmissionRejected) as e:
+        export_store.discard(filepath)
+        return query_error_response(e)
+    except Exception as e:
+        print(f"Erro na busca reversa: {e}")
+        export_store.discard(filepath)
+        return jsonify({'error': 'Erro na busca reversa'}), 400
+    
+    if leads_used == 0:
+        export_store.discard(filepath)
+        return jsonify({'error': 'Nenhuma empresa encontrada para os contatos informados'}), 400
+    
+    # Só os estabelecimentos encontrados consomem leads
+    product_key.remaining_leads -= leads_used
+    artifact = store_export(user_id, filepath, filename, export_format, leads_used)
+    db.session.commit()
+    evict_exports()
+    
+    response = artifact_response(artifact)
+    response.headers['X-Lookup-Requested'] = str(len(lookups))
+    response.headers['X-Lookup-Invalid'] = str(invalid)
+    response.headers['X-Lookup-Matched'] = str(leads_used)
+    return response
+
 @app.route('/api/quick-export', methods=['POST'])
 def quick_export():
     if 'user_id' not in session:
@@ -533,6 +1444,11 @@ def quick_export():
     data = request.get_json()
     export_format = data.get('format', 'csv')
     
+    try:
+        validate_export_format(export_format)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     # Filtro pré-definido para empresas ativas
     filters = {'est.situacao_cadastral': '02'}  # 02 = ATIVA
     
@@ -543,30 +1459,39 @@ def quick_export():
         's.opcao_simples'
     ]
     
-    db_path = get_current_database()
-    df = query_database(db_path, filters, selected_columns)
+    # Arquivo temporário no export_store
+    filename = export_filename('empresas_ativas', datetime.now().strftime("%Y%m%d_%H%M%S"), export_format)
+    filepath = export_store.new_path(filename)
     
-    if df.empty:
+    db_path = get_lead_source()
+    try:
+        leads_used = export_query(user_id, db_path, filters, selected_columns,
+                                  product_key.remaining_leads, filepath, export_format,
+                                  reference_tables=get_decode_tables(data, db_path))
+    except (QueryTimeout, QueryRejected, AdmissionRejected) as e:
+        export_store.discard(filepath)
+        return query_error_response(e)
+    except ValueError as e:
+        # Filtro, operador ou coluna inválidos
+        export_store.discard(filepath)
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        # Falha ao gravar o arquivo (disco, parquet/zstd): não é falta de resultado
+        print(f"Erro ao exportar dados: {e}")
+        export_store.discard(filepath)
+        return jsonify({'error': 'Erro ao exportar dados'}), 500
+    
+    if leads_used == 0:
+        export_store.discard(filepath)
         return jsonify({'error': 'Nenhum resultado encontrado'}), 400
     
-    # Reduzir leads disponíveis
-    leads_used = min(len(df), product_key.remaining_leads)
+    # Reduzir leads disponíveis; o arquivo fica disponível para novos downloads sem custo
     product_key.remaining_leads -= leads_used
+    artifact = store_export(user_id, filepath, filename, export_format, leads_used)
     db.session.commit()
+    evict_exports()
     
-    # Criar arquivo temporário
-    temp_dir = tempfile.mkdtemp()
-    
-    if export_format == 'xlsx':
-        filename = f'empresas_ativas_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-        filepath = os.path.join(temp_dir, filename)
-        df.head(leads_used).to_excel(filepath, index=False)
-    else:
-        filename = f'empresas_ativas_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-        filepath = os.path.join(temp_dir, filename)
-        df.head(leads_used).to_csv(filepath, index=False)
-    
-    return send_file(filepath, as_attachment=True, download_name=filename)
+    return artifact_response(artifact)
 
 @app.route('/admin/reset-leads', methods=['POST'])
 def reset_leads():
@@ -639,6 +1564,10 @@ def add_product_key():
         'total_leads': total_leads
     })
 
+# Tempo de inicialização do módulo, pago por toda instância nova (cold start)
+app.config['STARTUP_SECONDS'] = round(time.perf_counter() - _startup_started, 3)
+print(f"Aplicação inicializada em {app.config['STARTUP_SECONDS']}s")
+
 if __name__ == '__main__':
     # Criar diretórios necessários
     os.makedirs('uploads', exist_ok=True)
@@ -646,6 +1575,7 @@ if __name__ == '__main__':
     
     with app.app_context():
         db.create_all()
+        sync_schema(db.engine, db.metadata)
         
         # Criar usuário admin se não existir
         if not User.query.filter_by(username='admin').first():
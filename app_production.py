@@ -1,33 +1,55 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file
+import time
+_startup_started = time.perf_counter()
+
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file, Response
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import sqlite3
-import pandas as pd
 import os
-import secrets
-import string
+import json
 from datetime import datetime
 import tempfile
-from cloud_sql_config import get_database_uri
+import uuid
+from cloud_sql_config import get_database_uri, get_engine_options, get_pool_settings, PoolMetrics
+from export_formats import write_xlsx
+from admin_listing import listing_args, prefix_filter, apply_sort
+from product_keys import bulk_create_keys, keys_csv, MAX_KEYS_PER_REQUEST
+from lead_backend import ServerBackend, load_into_server, connect as connect_lead_database
+from shared_cache import create_cache, cache_key, get_or_compute
+from model_schema import sync_schema
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'sua-chave-secreta-aqui')
 
 # Configuração do banco de dados
 if os.environ.get('GAE_ENV', '').startswith('standard'):
-    # Produção - usa Cloud SQL
+    # Produção - usa Cloud SQL, com pool dimensionado pelos workers/threads e pre-ping
     app.config['SQLALCHEMY_DATABASE_URI'] = get_database_uri()
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = get_engine_options()
 else:
     # Desenvolvimento - usa SQLite
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///sistema.db'
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Prazo das buscas na base de leads (statement timeout no servidor)
+LEAD_QUERY_TIMEOUT = float(os.environ.get('LEAD_QUERY_TIMEOUT', 30))
 app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', 'uploads')
 
 # Garante que a pasta de upload existe
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# Cache compartilhado entre as instâncias (Redis/memcached; em memória sem SHARED_CACHE_URL)
+shared_cache = create_cache(os.environ.get('SHARED_CACHE_URL'))
+CACHE_RESULT_TTL = int(os.environ.get('CACHE_RESULT_TTL', 600))
+
+# Base de leads em servidor MySQL/PostgreSQL (compartilhada entre instâncias);
+# sem LEAD_DATABASE_URL as buscas usam o arquivo SQLite ativo
+lead_server = (ServerBackend(os.environ['LEAD_DATABASE_URL'], **get_pool_settings())
+               if os.environ.get('LEAD_DATABASE_URL') else None)
+
 db = SQLAlchemy(app)
 
 # Modelos do banco de dados
@@ -37,22 +59,24 @@ class User(db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(200), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
 class ProductKey(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     key_value = db.Column(db.String(50), unique=True, nullable=False)
     total_leads = db.Column(db.Integer, nullable=False)
     remaining_leads = db.Column(db.Integer, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
     activated_at = db.Column(db.DateTime, nullable=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
 class DatabaseConfig(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     database_path = db.Column(db.String(500), nullable=False)
     is_active = db.Column(db.Boolean, default=True)
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Carimbo trocado a cada ativação: invalida o cache compartilhado em todas as instâncias
+    version = db.Column(db.String(32), default=lambda: uuid.uuid4().hex)
 
 class SavedFilter(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -63,17 +87,9 @@ class SavedFilter(db.Model):
 
 # Criar as tabelas se não existirem
 with app.app_context():
+    pool_metrics = PoolMetrics(db.engine)
     db.create_all()
-
-# Função para gerar chave de produto
-def generate_product_key():
-    """Gera uma chave de produto única"""
-    characters = string.ascii_uppercase + string.digits
-    while True:
-        key = ''.join(secrets.choice(characters) for _ in range(16))
-        formatted_key = f"{key[:4]}-{key[4:8]}-{key[8:12]}-{key[12:16]}"
-        if not ProductKey.query.filter_by(key_value=formatted_key).first():
-            return formatted_key
+    sync_schema(db.engine, db.metadata)
 
 # Decorador para verificar se o usuário está logado
 def login_required(f):
@@ -258,9 +274,6 @@ def api_search():
         return jsonify({'error': 'Nenhum banco de dados configurado'}), 500
     
     try:
-        # Conectar ao banco de dados SQLite
-        conn = sqlite3.connect(db_config.database_path)
-        
         # Construir query baseada nos filtros
         query = "SELECT * FROM leads WHERE 1=1"
         params = []
@@ -304,12 +317,22 @@ def api_search():
         limit = min(int(data.get('limit', 10)), product_key.remaining_leads, 100)
         query += f" LIMIT {limit}"
         
-        # Executar query
-        df = pd.read_sql_query(query, conn, params=params)
-        conn.close()
+        def run_search():
+            # Conectar à base de leads (servidor, se configurado, ou arquivo SQLite)
+            conn = connect_lead_database(lead_server or db_config.database_path,
+                                         timeout=LEAD_QUERY_TIMEOUT)
+            try:
+                # Converter as linhas direto do cursor
+                cursor = conn.execute(query, params)
+                columns = [description[0] for description in cursor.description]
+                return [dict(zip(columns, row)) for row in cursor.fetchall()]
+            finally:
+                conn.close()
         
-        # Converter para JSON
-        results = df.to_dict('records')
+        # A mesma busca na mesma versão da base é servida pelo cache de qualquer instância
+        results = get_or_compute(
+            shared_cache, cache_key('search', db_config.version or db_config.id, query, params),
+            CACHE_RESULT_TTL, run_search)
         
         # Atualizar leads restantes
         leads_used = len(results)
@@ -341,7 +364,7 @@ def save_filter():
     saved_filter = SavedFilter(
         user_id=user_id,
         filter_name=filter_name,
-        filter_data=str(filter_data)
+        filter_data=json.dumps(filter_data)
     )
     
     db.session.add(saved_filter)
@@ -374,13 +397,13 @@ def export_results():
     if not results:
         return jsonify({'error': 'Nenhum resultado para exportar'}), 400
     
-    # Criar DataFrame
-    df = pd.DataFrame(results)
+    # Colunas na ordem em que aparecem nos resultados
+    columns = list(dict.fromkeys(key for result in results for key in result))
     
     # Criar arquivo Excel temporário
     with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as tmp:
-        df.to_excel(tmp.name, index=False)
         tmp_path = tmp.name
+    write_xlsx(tmp_path, columns, ([result.get(col) for col in columns] for result in results))
     
     # Enviar arquivo
     response = send_file(
@@ -404,10 +427,9 @@ def export_results():
 @app.route('/admin')
 @admin_required
 def admin_dashboard():
-    # Estatísticas
-    total_users = User.query.count()
-    total_keys = ProductKey.query.count()
-    active_keys = ProductKey.query.filter(ProductKey.user_id.isnot(None)).count()
+    # Estatísticas agregadas em uma consulta por tabela
+    total_users = db.session.query(func.count(User.id)).scalar()
+    total_keys, active_keys = db.session.query(func.count(ProductKey.id), func.count(ProductKey.user_id)).one()
     
     # Listar usuários recentes
     recent_users = User.query.order_by(User.created_at.desc()).limit(10).all()
@@ -429,8 +451,14 @@ def admin_dashboard():
 @app.route('/admin/users')
 @admin_required
 def admin_users():
-    users = User.query.order_by(User.created_at.desc()).all()
-    return render_template('admin_users.html', users=users)
+    args = listing_args(request.args, 'user')
+    query = User.query
+    if args['q']:
+        query = query.filter(prefix_filter(User.username, args['q']) | prefix_filter(User.email, args['q']))
+    query = apply_sort(query, {'created_at': User.created_at, 'username': User.username},
+                       args['sort'], args['order'], User.id)
+    pagination = query.paginate(page=args['page'], per_page=args['per_page'], error_out=False)
+    return render_template('admin_users.html', users=pagination.items, pagination=pagination, listing=args)
 
 @app.route('/admin/toggle_admin/<int:user_id>', methods=['POST'])
 @admin_required
@@ -478,31 +506,56 @@ def delete_user(user_id):
     flash(f'Usuário {user.username} deletado com sucesso!', 'success')
     return redirect(url_for('admin_users'))
 
+@app.route('/admin/pool-metrics')
+@admin_required
+def admin_pool_metrics():
+    """Estado do pool de conexões do banco do sistema"""
+    return jsonify(pool_metrics.snapshot())
+
 @app.route('/admin/keys')
 @admin_required
 def admin_keys():
-    keys = ProductKey.query.order_by(ProductKey.created_at.desc()).all()
-    return render_template('admin_keys.html', keys=keys)
+    args = listing_args(request.args, 'key')
+    query = ProductKey.query
+    if args['q']:
+        query = query.filter(prefix_filter(ProductKey.key_value, args['q'].upper()))
+    status = request.args.get('key_status', '')
+    if status == 'ativada':
+        query = query.filter(ProductKey.user_id.isnot(None))
+    elif status == 'disponivel':
+        query = query.filter(ProductKey.user_id.is_(None))
+    query = apply_sort(query, {'created_at': ProductKey.created_at, 'key_value': ProductKey.key_value},
+                       args['sort'], args['order'], ProductKey.id)
+    pagination = query.paginate(page=args['page'], per_page=args['per_page'], error_out=False)
+    return render_template('admin_keys.html', keys=pagination.items, pagination=pagination,
+                           listing=args, status=status)
 
 @app.route('/admin/generate_keys', methods=['POST'])
 @admin_required
 def generate_keys():
-    quantity = int(request.form.get('quantity', 1))
-    leads_per_key = int(request.form.get('leads_per_key', 100))
+    try:
+        quantity = int(request.form.get('quantity', 1))
+        leads_per_key = int(request.form.get('leads_per_key', 100))
+    except ValueError:
+        flash('Quantidade inválida!', 'danger')
+        return redirect(url_for('admin_keys'))
     
-    keys_generated = []
+    if not 1 <= quantity <= MAX_KEYS_PER_REQUEST or leads_per_key <= 0:
+        flash(f'Gere entre 1 e {MAX_KEYS_PER_REQUEST} chaves por vez!', 'danger')
+        return redirect(url_for('admin_keys'))
     
-    for _ in range(quantity):
-        key_value = generate_product_key()
-        new_key = ProductKey(
-            key_value=key_value,
-            total_leads=leads_per_key,
-            remaining_leads=leads_per_key
-        )
-        db.session.add(new_key)
-        keys_generated.append(key_value)
+    try:
+        keys_generated = bulk_create_keys(db.session, ProductKey, quantity, leads_per_key, grouped=True)
+    except IntegrityError as e:
+        print(f"Erro ao gerar chaves: {e}")
+        flash('Erro ao gerar chaves!', 'danger')
+        return redirect(url_for('admin_keys'))
     
-    db.session.commit()
+    # Lotes grandes: lista de chaves em CSV, enviada em streaming
+    if request.form.get('format') == 'csv':
+        filename = f"product_keys_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        return Response(keys_csv(keys_generated, leads_per_key), mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename={filename}'})
     
     flash(f'{quantity} chave(s) gerada(s) com sucesso!', 'success')
     
@@ -562,6 +615,8 @@ def upload_database():
                 flash('Banco de dados inválido! A tabela "leads" não foi encontrada.', 'danger')
                 return redirect(url_for('admin_database'))
             conn.close()
+            if lead_server is not None:
+                load_into_server(filepath, lead_server)
         except Exception as e:
             os.remove(filepath)
             flash(f'Erro ao verificar banco de dados: {str(e)}', 'danger')
@@ -593,7 +648,16 @@ def activate_database(db_id):
     # Ativar o banco selecionado
     db_config = DatabaseConfig.query.get(db_id)
     if db_config:
+        if lead_server is not None:
+            # O servidor guarda só uma versão: a reativada é carregada de novo
+            try:
+                load_into_server(db_config.database_path, lead_server)
+            except Exception as e:
+                db.session.rollback()
+                flash(f'Erro ao carregar banco de dados no servidor: {str(e)}', 'danger')
+                return redirect(url_for('admin_database'))
         db_config.is_active = True
+        db_config.version = uuid.uuid4().hex
         db.session.commit()
         flash('Banco de dados ativado com sucesso!', 'success')
     else:
@@ -623,6 +687,10 @@ def delete_database(db_id):
     flash('Banco de dados removido com sucesso!', 'success')
     return redirect(url_for('admin_database'))
 
+# Tempo de inicialização do módulo, pago por toda instância nova (cold start)
+app.config['STARTUP_SECONDS'] = round(time.perf_counter() - _startup_started, 3)
+print(f"Aplicação inicializada em {app.config['STARTUP_SECONDS']}s")
+
 if __name__ == '__main__':
     # Em produção, o App Engine usa o Gunicorn
     # Em desenvolvimento, usa o servidor de desenvolvimento do Flask
@@ -0,0 +1,112 @@
+"""
+Benchmark do pool de conexões contra um MySQL local (ou compatível, ex.: MariaDB)
+
+Simula as threads de um worker do gunicorn fazendo requisições que pegam uma
+conexão do pool, executam uma consulta e devolvem a conexão. Serve para testar
+pool_size/max_overflow/pool_timeout sem o Cloud SQL:
+
+    docker run -d -p 3306:3306 -e MYSQL_ALLOW_EMPTY_PASSWORD=yes -e MYSQL_DATABASE=sistema_db mysql:8
+    python benchmark_pool.py --threads 8 --requests 2000 --query-ms 20
+
+As variáveis DB_* e GUNICORN_* são as mesmas de cloud_sql_config.
+"""
+import argparse
+import statistics
+import threading
+import time
+
+import sqlalchemy
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+
+from cloud_sql_config import get_database_uri, get_engine_options, PoolMetrics
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_benchmark(engine, threads, requests, query_ms):
+    """Executa as requisições e retorna tempos de espera por conexão e totais"""
+    waits = []
+    latencies = []
+    timeouts = 0
+    lock = threading.Lock()
+    counter = iter(range(requests))
+    query = sqlalchemy.text("SELECT SLEEP(:seconds)") if query_ms else sqlalchemy.text("SELECT 1")
+
+    def worker():
+        nonlocal timeouts
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            started = time.perf_counter()
+            try:
+                with engine.connect() as conn:
+                    acquired = time.perf_counter()
+                    conn.execute(query, {'seconds': query_ms / 1000})
+            except PoolTimeout:
+                with lock:
+                    timeouts += 1
+                continue
+            finished = time.perf_counter()
+            with lock:
+                waits.append(acquired - started)
+                latencies.append(finished - started)
+
+    pool_threads = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in pool_threads:
+        thread.start()
+    for thread in pool_threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'requests': len(latencies),
+        'timeouts': timeouts,
+        'elapsed_s': round(elapsed, 2),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'wait_p50_ms': round(percentile(waits, 0.5) * 1000, 2),
+        'wait_p95_ms': round(percentile(waits, 0.95) * 1000, 2),
+        'wait_max_ms': round(max(waits, default=0) * 1000, 2),
+        'latency_mean_ms': round(statistics.mean(latencies) * 1000, 2) if latencies else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark do pool de conexões MySQL')
+    parser.add_argument('--url', default=None, help='URL do SQLAlchemy (padrão: get_database_uri())')
+    parser.add_argument('--threads', type=int, default=8, help='Threads concorrentes (threads do gunicorn)')
+    parser.add_argument('--requests', type=int, default=1000, help='Total de requisições')
+    parser.add_argument('--query-ms', type=int, default=20, help='Duração de cada consulta (SELECT SLEEP)')
+    parser.add_argument('--pool-size', type=int, default=None)
+    parser.add_argument('--max-overflow', type=int, default=None)
+    parser.add_argument('--pool-timeout', type=int, default=None)
+    args = parser.parse_args()
+
+    options = get_engine_options()
+    for name in ('pool_size', 'max_overflow', 'pool_timeout'):
+        value = getattr(args, name)
+        if value is not None:
+            options[name] = value
+
+    engine = sqlalchemy.create_engine(args.url or get_database_uri(), **options)
+    metrics = PoolMetrics(engine)
+    try:
+        print(f"Pool: pool_size={options['pool_size']} max_overflow={options['max_overflow']} "
+              f"pool_timeout={options['pool_timeout']}s")
+        result = run_benchmark(engine, args.threads, args.requests, args.query_ms)
+        for name, value in result.items():
+            print(f"{name}: {value}")
+        for name, value in metrics.snapshot().items():
+            print(f"pool.{name}: {value}")
+    finally:
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
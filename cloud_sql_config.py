@@ -2,75 +2,146 @@
 Configuração para Google Cloud SQL
 """
 import os
+import threading
+import time
 import sqlalchemy
+from sqlalchemy import event
+
+# Conexões que o Cloud SQL aceita (db-f1-micro: 250) e reserva para admin/migrações
+DEFAULT_MAX_CONNECTIONS = 250
+DEFAULT_RESERVED_CONNECTIONS = 10
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+def get_pool_settings():
+    """Tamanho do pool a partir do modelo de workers/threads do gunicorn e do max_instances
+
+    Cada thread usa no máximo uma conexão por vez, então o pool de um processo
+    não precisa passar do número de threads; e a soma de todos os processos
+    (instâncias x workers) precisa caber no limite de conexões do Cloud SQL.
+    Com LEAD_DATABASE_URL cada processo tem dois pools (sistema e base de
+    leads), que dividem a mesma cota. DB_POOL_SIZE e DB_MAX_OVERFLOW
+    sobrescrevem o cálculo.
+    """
+    workers = _env_int('GUNICORN_WORKERS', _env_int('WEB_CONCURRENCY', 1))
+    threads = _env_int('GUNICORN_THREADS', 1)
+    max_instances = _env_int('GAE_MAX_INSTANCES', 1)
+    max_connections = _env_int('DB_MAX_CONNECTIONS', DEFAULT_MAX_CONNECTIONS)
+    reserved = _env_int('DB_RESERVED_CONNECTIONS', DEFAULT_RESERVED_CONNECTIONS)
+    pools = 2 if os.environ.get('LEAD_DATABASE_URL') else 1
+
+    # Conexões disponíveis para cada pool no pior caso (todas as instâncias no ar)
+    per_process = max(1, (max_connections - reserved) // max(1, max_instances * workers * pools))
+    connections = min(threads, per_process)
+
+    # Pool fixo para a concorrência esperada; overflow só para picos, dentro do limite
+    pool_size = _env_int('DB_POOL_SIZE', max(1, connections))
+    max_overflow = _env_int('DB_MAX_OVERFLOW', max(0, min(2, per_process - pool_size)))
+
+    return {
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        # Espera curta por conexão: melhor falhar rápido do que segurar a requisição
+        'pool_timeout': _env_int('DB_POOL_TIMEOUT', 10),
+        'pool_recycle': _env_int('DB_POOL_RECYCLE', 1800),
+        'pool_pre_ping': True,
+    }
+
+def get_engine_options():
+    """Opções do engine (pool, pre-ping e timeouts) para SQLALCHEMY_ENGINE_OPTIONS"""
+    statement_timeout_ms = _env_int('DB_STATEMENT_TIMEOUT_MS', 30000)
+    options = get_pool_settings()
+    options['connect_args'] = {
+        'connect_timeout': _env_int('DB_CONNECT_TIMEOUT', 10),
+        # Timeout de rede um pouco acima do limite das consultas
+        'read_timeout': statement_timeout_ms // 1000 + 5,
+        'write_timeout': statement_timeout_ms // 1000 + 5,
+        # Limite de execução de SELECTs aplicado pelo próprio MySQL
+        'init_command': f'SET SESSION max_execution_time={statement_timeout_ms}',
+    }
+    return options
 
 # Configurações do Cloud SQL
 def get_cloud_sql_connection():
     """Retorna uma conexão com o Cloud SQL"""
-    
-    # Configurações de conexão
-    db_user = os.environ.get("DB_USER", "root")
-    db_pass = os.environ.get("DB_PASS", "")
-    db_name = os.environ.get("DB_NAME", "sistema_db")
-    db_socket_dir = os.environ.get("DB_SOCKET_DIR", "/cloudsql")
-    instance_connection_name = os.environ.get("INSTANCE_CONNECTION_NAME", "")
-    
-    # Se estiver rodando no App Engine
-    if os.environ.get('GAE_ENV', '').startswith('standard'):
-        # Usa Unix socket
-        db_socket = f"{db_socket_dir}/{instance_connection_name}"
-        
-        pool = sqlalchemy.create_engine(
-            sqlalchemy.engine.url.URL.create(
-                drivername="mysql+pymysql",
-                username=db_user,
-                password=db_pass,
-                database=db_name,
-                query={"unix_socket": db_socket}
-            ),
-            pool_size=5,
-            max_overflow=2,
-            pool_timeout=30,
-            pool_recycle=1800,
-        )
-    else:
-        # Desenvolvimento local - usa IP público
-        db_host = os.environ.get("DB_HOST", "127.0.0.1")
-        db_port = os.environ.get("DB_PORT", "3306")
-        
-        pool = sqlalchemy.create_engine(
-            sqlalchemy.engine.url.URL.create(
-                drivername="mysql+pymysql",
-                username=db_user,
-                password=db_pass,
-                host=db_host,
-                port=db_port,
-                database=db_name
-            ),
-            pool_size=5,
-            max_overflow=2,
-            pool_timeout=30,
-            pool_recycle=1800,
-        )
-    
-    return pool
+    return sqlalchemy.create_engine(get_database_uri(), **get_engine_options())
 
 def get_database_uri():
     """Retorna a URI do banco de dados para SQLAlchemy"""
-    
+
     db_user = os.environ.get("DB_USER", "root")
     db_pass = os.environ.get("DB_PASS", "")
     db_name = os.environ.get("DB_NAME", "sistema_db")
-    
+
     # Se estiver rodando no App Engine
     if os.environ.get('GAE_ENV', '').startswith('standard'):
         db_socket_dir = os.environ.get("DB_SOCKET_DIR", "/cloudsql")
         instance_connection_name = os.environ.get("INSTANCE_CONNECTION_NAME", "")
-        
+
         return f"mysql+pymysql://{db_user}:{db_pass}@/{db_name}?unix_socket={db_socket_dir}/{instance_connection_name}"
     else:
         # Desenvolvimento local
         db_host = os.environ.get("DB_HOST", "127.0.0.1")
         db_port = os.environ.get("DB_PORT", "3306")
-        
-        return f"mysql+pymysql://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}"
\ No newline at end of file
+
+        return f"mysql+pymysql://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}"
+
+class PoolMetrics:
+    """Contadores do pool de conexões, alimentados pelos eventos do SQLAlchemy"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.invalidations = 0
+        self.max_checked_out = 0
+        self._checked_out = 0
+        self._checkout_started = {}
+        self.total_hold_seconds = 0.0
+
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'checkout', self._on_checkout)
+        event.listen(engine, 'checkin', self._on_checkin)
+        event.listen(engine, 'invalidate', self._on_invalidate)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+            self._checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self._checked_out)
+            self._checkout_started[id(connection_record)] = time.perf_counter()
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            started = self._checkout_started.pop(id(connection_record), None)
+            if started is not None:
+                self._checked_out -= 1
+                self.total_hold_seconds += time.perf_counter() - started
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+
+    def snapshot(self):
+        """Estado atual do pool e contadores acumulados"""
+        pool = self.engine.pool
+        with self._lock:
+            metrics = {
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'invalidations': self.invalidations,
+                'max_checked_out': self.max_checked_out,
+                'avg_hold_ms': round(self.total_hold_seconds / self.checkouts * 1000, 2) if self.checkouts else 0,
+            }
+        # Pools sem tamanho fixo (ex.: SQLite em desenvolvimento) não têm estes métodos
+        for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+            if hasattr(pool, name):
+                metrics[name] = getattr(pool, name)()
+        return metrics
@@ -0,0 +1,119 @@
+"""
+Enriquecimento em lote: cruza uma lista de CNPJs com a base de empresas
+"""
+import csv
+import io
+import itertools
+import re
+
+from export_formats import write_export
+from lead_query import select_clause
+
+# Quantidade máxima de CNPJs aceitos por requisição
+MAX_ENRICH_CNPJS = 200000
+
+_NON_DIGITS = re.compile(r'\D')
+
+
+def normalize_cnpj(value):
+    """Normaliza um CNPJ para (básico, ordem, dv); ordem/dv são None para CNPJ básico
+
+    Planilhas costumam perder zeros à esquerda, então até 8 dígitos é tratado
+    como CNPJ básico e de 9 a 14 dígitos como CNPJ completo.
+    """
+    digits = _NON_DIGITS.sub('', str(value))
+    if not digits or len(digits) > 14:
+        return None
+    if len(digits) <= 8:
+        return digits.zfill(8), None, None
+    digits = digits.zfill(14)
+    return digits[:8], digits[8:12], digits[12:]
+
+
+def parse_cnpjs(values):
+    """Normaliza e remove duplicados, mantendo a ordem de entrada
+
+    Nenhum estabelecimento casa com mais de um item da lista, então as linhas
+    do resultado são estabelecimentos distintos.
+    Retorna (lista de (informado, básico, ordem, dv), quantidade de inválidos).
+    """
+    seen = set()
+    lookups = []
+    invalid = 0
+
+    for value in values:
+        value = str(value).strip()
+        if not value:
+            continue
+        normalized = normalize_cnpj(value)
+        if normalized is None:
+            invalid += 1
+            continue
+        if normalized in seen:
+            continue
+        seen.add(normalized)
+        lookups.append((value,) + normalized)
+
+    # CNPJ completo de uma empresa também enviada pelo básico: o básico já traz
+    # todos os estabelecimentos, e cada estabelecimento é cobrado uma só vez
+    whole_companies = {basico for _, basico, ordem, _ in lookups if ordem is None}
+    lookups = [lookup for lookup in lookups if lookup[2] is None or lookup[1] not in whole_companies]
+
+    return lookups, invalid
+
+
+def read_first_column(stream, accept):
+    """Valores da primeira coluna de um arquivo CSV/TXT enviado que passam em accept"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='ignore', newline='')
+    first_line = text.readline()
+
+    try:
+        dialect = csv.Sniffer().sniff(first_line, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+
+    for row in csv.reader(itertools.chain([first_line], text), dialect):
+        if row and accept(row[0]):
+            yield row[0]
+
+
+def read_cnpj_file(stream):
+    """Lê a primeira coluna de um arquivo CSV/TXT enviado (uma linha por CNPJ)"""
+    # Cabeçalhos e linhas sem dígitos são ignorados
+    return read_first_column(stream, lambda value: _NON_DIGITS.sub('', value))
+
+
+def enrich_to_file(conn, lookups, selected_columns, limit, filepath, export_format):
+    """Carrega os CNPJs em uma tabela temporária, cruza pelo índice da chave
+    primária e grava os encontrados no arquivo. Retorna o número de linhas."""
+    try:
+        # TEMPORARY e sem rowid: o mesmo SQL vale para SQLite, MySQL e PostgreSQL
+        conn.execute("""
+            CREATE TEMPORARY TABLE enrich_cnpj (
+                posicao INTEGER,
+                cnpj_informado TEXT,
+                cnpj_basico TEXT,
+                cnpj_ordem TEXT,
+                cnpj_dv TEXT
+            )
+        """)
+        conn.executemany("INSERT INTO enrich_cnpj VALUES (?, ?, ?, ?, ?)",
+                         ((i,) + tuple(lookup) for i, lookup in enumerate(lookups)))
+
+        # CROSS JOIN fixa a lista enviada como laço externo: cada CNPJ vira
+        # uma busca pontual na chave primária de estabelecimento
+        query = f"""
+            SELECT l.cnpj_informado, {select_clause(selected_columns)}
+            FROM enrich_cnpj l
+            CROSS JOIN estabelecimento est
+            JOIN empresas e ON e.cnpj_basico = est.cnpj_basico
+            LEFT JOIN simples s ON s.cnpj_basico = est.cnpj_basico
+            WHERE est.cnpj_basico = l.cnpj_basico
+                AND (l.cnpj_ordem IS NULL OR (est.cnpj_ordem = l.cnpj_ordem AND est.cnpj_dv = l.cnpj_dv))
+            ORDER BY l.posicao
+            LIMIT ?
+        """
+        cursor = conn.execute(query, (int(limit),))
+        return write_export(cursor, filepath, export_format)
+    finally:
+        conn.execute("DROP TABLE IF EXISTS enrich_cnpj")
@@ -0,0 +1,160 @@
+"""
+Busca reversa: empresas donas de um telefone ou de um domínio de email
+
+Telefones são comparados em E.164 e domínios com o email_dominio dos
+estabelecimentos, ambos indexados na ativação (lead_database, etapas
+contact_columns e contact_lookup). A lista enviada vai para uma tabela
+temporária e cada contato vira uma busca pontual nos índices. Um
+estabelecimento encontrado por vários contatos sai (e é cobrado) uma vez só,
+com o primeiro deles na ordem da lista.
+"""
+import re
+
+from cnpj_enrichment import read_first_column
+from export_formats import write_export
+from lead_database import PHONE_COUNTRY_CODE, normalize_phone
+from lead_query import select_clause
+
+# Quantidade máxima de contatos aceitos por requisição
+MAX_LOOKUP_CONTACTS = 200000
+
+# Domínios de email gratuitos: pertencem a milhares de empresas e não identificam nenhuma
+FREE_EMAIL_DOMAINS = {
+    'gmail.com', 'hotmail.com', 'hotmail.com.br', 'outlook.com', 'outlook.com.br', 'live.com',
+    'yahoo.com', 'yahoo.com.br', 'bol.com.br', 'uol.com.br', 'terra.com.br', 'ig.com.br', 'icloud.com',
+}
+
+_NON_DIGITS = re.compile(r'\D')
+
+_DOMAIN_PATTERN = re.compile(r'^[a-z0-9-]+(\.[a-z0-9-]+)+$')
+
+
+def normalize_domain(value):
+    """Domínio a partir de um email, URL ou domínio ('Vendas@Empresa.com.br' -> 'empresa.com.br')"""
+    value = value.strip().lower()
+    value = value.rsplit('@', 1)[-1]
+    value = re.sub(r'^[a-z]+://', '', value).split('/', 1)[0]
+    if value.startswith('www.'):
+        value = value[4:]
+    return value if _DOMAIN_PATTERN.match(value) else None
+
+
+def normalize_contact(value):
+    """(tipo, chave) de um telefone ou domínio informado, ou None se inválido"""
+    value = str(value).strip()
+    if not value:
+        return None
+    if '@' in value or re.search(r'[a-zA-Z]', value):
+        domain = normalize_domain(value)
+        if domain is None or domain in FREE_EMAIL_DOMAINS:
+            return None
+        return 'dominio', domain
+
+    digits = _NON_DIGITS.sub('', value)
+    if digits.startswith(PHONE_COUNTRY_CODE) and len(digits) in (12, 13):
+        digits = digits[len(PHONE_COUNTRY_CODE):]
+    phone, _ = normalize_phone('', digits)
+    return ('telefone', phone) if phone else None
+
+
+def parse_contacts(values):
+    """Normaliza e remove duplicados, mantendo a ordem de entrada
+
+    Retorna (lista de (informado, tipo, chave), quantidade de inválidos).
+    """
+    seen = set()
+    lookups = []
+    invalid = 0
+
+    for value in values:
+        value = str(value).strip()
+        if not value:
+            continue
+        normalized = normalize_contact(value)
+        if normalized is None:
+            invalid += 1
+            continue
+        if normalized in seen:
+            continue
+        seen.add(normalized)
+        lookups.append((value,) + normalized)
+
+    return lookups, invalid
+
+
+def read_contact_file(stream):
+    """Lê a primeira coluna de um arquivo CSV/TXT enviado (um telefone ou domínio por linha)"""
+    return read_first_column(stream, lambda value: value.strip())
+
+
+def lookup_to_file(conn, lookups, selected_columns, limit, filepath, export_format):
+    """Carrega os contatos em uma tabela temporária, cruza pelos índices de
+    telefone e domínio e grava os estabelecimentos encontrados no arquivo,
+    um por linha. Retorna o número de linhas."""
+    try:
+        conn.execute("""
+            CREATE TEMPORARY TABLE lookup_contato (
+                posicao INTEGER PRIMARY KEY,
+                contato_informado TEXT,
+                tipo TEXT,
+                chave TEXT
+            )
+        """)
+        conn.executemany("INSERT INTO lookup_contato VALUES (?, ?, ?, ?)",
+                         ((i,) + tuple(lookup) for i, lookup in enumerate(lookups)))
+        conn.execute("""
+            CREATE TEMPORARY TABLE lookup_encontrado (
+                posicao INTEGER,
+                cnpj_basico TEXT,
+                cnpj_ordem TEXT,
+                cnpj_dv TEXT
+            )
+        """)
+
+        # Uma busca por índice. O CROSS JOIN fixa a ordem lista -> estabelecimento,
+        # então cada contato é uma busca no índice da sua coluna. Cada busca é uma
+        # instrução separada: o MySQL não lê a mesma tabela temporária duas vezes
+        # numa consulta.
+        matches = [
+            "l.tipo = 'telefone' AND est.telefone_1_e164 = l.chave",
+            "l.tipo = 'telefone' AND est.telefone_2_e164 = l.chave",
+            "l.tipo = 'dominio' AND est.email_dominio = l.chave",
+        ]
+        for match in matches:
+            conn.execute(f"""
+                INSERT INTO lookup_encontrado
+                SELECT l.posicao, est.cnpj_basico, est.cnpj_ordem, est.cnpj_dv
+                FROM lookup_contato l
+                CROSS JOIN estabelecimento est
+                WHERE {match}
+            """)
+
+        # Cada estabelecimento uma vez, pelo primeiro contato que o encontrou
+        cursor = conn.execute(f"""
+            SELECT l.posicao, l.contato_informado, {select_clause(selected_columns)}
+            FROM (
+                SELECT MIN(posicao) AS posicao, cnpj_basico, cnpj_ordem, cnpj_dv
+                FROM lookup_encontrado
+                GROUP BY cnpj_basico, cnpj_ordem, cnpj_dv
+            ) AS m
+            JOIN lookup_contato l ON l.posicao = m.posicao
+            JOIN estabelecimento est ON est.cnpj_basico = m.cnpj_basico
+                AND est.cnpj_ordem = m.cnpj_ordem AND est.cnpj_dv = m.cnpj_dv
+            JOIN empresas e ON e.cnpj_basico = est.cnpj_basico
+            LEFT JOIN simples s ON s.cnpj_basico = est.cnpj_basico
+            ORDER BY 1 LIMIT ?""", (int(limit),))
+        return write_export(_PositionlessCursor(cursor), filepath, export_format)
+    finally:
+        conn.execute("DROP TABLE IF EXISTS lookup_encontrado")
+        conn.execute("DROP TABLE IF EXISTS lookup_contato")
+
+
+class _PositionlessCursor:
+    """Envolve um cursor e descarta a primeira coluna (posicao, usada só na ordenação)"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.description = cursor.description[1:]
+
+    def fetchmany(self, size):
+        return [row[1:] for row in self._cursor.fetchmany(size)]
@@ -0,0 +1,145 @@
+"""
+Contagens aproximadas e amostras aleatórias para a prévia
+
+Um filtro sobre uma só coluna com histograma é respondido pela soma das
+contagens dos valores que casam (exato, sem tocar nas tabelas grandes).
+Combinações de filtros são estimadas pela fração da amostra uniforme
+(lead_sample) que os atende, com margem de erro de 95%; com poucas linhas
+da amostra atendendo, a prévia volta à contagem exata. As estruturas são
+montadas na ativação (lead_database, etapa count_estimates); a cobrança
+continua usando as linhas efetivamente exportadas.
+
+A mesma amostra, lida na ordem embaralhada, dá linhas aleatórias da prévia
+sem percorrer o resultado inteiro.
+"""
+import math
+import random
+
+from lead_backend import dialect_of
+from lead_query import CONTACT_FILTERS, MAX_RESULTS, build_query, flag_value, like_operator
+
+# z do intervalo de confiança de 95%
+CONFIDENCE_Z = 1.96
+
+# Linhas da amostra que precisam atender aos filtros para a estimativa valer;
+# abaixo disso o erro relativo é grande e a contagem exata é barata
+MIN_SAMPLE_MATCHES = 30
+
+
+def _has_value(value):
+    if isinstance(value, dict):
+        value = value.get('value')
+    if isinstance(value, str):
+        return bool(value.strip())
+    return value is not None and value != []
+
+
+def _histogram_condition(column, value, dialect='sqlite'):
+    """(condição sobre value, parâmetro) quando o filtro pode ser somado no histograma"""
+    op = None
+    if isinstance(value, dict):
+        op = value.get('op', 'contains')
+        value = value.get('value')
+    if column in CONTACT_FILTERS:
+        # Flags de contato: o histograma guarda 0/1 como texto
+        return "value = ?", str(int(flag_value(value)))
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    if op in (None, 'contains'):
+        return f"value {like_operator(dialect)} ?", f"%{value}%"
+    if op == 'exact':
+        return "value = ?", value
+    if op == 'prefix':
+        return f"value {like_operator(dialect)} ?", f"{value}%"
+    return None
+
+
+def sample_estimate(matches, sample_size, total):
+    """(estimativa, margem de 95%) de uma amostra aleatória simples sem reposição"""
+    p = matches / sample_size
+    # Correção de população finita: amostra do tamanho da população é exata
+    fpc = (total - sample_size) / (total - 1) if total > 1 else 0
+    if matches == 0:
+        # Regra de três: sem ocorrências, a fração real fica abaixo de 3/n com 95%
+        error = total * 3 / sample_size if fpc else 0
+    else:
+        error = CONFIDENCE_Z * total * math.sqrt(p * (1 - p) / sample_size * fpc)
+    return round(total * p), math.ceil(error)
+
+
+def approximate_count(conn, filters, features):
+    """{'count', 'error', 'method'} estimados para os filtros
+
+    A contagem é limitada a MAX_RESULTS, como a contagem exata. Retorna None
+    se a base não tem as estruturas da etapa count_estimates ou se a amostra
+    tem menos de MIN_SAMPLE_MATCHES linhas que atendem aos filtros.
+    """
+    if 'count_estimates' not in features:
+        return None
+    row = conn.execute("SELECT count FROM lead_histogram WHERE column_name = '*'").fetchone()
+    if row is None:
+        return None
+    total = row[0]
+
+    active = {column: value for column, value in filters.items() if _has_value(value)}
+    if not active:
+        return {'count': min(total, MAX_RESULTS), 'error': 0, 'method': 'total'}
+
+    if len(active) == 1:
+        column, value = next(iter(active.items()))
+        condition = _histogram_condition(column, value, dialect_of(conn))
+        if condition and conn.execute("SELECT 1 FROM lead_histogram WHERE column_name = ? LIMIT 1",
+                                      (column,)).fetchone():
+            count = conn.execute(
+                f"SELECT COALESCE(SUM(count), 0) FROM lead_histogram WHERE column_name = ? AND {condition[0]}",
+                (column, condition[1])).fetchone()[0]
+            # SUM volta como Decimal no PostgreSQL
+            return {'count': min(int(count), MAX_RESULTS), 'error': 0, 'method': 'histogram'}
+
+    sample_size = conn.execute("SELECT COUNT(*) FROM lead_sample").fetchone()[0]
+    if sample_size == 0:
+        return {'count': 0, 'error': 0, 'method': 'sample'}
+
+    query, params = build_query(active, ['est.cnpj_basico'], limit=sample_size,
+                                features=features, from_sample=True, dialect=dialect_of(conn))
+    matches = conn.execute(f"SELECT COUNT(*) FROM ({query}) AS amostra", params).fetchone()[0]
+    if matches < MIN_SAMPLE_MATCHES and sample_size < total:
+        return None
+    count, error = sample_estimate(matches, sample_size, total)
+    return {'count': min(count, MAX_RESULTS), 'error': error, 'method': 'sample'}
+
+
+def sample_rows(conn, filters, selected_columns, features, size):
+    """size linhas aleatórias do resultado, tiradas da amostra uniforme
+
+    Retorna None quando a base não tem a amostra ou ela tem menos de size
+    linhas que atendem aos filtros (filtros muito seletivos).
+    """
+    if 'count_estimates' not in features:
+        return None
+    query, params = build_query(filters, selected_columns, limit=size, features=features, from_sample=True,
+                                dialect=dialect_of(conn))
+    rows = conn.execute(query, params).fetchall()
+    return rows if len(rows) == size else None
+
+
+def reservoir_sample(cursor, rows, size, batch_size=1000):
+    """Amostra uniforme de size linhas (Algoritmo R) de rows mais o restante do cursor
+
+    rows são as primeiras linhas já lidas (no máximo size). Retorna a amostra
+    embaralhada e o número de linhas lidas.
+    """
+    sample = list(rows)
+    seen = len(rows)
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            break
+        for row in batch:
+            slot = random.randrange(seen + 1)
+            if slot < size:
+                sample[slot] = row
+            seen += 1
+    random.shuffle(sample)
+    return sample, seen
@@ -4,6 +4,7 @@ from faker import Faker
 from faker.providers import company
 import pandas as pd
 import os
+from lead_database import prepare_database
 
 # Configurar Faker para português brasileiro
 fake = Faker('pt_BR')
@@ -307,7 +308,7 @@ def create_test_database():
             '076',  # pais (Brasil)
             fake.date_between(start_date='-20y', end_date='today').strftime('%Y%m%d'),
             random.choice(['4711-3/02', '6201-5/00', '7020-4/00']),  # cnae_fiscal_principal
-            '',  # cnae_fiscal_secundaria
+            ','.join(c[0].replace('-', '').replace('/', '') for c in random.sample(cnaes, random.randint(0, 3))),  # cnae_fiscal_secundaria
             'RUA',  # tipo_logradouro
             fake.street_name(),  # logradouro
             str(random.randint(1, 9999)),  # numero
@@ -412,6 +413,9 @@ def create_test_database():
         print(f"CNPJ: {row[0]} | Empresa: {row[1]} | Fantasia: {row[2]} | UF: {row[3]} | Simples: {row[4]}")
     
     conn.close()
+    
+    # Mesma preparação aplicada na ativação de um banco enviado
+    prepare_database('data/empresas_teste.db')
     print(f"\nArquivo salvo em: data/empresas_teste.db")
 
 if __name__ == "__main__":
@@ -0,0 +1,191 @@
+"""
+Formatos de exportação gerados diretamente a partir do cursor do banco
+"""
+import contextlib
+import csv
+import gzip
+import io
+import itertools
+
+# formato -> (extensão, mimetype)
+EXPORT_FORMATS = {
+    'csv': ('.csv', 'text/csv'),
+    'csv.gz': ('.csv.gz', 'application/gzip'),
+    'csv.zst': ('.csv.zst', 'application/zstd'),
+    'parquet': ('.parquet', 'application/vnd.apache.parquet'),
+    'xlsx': ('.xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
+
+# Linhas lidas do cursor por vez
+CURSOR_BATCH_SIZE = 5000
+
+# Linhas por row group no Parquet
+PARQUET_ROW_GROUP_SIZE = 50000
+
+
+def validate_export_format(export_format):
+    """Valida o formato pedido e a presença da dependência que ele exige"""
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f'Formato de exportação inválido: {export_format}')
+
+    try:
+        if export_format == 'csv.zst':
+            import zstandard  # noqa: F401
+        elif export_format == 'parquet':
+            import pyarrow  # noqa: F401
+    except ImportError:
+        raise ValueError(f'Formato {export_format} não está disponível neste servidor')
+
+
+def export_filename(prefix, timestamp, export_format):
+    """Monta o nome do arquivo exportado"""
+    extension = EXPORT_FORMATS[export_format][0]
+    return f'{prefix}_{timestamp}{extension}'
+
+
+def export_mimetype(export_format):
+    return EXPORT_FORMATS[export_format][1]
+
+
+def iter_batches(cursor, batch_size=CURSOR_BATCH_SIZE):
+    """Lê o cursor em lotes sem materializar o resultado inteiro"""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield rows
+
+
+def write_export(cursor, filepath, export_format):
+    """Escreve o resultado do cursor no arquivo e retorna o número de linhas"""
+    columns = [description[0] for description in cursor.description]
+
+    if export_format == 'csv':
+        with open(filepath, 'w', newline='', encoding='utf-8') as f:
+            return _write_csv(f, columns, cursor)
+
+    if export_format == 'csv.gz':
+        with gzip.open(filepath, 'wt', newline='', encoding='utf-8', compresslevel=6) as f:
+            return _write_csv(f, columns, cursor)
+
+    if export_format == 'csv.zst':
+        import zstandard
+
+        with open(filepath, 'wb') as raw:
+            compressor = zstandard.ZstdCompressor(level=3)
+            with compressor.stream_writer(raw) as writer:
+                with io.TextIOWrapper(writer, encoding='utf-8', newline='') as f:
+                    return _write_csv(f, columns, cursor)
+
+    if export_format == 'parquet':
+        return _write_parquet(filepath, columns, cursor)
+
+    if export_format == 'xlsx':
+        return _write_xlsx(filepath, columns, cursor)
+
+    raise ValueError(f'Formato de exportação inválido: {export_format}')
+
+
+def _write_csv(f, columns, cursor):
+    writer = csv.writer(f)
+    writer.writerow(columns)
+    total = 0
+    for rows in iter_batches(cursor):
+        writer.writerows(rows)
+        total += len(rows)
+    return total
+
+
+def _write_parquet(filepath, columns, cursor):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # As tabelas da Receita são todas TEXT; um schema fixo evita que lotes
+    # só com nulos gerem tipos diferentes entre row groups
+    schema = pa.schema([(column, pa.string()) for column in columns])
+    total = 0
+
+    with pq.ParquetWriter(filepath, schema, compression='zstd') as writer:
+        for rows in iter_batches(cursor, PARQUET_ROW_GROUP_SIZE):
+            arrays = [
+                pa.array([None if row[i] is None else str(row[i]) for row in rows], type=pa.string())
+                for i in range(len(columns))
+            ]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            total += len(rows)
+
+    return total
+
+
+def _write_xlsx(filepath, columns, cursor):
+    return write_xlsx(filepath, columns, (row for rows in iter_batches(cursor) for row in rows))
+
+
+def write_xlsx(filepath, columns, rows):
+    """Grava linhas em XLSX no modo write-only do openpyxl e retorna o total"""
+    # openpyxl é pesado e só é carregado quando alguém pede Excel
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(list(columns))
+    total = 0
+    for row in rows:
+        sheet.append(list(row))
+        total += 1
+    workbook.save(filepath)
+    return total
+
+
+class _RowsCursor:
+    """Cursor mínimo (description e fetchmany) sobre as linhas lidas de um arquivo"""
+
+    def __init__(self, columns, rows):
+        self.description = [(column,) for column in columns]
+        self._rows = rows
+
+    def fetchmany(self, size):
+        return list(itertools.islice(self._rows, size))
+
+
+def copy_export_rows(source, target, export_format, max_rows):
+    """Grava em target as primeiras max_rows linhas de um arquivo exportado, no mesmo formato"""
+    with contextlib.ExitStack() as stack:
+        columns, rows = _read_export(stack, source, export_format)
+        return write_export(_RowsCursor(columns, itertools.islice(rows, max_rows)), target, export_format)
+
+
+def _read_export(stack, filepath, export_format):
+    """(colunas, iterador das linhas) de um arquivo gerado por write_export"""
+    if export_format in ('csv', 'csv.gz', 'csv.zst'):
+        if export_format == 'csv':
+            f = stack.enter_context(open(filepath, newline='', encoding='utf-8'))
+        elif export_format == 'csv.gz':
+            f = stack.enter_context(gzip.open(filepath, 'rt', newline='', encoding='utf-8'))
+        else:
+            import zstandard
+
+            raw = stack.enter_context(open(filepath, 'rb'))
+            reader = stack.enter_context(zstandard.ZstdDecompressor().stream_reader(raw))
+            f = stack.enter_context(io.TextIOWrapper(reader, encoding='utf-8', newline=''))
+        reader = csv.reader(f)
+        return next(reader), reader
+
+    if export_format == 'parquet':
+        import pyarrow.parquet as pq
+
+        parquet = pq.ParquetFile(filepath)
+        batches = parquet.iter_batches(batch_size=PARQUET_ROW_GROUP_SIZE)
+        rows = (row for batch in batches for row in zip(*(column.to_pylist() for column in batch.columns)))
+        return parquet.schema_arrow.names, rows
+
+    if export_format == 'xlsx':
+        from openpyxl import load_workbook
+
+        # Os objetos do export_store não têm extensão, que o openpyxl exige em caminhos
+        workbook = load_workbook(stack.enter_context(open(filepath, 'rb')), read_only=True)
+        stack.callback(workbook.close)
+        rows = workbook.active.iter_rows(values_only=True)
+        return list(next(rows)), rows
+
+    raise ValueError(f'Formato de exportação inválido: {export_format}')
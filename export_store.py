@@ -0,0 +1,108 @@
+"""
+Armazenamento dos arquivos exportados, endereçados pelo conteúdo
+
+Cada exportação é gravada num arquivo temporário dentro do store e, ao
+terminar, movida para objects/<sha256>: exportações com o mesmo conteúdo
+ocupam um só arquivo. Os metadados (dono, validade, downloads) ficam no
+modelo ExportArtifact do app; aqui ficam só os arquivos, o descarte dos que
+não são mais referenciados e os contadores do processo.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# Bytes lidos por vez no cálculo do hash
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Objetos recém-gravados ficam fora do descarte por este tempo (segundos)
+OBJECT_GRACE_SECONDS = 300
+
+
+class ExportStore:
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        self.tmp_dir = os.path.join(root, 'tmp')
+        self._lock = threading.Lock()
+        self.counters = {'stored': 0, 'deduplicated': 0, 'redownloads': 0, 'evicted': 0}
+
+    def _ensure_dirs(self):
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def new_path(self, filename):
+        """Caminho temporário para gravar uma exportação (mesmo disco dos objetos)"""
+        self._ensure_dirs()
+        return os.path.join(tempfile.mkdtemp(dir=self.tmp_dir), filename)
+
+    def discard(self, path):
+        """Remove um arquivo temporário que não virou artefato"""
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    def path(self, content_hash):
+        return os.path.join(self.objects_dir, content_hash[:2], content_hash)
+
+    def commit(self, path):
+        """Move o arquivo temporário para o endereço do seu conteúdo
+
+        Retorna (hash, tamanho); se o conteúdo já existe, o arquivo novo é descartado.
+        """
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        content_hash = digest.hexdigest()
+        size = os.path.getsize(path)
+
+        target = self.path(content_hash)
+        with self._lock:
+            if os.path.exists(target):
+                # Renova o mtime: o arquivo acabou de ser referenciado de novo
+                os.utime(target)
+                self.counters['deduplicated'] += 1
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(path, target)
+                self.counters['stored'] += 1
+        self.discard(path)
+        return content_hash, size
+
+    def exists(self, content_hash):
+        return os.path.exists(self.path(content_hash))
+
+    def delete_unreferenced(self, referenced, tmp_max_age, grace=OBJECT_GRACE_SECONDS):
+        """Apaga objetos fora de referenced e temporários mais antigos que tmp_max_age segundos
+
+        Objetos gravados há menos de grace segundos são mantidos: o artefato
+        que os referencia pode ainda não ter sido gravado no banco.
+        Retorna o número de objetos apagados.
+        """
+        deleted = 0
+        now = time.time()
+        with self._lock:
+            for directory, _, files in os.walk(self.objects_dir):
+                for name in files:
+                    path = os.path.join(directory, name)
+                    if name not in referenced and now - os.path.getmtime(path) > grace:
+                        os.remove(path)
+                        deleted += 1
+            self.counters['evicted'] += deleted
+
+        if os.path.isdir(self.tmp_dir):
+            for name in os.listdir(self.tmp_dir):
+                path = os.path.join(self.tmp_dir, name)
+                if now - os.path.getmtime(path) > tmp_max_age:
+                    shutil.rmtree(path, ignore_errors=True)
+        return deleted
+
+    def disk_usage(self):
+        """(arquivos, bytes) dos objetos no disco"""
+        files = size = 0
+        for directory, _, names in os.walk(self.objects_dir):
+            for name in names:
+                files += 1
+                size += os.path.getsize(os.path.join(directory, name))
+        return files, size
@@ -0,0 +1,88 @@
+"""
+Respostas JSON compactas com compressão negociada, ETags e Last-Modified
+"""
+import gzip
+import hashlib
+import json
+
+from flask import request, Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Abaixo deste tamanho a compressão não compensa
+MIN_COMPRESS_SIZE = 1024
+
+
+def encode_json(payload):
+    """Serializa o payload em bytes usando o encoder mais rápido disponível"""
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+
+
+def make_etag(*parts):
+    """Gera um ETag estável a partir das partes que definem o conteúdo"""
+    raw = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def columnar(columns, rows):
+    """Formato colunar: nomes das colunas uma vez e as linhas como listas"""
+    return {'columns': list(columns), 'rows': [list(row) for row in rows]}
+
+
+def not_modified(etag, last_modified=None):
+    """Retorna uma resposta 304 se o cliente já tem a versão do ETag
+
+    Sem If-None-Match, vale o If-Modified-Since contra last_modified (datetime UTC).
+    """
+    # If-None-Match usa a comparação fraca
+    if etag and request.if_none_match.contains_weak(etag):
+        fresh = True
+    elif last_modified and not request.if_none_match and request.if_modified_since:
+        # Last-Modified tem resolução de segundos
+        fresh = last_modified.replace(microsecond=0, tzinfo=None) <= request.if_modified_since.replace(tzinfo=None)
+    else:
+        fresh = False
+
+    if not fresh:
+        return None
+    response = Response(status=304)
+    if etag:
+        response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
+
+
+def json_response(payload, status=200, etag=None, max_age=0, last_modified=None):
+    """Resposta JSON com ETag/Last-Modified e gzip/brotli conforme o Accept-Encoding"""
+    body = encode_json(payload)
+    response = Response(body, status=status, mimetype='application/json')
+
+    if etag:
+        # Fraco (W/): o mesmo ETag vale para os corpos identity, gzip e brotli
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = f'private, max-age={max_age}, must-revalidate'
+    if last_modified:
+        response.last_modified = last_modified
+
+    response.vary.add('Accept-Encoding')
+    if len(body) >= MIN_COMPRESS_SIZE:
+        accepted = request.accept_encodings
+        if brotli is not None and accepted['br']:
+            response.set_data(brotli.compress(body, quality=5))
+            response.headers['Content-Encoding'] = 'br'
+        elif accepted['gzip']:
+            response.set_data(gzip.compress(body, compresslevel=6))
+            response.headers['Content-Encoding'] = 'gzip'
+
+    return response
@@ -0,0 +1,365 @@
+"""
+Backends da base de empresas: arquivo SQLite local ou servidor MySQL/PostgreSQL
+
+As consultas são montadas em SQL do SQLite (placeholders '?', '||'), com o
+operador de LIKE do dialeto vindo do lead_query; a conexão de servidor troca
+os placeholders, aplica o prazo como statement timeout e usa
+cursores do lado do servidor para exportações. O carregador copia uma base
+.db preparada para o servidor em lote e troca as tabelas de uma vez.
+"""
+import io
+import itertools
+import re
+import sqlite3
+import time
+
+import sqlalchemy
+
+# Instruções da VM do SQLite entre verificações do prazo
+PROGRESS_INTERVAL = 10000
+
+# Linhas copiadas por vez no carregamento
+LOAD_BATCH_SIZE = 10000
+
+# Linhas buscadas por vez nos cursores do lado do servidor
+STREAM_BATCH_SIZE = 2000
+
+# Colunas de dígitos filtradas por prefixo (lead_query): no PostgreSQL os
+# índices usam text_pattern_ops, que atende o LIKE 'prefixo%' e a igualdade
+PREFIX_SEARCH_COLUMNS = {'cnpj_basico', 'cnpj_completo', 'cnae'}
+
+# Etapas de preparação que dependem de recursos só do SQLite
+SQLITE_ONLY_STEPS = {'socios_fts'}
+
+# Tabelas de controle da atualização incremental, que ficam só no arquivo SQLite
+SKIP_TABLES = {'lead_changes'}
+
+# Colunas de chave com largura conhecida: no MySQL os índices compostos
+# (estabelecimento_cnae) precisam caber no limite de 3072 bytes por chave
+MYSQL_KEY_COLUMN_TYPES = {
+    'cnpj_basico': 'VARCHAR(14)',
+    'cnpj_ordem': 'VARCHAR(14)',
+    'cnpj_dv': 'VARCHAR(14)',
+    'cnpj_completo': 'VARCHAR(14)',
+    'cnpj_cpf_socio': 'VARCHAR(14)',
+    'cnae': 'VARCHAR(16)',
+    'codigo': 'VARCHAR(16)',
+}
+
+
+# Literal entre aspas simples (mantido como está) ou placeholder '?'
+_LITERAL_OR_PLACEHOLDER = re.compile(r"('(?:[^']|'')*')|\?")
+
+
+class LeadSQLiteConnection(sqlite3.Connection):
+    """Conexão SQLite com a mesma interface da conexão de servidor"""
+    dialect = 'sqlite'
+
+    def stream(self, query, params=()):
+        # O cursor do SQLite já lê as linhas sob demanda
+        return self.execute(query, params)
+
+
+class SQLiteBackend:
+    """Arquivo SQLite local (a base ativa enviada pelo admin)"""
+    dialect = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self, timeout=None, expired=None):
+        conn = sqlite3.connect(self.path, factory=LeadSQLiteConnection)
+        if expired is not None:
+            # Retornar verdadeiro no progress handler interrompe a consulta em andamento
+            conn.set_progress_handler(expired, PROGRESS_INTERVAL)
+        return conn
+
+
+class _PrefetchedCursor:
+    """Cursor nomeado do psycopg2 só tem description depois do primeiro lote"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+        self.description = cursor.description
+
+    def fetchmany(self, size):
+        if self._rows:
+            rows, self._rows = self._rows[:size], self._rows[size:]
+            return rows
+        return self._cursor.fetchmany(size)
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows + self._cursor.fetchall()
+
+
+class ServerConnection:
+    """Conexão MySQL/PostgreSQL do pool com execute/executemany/stream no estilo sqlite3"""
+
+    _stream_names = itertools.count()
+
+    def __init__(self, raw, dialect, timeout=None):
+        self._raw = raw
+        self.dialect = dialect
+        # Prazo em ms; 0 desliga o limite
+        timeout_ms = max(int(timeout * 1000), 1) if timeout is not None else 0
+        cursor = raw.cursor()
+        if dialect == 'mysql':
+            cursor.execute(f"SET SESSION max_execution_time = {timeout_ms}")
+        else:
+            cursor.execute(f"SET statement_timeout = {timeout_ms}")
+        cursor.close()
+
+    @property
+    def Error(self):
+        # Exceção base do driver (DB-API), como sqlite3.Connection.Error
+        return self._raw.driver_connection.Error
+
+    @staticmethod
+    def _adapt(query):
+        """Placeholders '?' fora dos literais viram '%s'; '%' é escapado para o driver"""
+        query = query.replace('%', '%%')
+        return _LITERAL_OR_PLACEHOLDER.sub(lambda match: match.group(1) or '%s', query)
+
+    def cursor(self):
+        return self._raw.cursor()
+
+    def execute(self, query, params=()):
+        cursor = self._raw.cursor()
+        cursor.execute(self._adapt(query), tuple(params))
+        return cursor
+
+    def executemany(self, query, rows):
+        cursor = self._raw.cursor()
+        cursor.executemany(self._adapt(query), [tuple(row) for row in rows])
+        return cursor
+
+    def stream(self, query, params=()):
+        """Cursor do lado do servidor: as linhas chegam em lotes, sem carregar o resultado"""
+        if self.dialect == 'mysql':
+            import pymysql.cursors
+            cursor = self._raw.cursor(pymysql.cursors.SSCursor)
+        else:
+            cursor = self._raw.cursor(name=f'lead_stream_{next(self._stream_names)}')
+            cursor.itersize = STREAM_BATCH_SIZE
+        cursor.execute(self._adapt(query), tuple(params))
+        if self.dialect == 'postgresql':
+            return _PrefetchedCursor(cursor)
+        return cursor
+
+    def commit(self):
+        self._raw.commit()
+
+    def rollback(self):
+        self._raw.rollback()
+
+    def interrupt(self):
+        # PostgreSQL cancela a consulta em andamento; no MySQL vale o max_execution_time
+        if self.dialect == 'postgresql':
+            self._raw.driver_connection.cancel()
+
+    def close(self):
+        # Devolve a conexão ao pool (com rollback de transação pendente)
+        self._raw.close()
+
+
+class ServerBackend:
+    """Base de empresas em um servidor MySQL ou PostgreSQL (URL do SQLAlchemy)"""
+
+    def __init__(self, url, **pool_settings):
+        # pool_settings: tamanho e timeouts do pool (cloud_sql_config.get_pool_settings)
+        options = {'pool_pre_ping': True, 'pool_recycle': 1800, **pool_settings}
+        self.engine = sqlalchemy.create_engine(url, **options)
+        self.dialect = self.engine.dialect.name
+        if self.dialect == 'mysql':
+            # Uma vez por conexão física, não a cada retirada do pool
+            sqlalchemy.event.listen(self.engine, 'connect', _mysql_session_mode)
+
+    def connect(self, timeout=None, expired=None):
+        return ServerConnection(self.engine.raw_connection(), self.dialect, timeout)
+
+
+def _mysql_session_mode(dbapi_connection, connection_record):
+    # '||' como concatenação, como no SQLite e no PostgreSQL
+    cursor = dbapi_connection.cursor()
+    cursor.execute("SET SESSION sql_mode = CONCAT(@@sql_mode, ',PIPES_AS_CONCAT')")
+    cursor.close()
+
+
+def dialect_of(conn):
+    """Dialeto da conexão para o lead_query ('sqlite' também para conexões sqlite3 comuns)"""
+    return getattr(conn, 'dialect', 'sqlite')
+
+
+def recover_after_error(conn):
+    """Depois de um erro tratado: o PostgreSQL aborta a transação até o rollback
+
+    O SQLite segue normalmente, e um rollback ali desfaria escritas pendentes.
+    """
+    if dialect_of(conn) == 'postgresql':
+        conn.rollback()
+
+
+def connect(source, timeout=None, expired=None):
+    """Conexão com a base: caminho de um arquivo SQLite ou um backend"""
+    if isinstance(source, str):
+        source = SQLiteBackend(source)
+    return source.connect(timeout=timeout, expired=expired)
+
+
+def _sqlite_tables(conn):
+    """Tabelas comuns da base (sem as virtuais do FTS5 e suas tabelas internas)"""
+    rows = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table'").fetchall()
+    virtual = [name for name, sql in rows if sql and sql.upper().startswith('CREATE VIRTUAL')]
+    return [
+        name for name, sql in rows
+        if not name.startswith('sqlite_') and name not in virtual and name not in SKIP_TABLES
+        and not any(name.startswith(f'{v}_') for v in virtual)
+    ]
+
+
+def _sqlite_indexes(conn, table):
+    """(nome, colunas) dos índices da tabela, incluindo os da chave primária"""
+    indexes = []
+    for _, name, *_ in conn.execute(f"PRAGMA index_list({table})").fetchall():
+        columns = [row[2] for row in conn.execute(f"PRAGMA index_info({name})")]
+        if columns and None not in columns:
+            indexes.append((name.replace('sqlite_autoindex_', 'pk_'), columns))
+    return indexes
+
+
+def _column_type(declared, dialect, indexed, name=None):
+    declared = (declared or '').upper()
+    if 'INT' in declared:
+        return 'BIGINT'
+    if any(t in declared for t in ('REAL', 'FLOA', 'DOUB')):
+        return 'DOUBLE PRECISION'
+    # MySQL só indexa TEXT com prefixo; colunas indexadas viram VARCHAR
+    if dialect == 'mysql' and indexed:
+        return MYSQL_KEY_COLUMN_TYPES.get(name, 'VARCHAR(255)')
+    return 'TEXT'
+
+
+def _index_column(column, dialect):
+    if dialect == 'postgresql' and column in PREFIX_SEARCH_COLUMNS:
+        return f"{column} text_pattern_ops"
+    return column
+
+
+def _numeric_or_none(value):
+    # SQLite aceita texto em colunas INTEGER/REAL; no servidor vira NULL
+    return value if value is None or isinstance(value, (int, float)) else None
+
+
+def _copy_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def _copy_line(row):
+    # COPY em CSV: campo vazio sem aspas é NULL; strings sempre entre aspas
+    return ','.join(_copy_value(value) for value in row) + '\n'
+
+
+def _copy_rows(source, conn, dialect, table, target, columns, numeric):
+    column_list = ', '.join(columns)
+    cursor = source.execute(f"SELECT {column_list} FROM {table}")
+    raw_cursor = conn.cursor()
+    positions = [i for i, column in enumerate(columns) if column in numeric]
+    while True:
+        rows = cursor.fetchmany(LOAD_BATCH_SIZE)
+        if not rows:
+            break
+        if positions:
+            rows = [list(row) for row in rows]
+            for row in rows:
+                for i in positions:
+                    row[i] = _numeric_or_none(row[i])
+        if dialect == 'postgresql':
+            buffer = io.StringIO(''.join(_copy_line(row) for row in rows))
+            raw_cursor.copy_expert(f"COPY {target} ({column_list}) FROM STDIN WITH (FORMAT csv)", buffer)
+        else:
+            # PyMySQL agrupa o executemany de INSERT ... VALUES em INSERTs de várias linhas
+            placeholders = ', '.join('%s' for _ in columns)
+            raw_cursor.executemany(f"INSERT INTO {target} ({column_list}) VALUES ({placeholders})", rows)
+    raw_cursor.close()
+
+
+def load_into_server(db_path, backend):
+    """Copia as tabelas da base SQLite preparada para o servidor e troca as versões de uma vez
+
+    As tabelas novas são carregadas com sufixo e renomeadas juntas no fim, então
+    as consultas em andamento continuam vendo a versão anterior até a troca.
+    Retorna o número de linhas copiadas por tabela.
+    """
+    dialect = backend.dialect
+    suffix = time.strftime('%Y%m%d%H%M%S')
+    source = sqlite3.connect(db_path)
+    raw = backend.engine.raw_connection()
+    tables = _sqlite_tables(source)
+    try:
+        cursor = raw.cursor()
+        counts = {}
+
+        for table in tables:
+            info = source.execute(f"PRAGMA table_info({table})").fetchall()
+            indexes = _sqlite_indexes(source, table)
+            indexed = {column for _, columns in indexes for column in columns}
+            columns = [row[1] for row in info]
+            numeric = {row[1] for row in info if _column_type(row[2], dialect, False) != 'TEXT'}
+            definition = ', '.join(
+                f"{row[1]} {_column_type(row[2], dialect, row[1] in indexed, row[1])}" for row in info
+            )
+
+            target = f"{table}__{suffix}"
+            cursor.execute(f"CREATE TABLE {target} ({definition})")
+            _copy_rows(source, raw, dialect, table, target, columns, numeric)
+            for name, index_columns in indexes:
+                cursor.execute(f"CREATE INDEX {name}__{suffix} ON {target} "
+                               f"({', '.join(_index_column(column, dialect) for column in index_columns)})")
+            if table == 'lead_prepare_steps':
+                steps = ', '.join(f"'{step}'" for step in SQLITE_ONLY_STEPS)
+                cursor.execute(f"DELETE FROM {target} WHERE step IN ({steps})")
+            counts[table] = source.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            raw.commit()
+
+        # Troca: as tabelas atuais saem e as novas assumem os nomes
+        existing = {name for name in sqlalchemy.inspect(backend.engine).get_table_names()}
+        if dialect == 'mysql':
+            renames = []
+            for table in tables:
+                if table in existing:
+                    renames.append(f"{table} TO {table}__old_{suffix}")
+                renames.append(f"{table}__{suffix} TO {table}")
+            cursor.execute(f"RENAME TABLE {', '.join(renames)}")
+        else:
+            for table in tables:
+                if table in existing:
+                    cursor.execute(f"ALTER TABLE {table} RENAME TO {table}__old_{suffix}")
+                cursor.execute(f"ALTER TABLE {table}__{suffix} RENAME TO {table}")
+        raw.commit()
+
+        for table in tables:
+            if table in existing:
+                cursor.execute(f"DROP TABLE {table}__old_{suffix}")
+            cursor.execute(f"ANALYZE {'TABLE ' if dialect == 'mysql' else ''}{table}")
+            if dialect == 'mysql':
+                cursor.fetchall()
+        raw.commit()
+        cursor.close()
+        return counts
+    except Exception:
+        raw.rollback()
+        # Remove o que já foi carregado desta versão
+        cursor = raw.cursor()
+        for table in tables:
+            cursor.execute(f"DROP TABLE IF EXISTS {table}__{suffix}")
+        raw.commit()
+        raise
+    finally:
+        raw.close()
+        source.close()
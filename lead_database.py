@@ -0,0 +1,438 @@
+"""
+Preparação da base de empresas na ativação: colunas derivadas e índices
+
+Cada etapa é aplicada uma única vez por arquivo e registrada na tabela
+lead_prepare_steps; o montador de consultas só usa as estruturas cujas
+etapas já foram aplicadas.
+"""
+import random
+import re
+import sqlite3
+from collections import Counter
+from datetime import datetime
+
+import lead_backend
+
+_NON_DIGITS = re.compile(r'\D')
+
+# Linhas lidas por vez ao popular tabelas auxiliares
+PREPARE_BATCH_SIZE = 10000
+
+
+class StepUnavailable(Exception):
+    """A etapa não pode ser aplicada nesta instalação do SQLite (ex.: sem FTS5)"""
+
+
+def _table_columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _add_column(conn, table, column, column_type):
+    if column not in _table_columns(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+
+def _prepare_cnpj_completo(conn):
+    """CNPJ de 14 dígitos materializado e indexado (busca pontual/prefixo)"""
+    _add_column(conn, 'estabelecimento', 'cnpj_completo', 'TEXT')
+    conn.execute("UPDATE estabelecimento SET cnpj_completo = cnpj_basico || cnpj_ordem || cnpj_dv")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_estabelecimento_cnpj_completo ON estabelecimento (cnpj_completo)")
+
+
+# Cópias tipadas de colunas TEXT:
+# (tabela, coluna, coluna tipada, tipo SQL, expressão de conversão)
+TYPED_COLUMNS = [
+    ('estabelecimento', 'data_inicio_atividade', 'data_inicio_atividade_int', 'INTEGER',
+     "NULLIF(CAST(NULLIF(TRIM({}), '') AS INTEGER), 0)"),
+    ('estabelecimento', 'data_situacao_cadastral', 'data_situacao_cadastral_int', 'INTEGER',
+     "NULLIF(CAST(NULLIF(TRIM({}), '') AS INTEGER), 0)"),
+    ('simples', 'data_opcao_simples', 'data_opcao_simples_int', 'INTEGER',
+     "NULLIF(CAST(NULLIF(TRIM({}), '') AS INTEGER), 0)"),
+    ('empresas', 'capital_social', 'capital_social_num', 'REAL',
+     "CAST(REPLACE(NULLIF(TRIM({}), ''), ',', '.') AS REAL)"),
+]
+
+
+def _prepare_typed_columns(conn):
+    """Datas YYYYMMDD como inteiro e capital social numérico, indexados para faixas"""
+    for table, column, typed_column, sql_type, conversion in TYPED_COLUMNS:
+        _add_column(conn, table, typed_column, sql_type)
+        conn.execute(f"UPDATE {table} SET {typed_column} = {conversion.format(column)}")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{typed_column} ON {table} ({typed_column})")
+
+
+def normalize_cnae(code):
+    """CNAE só com dígitos ('4711-3/02' -> '4711302')"""
+    return _NON_DIGITS.sub('', code or '')
+
+
+def _cnae_rows(rows):
+    for cnpj_basico, cnpj_ordem, cnpj_dv, principal, secundarias in rows:
+        codes = {normalize_cnae(principal)}
+        codes.update(normalize_cnae(code) for code in (secundarias or '').split(','))
+        codes.discard('')
+        for code in codes:
+            yield code, cnpj_basico, cnpj_ordem, cnpj_dv
+
+
+def _prepare_cnae_index(conn):
+    """Índice invertido CNAE (principal e secundários) -> estabelecimento"""
+    conn.execute("DROP TABLE IF EXISTS estabelecimento_cnae")
+    conn.execute("""
+        CREATE TABLE estabelecimento_cnae (
+            cnae TEXT,
+            cnpj_basico TEXT,
+            cnpj_ordem TEXT,
+            cnpj_dv TEXT
+        )
+    """)
+
+    cursor = conn.execute("""
+        SELECT cnpj_basico, cnpj_ordem, cnpj_dv, cnae_fiscal_principal, cnae_fiscal_secundaria
+        FROM estabelecimento
+    """)
+    while True:
+        rows = cursor.fetchmany(PREPARE_BATCH_SIZE)
+        if not rows:
+            break
+        conn.executemany("INSERT INTO estabelecimento_cnae VALUES (?, ?, ?, ?)", _cnae_rows(rows))
+
+    # Índice de cobertura: a busca por CNAE já devolve a chave do estabelecimento
+    conn.execute("""
+        CREATE INDEX idx_estabelecimento_cnae
+        ON estabelecimento_cnae (cnae, cnpj_basico, cnpj_ordem, cnpj_dv)
+    """)
+
+
+def _prepare_socios_index(conn):
+    """Índices de sócios por empresa, documento e qualificação"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_socios_cnpj_basico ON socios (cnpj_basico)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_socios_cnpj_cpf_socio ON socios (cnpj_cpf_socio)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_socios_qualificacao ON socios (qualificacao_socio, cnpj_basico)")
+
+
+def _prepare_socios_fts(conn):
+    """Índice full-text (FTS5) do nome do sócio, com os campos usados nos filtros"""
+    conn.execute("DROP TABLE IF EXISTS socios_fts")
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE socios_fts USING fts5(
+                nome_socio,
+                cnpj_basico UNINDEXED,
+                cnpj_cpf_socio UNINDEXED,
+                qualificacao_socio UNINDEXED
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        raise StepUnavailable(str(e))
+
+    conn.execute("""
+        INSERT INTO socios_fts (nome_socio, cnpj_basico, cnpj_cpf_socio, qualificacao_socio)
+        SELECT nome_socio, cnpj_basico, cnpj_cpf_socio, qualificacao_socio FROM socios
+    """)
+
+
+# Código do Brasil nos telefones em E.164
+PHONE_COUNTRY_CODE = '55'
+
+_EMAIL_PATTERN = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+
+def normalize_phone(ddd, numero):
+    """(telefone E.164, é celular) ou (None, False) se o telefone não é válido
+
+    DDD e número vêm separados na base da Receita; número com DDD na frente
+    também é aceito. Celulares de 8 dígitos (6 a 9 na frente) ganham o nono dígito.
+    """
+    ddd = _NON_DIGITS.sub('', ddd or '').lstrip('0')
+    numero = _NON_DIGITS.sub('', numero or '').lstrip('0')
+    if not ddd and len(numero) in (10, 11):
+        ddd, numero = numero[:2], numero[2:]
+    if len(ddd) != 2 or '0' in ddd:
+        return None, False
+    if len(numero) == 9 and numero[0] == '9':
+        mobile = True
+    elif len(numero) == 8 and numero[0] in '2345':
+        mobile = False
+    elif len(numero) == 8 and numero[0] in '6789':
+        numero, mobile = '9' + numero, True
+    else:
+        return None, False
+    return f"+{PHONE_COUNTRY_CODE}{ddd}{numero}", mobile
+
+
+def normalize_email(email):
+    """Email sem espaços e em minúsculas, ou None se não parece um endereço"""
+    email = (email or '').strip().lower()
+    return email if _EMAIL_PATTERN.match(email) else None
+
+
+# Colunas de contato derivadas em estabelecimento: (coluna, tipo SQL)
+CONTACT_COLUMNS = [
+    ('telefone_1_e164', 'TEXT'),
+    ('telefone_2_e164', 'TEXT'),
+    ('email_normalizado', 'TEXT'),
+    ('has_phone', 'INTEGER'),
+    ('has_email', 'INTEGER'),
+    ('has_mobile', 'INTEGER'),
+]
+
+# Flags de contato indexadas, usadas como filtro
+CONTACT_FLAGS = ['has_phone', 'has_email', 'has_mobile']
+
+
+def _contact_rows(rows):
+    for rowid, ddd_1, telefone_1, ddd_2, telefone_2, email in rows:
+        phone_1, mobile_1 = normalize_phone(ddd_1, telefone_1)
+        phone_2, mobile_2 = normalize_phone(ddd_2, telefone_2)
+        email = normalize_email(email)
+        yield (phone_1, phone_2, email, int(bool(phone_1 or phone_2)), int(email is not None),
+               int(mobile_1 or mobile_2), rowid)
+
+
+def _update_contact_columns(conn, where=''):
+    cursor = conn.execute(f"""
+        SELECT rowid, ddd_1, telefone_1, ddd_2, telefone_2, correio_eletronico
+        FROM estabelecimento {where}
+    """)
+    assignments = ', '.join(f"{column} = ?" for column, _ in CONTACT_COLUMNS)
+    while True:
+        rows = cursor.fetchmany(PREPARE_BATCH_SIZE)
+        if not rows:
+            break
+        conn.executemany(f"UPDATE estabelecimento SET {assignments} WHERE rowid = ?", list(_contact_rows(rows)))
+
+
+def _prepare_contact_columns(conn):
+    """Telefones em E.164, email em minúsculas e flags de contato indexadas"""
+    for column, column_type in CONTACT_COLUMNS:
+        _add_column(conn, 'estabelecimento', column, column_type)
+    _update_contact_columns(conn)
+    for flag in CONTACT_FLAGS:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_estabelecimento_{flag} ON estabelecimento ({flag})")
+
+
+# Domínio do email normalizado (depois do '@')
+_EMAIL_DOMAIN_SQL = "SUBSTR(email_normalizado, INSTR(email_normalizado, '@') + 1)"
+
+
+def _prepare_contact_lookup(conn):
+    """Domínio do email e índices de telefone/domínio para a busca reversa"""
+    _add_column(conn, 'estabelecimento', 'email_dominio', 'TEXT')
+    conn.execute(f"UPDATE estabelecimento SET email_dominio = {_EMAIL_DOMAIN_SQL} WHERE email_normalizado IS NOT NULL")
+    for column in ('telefone_1_e164', 'telefone_2_e164', 'email_dominio'):
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_estabelecimento_{column} ON estabelecimento ({column})")
+
+
+# Colunas com histograma de valores: contagem exata de filtros sobre uma só coluna
+HISTOGRAM_COLUMNS = [
+    ('estabelecimento', 'est', 'uf'),
+    ('estabelecimento', 'est', 'situacao_cadastral'),
+    ('estabelecimento', 'est', 'municipio'),
+    ('estabelecimento', 'est', 'cnae_fiscal_principal'),
+    ('estabelecimento', 'est', 'identificador_matriz_filial'),
+    ('empresas', 'e', 'porte_empresa'),
+    ('empresas', 'e', 'natureza_juridica'),
+    ('simples', 's', 'opcao_simples'),
+    ('simples', 's', 'opcao_mei'),
+    ('estabelecimento', 'est', 'has_phone'),
+    ('estabelecimento', 'est', 'has_email'),
+    ('estabelecimento', 'est', 'has_mobile'),
+]
+
+# Linhas da amostra uniforme usada nas contagens aproximadas
+COUNT_SAMPLE_SIZE = 20000
+
+
+def _build_count_estimates(conn):
+    """Histogramas por valor e amostra uniforme (reservoir) da junção, numa só varredura
+
+    A linha ('*', '', total) de lead_histogram guarda o número de
+    estabelecimentos, base das estimativas. empresas e simples entram por
+    LEFT JOIN: as consultas só juntam empresas quando a usam, então um
+    estabelecimento sem empresa também conta.
+    """
+    columns = [
+        f"{alias}.{column}" for table, alias, column in HISTOGRAM_COLUMNS
+        if column in _table_columns(conn, table)
+    ]
+    conn.execute("CREATE TABLE IF NOT EXISTS lead_histogram (column_name TEXT, value TEXT, count INTEGER)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_lead_histogram ON lead_histogram (column_name, value)")
+    conn.execute("DELETE FROM lead_histogram")
+    # posicao embaralhada: ler a amostra nessa ordem dá linhas em ordem aleatória
+    conn.execute("DROP TABLE IF EXISTS lead_sample")
+    conn.execute("""
+        CREATE TABLE lead_sample (
+            posicao INTEGER PRIMARY KEY,
+            cnpj_basico TEXT,
+            cnpj_ordem TEXT,
+            cnpj_dv TEXT
+        )
+    """)
+
+    counters = [Counter() for _ in columns]
+    sample = []
+    rng = random.Random()
+    total = 0
+    cursor = conn.execute(f"""
+        SELECT est.cnpj_basico, est.cnpj_ordem, est.cnpj_dv{''.join(', ' + column for column in columns)}
+        FROM estabelecimento est
+        LEFT JOIN empresas e ON e.cnpj_basico = est.cnpj_basico
+        LEFT JOIN simples s ON s.cnpj_basico = est.cnpj_basico
+    """)
+    while True:
+        rows = cursor.fetchmany(PREPARE_BATCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            for counter, value in zip(counters, row[3:]):
+                counter[value] += 1
+            # Algoritmo R: cada linha fica na amostra com probabilidade COUNT_SAMPLE_SIZE/total
+            if total < COUNT_SAMPLE_SIZE:
+                sample.append(row[:3])
+            else:
+                slot = rng.randrange(total + 1)
+                if slot < COUNT_SAMPLE_SIZE:
+                    sample[slot] = row[:3]
+            total += 1
+
+    conn.execute("INSERT INTO lead_histogram VALUES ('*', '', ?)", (total,))
+    for column, counter in zip(columns, counters):
+        conn.executemany("INSERT INTO lead_histogram VALUES (?, ?, ?)",
+                         ((column, value, count) for value, count in counter.items() if value is not None))
+    rng.shuffle(sample)
+    conn.executemany("INSERT INTO lead_sample VALUES (?, ?, ?, ?)",
+                     ((i,) + tuple(key) for i, key in enumerate(sample)))
+
+
+# Etapas na ordem de aplicação: (nome, função)
+PREPARE_STEPS = [
+    ('cnpj_completo', _prepare_cnpj_completo),
+    ('typed_columns', _prepare_typed_columns),
+    ('cnae_index', _prepare_cnae_index),
+    ('socios_index', _prepare_socios_index),
+    ('socios_fts', _prepare_socios_fts),
+    ('contact_columns', _prepare_contact_columns),
+    ('contact_lookup', _prepare_contact_lookup),
+    ('count_estimates', _build_count_estimates),
+]
+
+
+# Atualização incremental: cada etapa recalcula só as linhas registradas em
+# lead_changes pela última atualização (ver lead_update.apply_update); os
+# índices comuns são mantidos pelo próprio SQLite.
+
+def _refresh_cnpj_completo(conn):
+    conn.execute("""
+        UPDATE estabelecimento SET cnpj_completo = cnpj_basico || cnpj_ordem || cnpj_dv
+        WHERE rowid IN (SELECT row_id FROM lead_changes WHERE table_name = 'estabelecimento' AND change != 'D')
+    """)
+
+
+def _refresh_typed_columns(conn):
+    for table, column, typed_column, sql_type, conversion in TYPED_COLUMNS:
+        conn.execute(f"""
+            UPDATE {table} SET {typed_column} = {conversion.format(column)}
+            WHERE rowid IN (SELECT row_id FROM lead_changes WHERE table_name = '{table}' AND change != 'D')
+        """)
+
+
+def _refresh_cnae_index(conn):
+    conn.execute("""
+        DELETE FROM estabelecimento_cnae
+        WHERE (cnpj_basico, cnpj_ordem, cnpj_dv) IN (
+            SELECT cnpj_basico, cnpj_ordem, cnpj_dv FROM lead_changes
+            WHERE table_name = 'estabelecimento'
+        )
+    """)
+    cursor = conn.execute("""
+        SELECT cnpj_basico, cnpj_ordem, cnpj_dv, cnae_fiscal_principal, cnae_fiscal_secundaria
+        FROM estabelecimento
+        WHERE rowid IN (SELECT row_id FROM lead_changes WHERE table_name = 'estabelecimento' AND change != 'D')
+    """)
+    while True:
+        rows = cursor.fetchmany(PREPARE_BATCH_SIZE)
+        if not rows:
+            break
+        conn.executemany("INSERT INTO estabelecimento_cnae VALUES (?, ?, ?, ?)", _cnae_rows(rows))
+
+
+def _refresh_contact_columns(conn):
+    _update_contact_columns(conn, """
+        WHERE rowid IN (SELECT row_id FROM lead_changes WHERE table_name = 'estabelecimento' AND change != 'D')
+    """)
+
+
+def _refresh_contact_lookup(conn):
+    conn.execute(f"""
+        UPDATE estabelecimento SET email_dominio = {_EMAIL_DOMAIN_SQL}
+        WHERE rowid IN (SELECT row_id FROM lead_changes WHERE table_name = 'estabelecimento' AND change != 'D')
+    """)
+
+
+def _refresh_socios_fts(conn):
+    conn.execute("""
+        DELETE FROM socios_fts
+        WHERE cnpj_basico IN (SELECT cnpj_basico FROM lead_changes WHERE table_name = 'socios')
+    """)
+    conn.execute("""
+        INSERT INTO socios_fts (nome_socio, cnpj_basico, cnpj_cpf_socio, qualificacao_socio)
+        SELECT nome_socio, cnpj_basico, cnpj_cpf_socio, qualificacao_socio FROM socios
+        WHERE rowid IN (SELECT row_id FROM lead_changes WHERE table_name = 'socios' AND change != 'D')
+    """)
+
+
+# Etapa -> função incremental; etapas ausentes só dependem de índices comuns.
+# Histogramas e amostra não têm versão incremental: são refeitos por inteiro.
+REFRESH_STEPS = {
+    'cnpj_completo': _refresh_cnpj_completo,
+    'typed_columns': _refresh_typed_columns,
+    'cnae_index': _refresh_cnae_index,
+    'socios_fts': _refresh_socios_fts,
+    'contact_columns': _refresh_contact_columns,
+    'contact_lookup': _refresh_contact_lookup,
+    'count_estimates': _build_count_estimates,
+}
+
+
+def prepared_steps(conn):
+    """Etapas já aplicadas na base aberta em conn"""
+    try:
+        return {row[0] for row in conn.execute("SELECT step FROM lead_prepare_steps")}
+    except conn.Error:
+        # Base sem a tabela de controle (não preparada), em qualquer backend
+        lead_backend.recover_after_error(conn)
+        return set()
+
+
+def prepare_database(db_path):
+    """Aplica as etapas pendentes e retorna os nomes das que foram aplicadas"""
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS lead_prepare_steps (
+                step TEXT PRIMARY KEY,
+                applied_at TEXT
+            )
+        """)
+        done = prepared_steps(conn)
+        applied = []
+
+        for name, step in PREPARE_STEPS:
+            if name in done:
+                continue
+            try:
+                with conn:
+                    step(conn)
+                    conn.execute("INSERT INTO lead_prepare_steps (step, applied_at) VALUES (?, ?)",
+                                 (name, datetime.utcnow().isoformat()))
+            except StepUnavailable as e:
+                print(f"Etapa {name} ignorada: {e}")
+                continue
+            applied.append(name)
+
+        if applied:
+            conn.execute("ANALYZE")
+        return applied
+    finally:
+        conn.close()
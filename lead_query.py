@@ -0,0 +1,447 @@
+"""
+Montagem das consultas na base de empresas (empresas, estabelecimento, simples)
+
+Filtros podem ser uma string (comportamento padrão da coluna) ou um dict
+{'op': ..., 'value': ...} com um operador explícito. Datas e capital social
+aceitam faixas: 'gte', 'lte', 'between' ([min, max]) e 'last_days' (N).
+O filtro 'cnae' busca no CNAE principal e nos secundários com 'any' (lista
+de códigos) ou 'prefix' (divisão, grupo ou classe). Os filtros socio_nome,
+socio_documento e socio_qualificacao selecionam empresas com um sócio que
+atende a todos eles. As flags est.has_phone, est.has_email e est.has_mobile
+aceitam verdadeiro ('1', 'true', 'sim') ou falso.
+
+O resultado tem sempre uma linha por estabelecimento (a unidade exportada e
+cobrada), então estabelecimento está em toda consulta; empresas e simples só
+entram no FROM quando usadas pelas colunas ou filtros. simples entra por LEFT
+JOIN (empresas sem registro no Simples não somem), exceto quando é filtrada,
+e a tabela com mais filtros vem primeiro.
+"""
+import re
+from datetime import date, timedelta
+
+from lead_database import CONTACT_FLAGS, TYPED_COLUMNS, normalize_cnae
+
+# Colunas usadas quando o usuário não seleciona nenhuma
+DEFAULT_COLUMNS = ['e.cnpj_basico', 'e.razao_social', 'est.nome_fantasia', 'est.uf', 's.opcao_simples']
+
+# Limite de linhas por consulta para não sobrecarregar
+MAX_RESULTS = 10000
+
+CNPJ_COMPLETO_SQL = "(est.cnpj_basico || est.cnpj_ordem || est.cnpj_dv)"
+
+# Apenas colunas qualificadas pelos aliases das tabelas da consulta
+_COLUMN_PATTERN = re.compile(r'^(e|est|s)\.[a-z_][a-z0-9_]*$')
+
+_NON_DIGITS = re.compile(r'\D')
+
+TABLE_ALIASES = {'empresas': 'e', 'estabelecimento': 'est', 'simples': 's'}
+
+# coluna -> (coluna tipada, conversão da coluna TEXT, tipo SQL)
+_TYPED = {
+    f"{TABLE_ALIASES[table]}.{column}": (f"{TABLE_ALIASES[table]}.{typed_column}", conversion, sql_type)
+    for table, column, typed_column, sql_type, conversion in TYPED_COLUMNS
+}
+
+# Operadores de faixa para colunas de data e valor
+RANGE_OPS = {'gte', 'lte', 'between', 'last_days'}
+
+
+def column_expression(column, features=frozenset()):
+    """Expressão SQL de uma coluna selecionável"""
+    if column == 'cnpj_completo':
+        if 'cnpj_completo' in features:
+            return "est.cnpj_completo as cnpj_completo"
+        return f"{CNPJ_COMPLETO_SQL} as cnpj_completo"
+    if not _COLUMN_PATTERN.match(column):
+        raise ValueError(f'Coluna inválida: {column}')
+    return column
+
+
+def select_clause(selected_columns, features=frozenset()):
+    """Lista de colunas do SELECT"""
+    return ', '.join(column_expression(col, features) for col in (selected_columns or DEFAULT_COLUMNS))
+
+
+def like_operator(dialect='sqlite'):
+    """LIKE sem diferenciar maiúsculas, como o do SQLite (e o do MySQL): ILIKE no PostgreSQL"""
+    return 'ILIKE' if dialect == 'postgresql' else 'LIKE'
+
+
+def _prefix_condition(sql_column, prefix, dialect='sqlite'):
+    """Strings de dígitos que começam com prefix, usando o índice da coluna
+
+    No SQLite (ordem por bytes) é a faixa [prefixo, prefixo + ':'), já que ':'
+    vem logo após '9'; o LIKE dali não usa o índice. No servidor a ordem segue
+    a collation da coluna, então vale o LIKE 'prefixo%' (no PostgreSQL,
+    indexado com text_pattern_ops pelo load_into_server).
+    """
+    if dialect == 'sqlite':
+        return f"{sql_column} >= ? AND {sql_column} < ?", [prefix, prefix + ':']
+    return f"{sql_column} LIKE ?", [prefix + '%']
+
+
+def _digit_condition(sql_column, digits, exact, dialect='sqlite'):
+    """Igualdade para o documento completo; faixa de prefixo para parcial"""
+    if exact:
+        return f"{sql_column} = ?", [digits]
+    return _prefix_condition(sql_column, digits, dialect)
+
+
+def _typed_value(value, sql_type):
+    """Converte o valor do filtro: datas para YYYYMMDD inteiro, capital para float"""
+    if value is None or value == '':
+        return None
+    if sql_type == 'REAL':
+        return float(str(value).replace(',', '.'))
+    digits = _NON_DIGITS.sub('', str(value))
+    if len(digits) != 8:
+        raise ValueError(f'Data inválida: {value}')
+    return int(digits)
+
+
+def _range_condition(column, op, value, features):
+    """Faixa sobre a coluna tipada (indexada) ou, sem preparação, sobre a conversão da TEXT"""
+    typed_column, conversion, sql_type = _TYPED[column]
+    sql_column = typed_column if 'typed_columns' in features else conversion.format(column)
+
+    if op == 'last_days':
+        start = date.today() - timedelta(days=int(value))
+        return f"{sql_column} >= ?", [int(start.strftime('%Y%m%d'))]
+
+    if op == 'between':
+        low, high = (_typed_value(v, sql_type) for v in value)
+    elif op == 'gte':
+        low, high = _typed_value(value, sql_type), None
+    else:
+        low, high = None, _typed_value(value, sql_type)
+
+    conditions, params = [], []
+    if low is not None:
+        conditions.append(f"{sql_column} >= ?")
+        params.append(low)
+    if high is not None:
+        conditions.append(f"{sql_column} <= ?")
+        params.append(high)
+    if not conditions:
+        return None
+    return ' AND '.join(conditions), params
+
+
+# CNAE normalizado (só dígitos) a partir de uma coluna TEXT da base original
+_CNAE_DIGITS_SQL = "REPLACE(REPLACE(REPLACE({}, '-', ''), '/', ''), '.', '')"
+
+
+def _cnae_condition(op, value, features, dialect='sqlite'):
+    """CNAE principal ou secundário: 'any' (lista de códigos) ou 'prefix' (divisão/grupo/classe)"""
+    codes = value if isinstance(value, (list, tuple)) else str(value).split(',')
+    codes = [code for code in (normalize_cnae(str(c)) for c in codes) if code]
+    if not codes:
+        return None
+
+    if 'cnae_index' in features:
+        if op == 'any':
+            match = f"cnae IN ({', '.join('?' for _ in codes)})"
+            params = list(codes)
+        else:
+            prefixes = [_prefix_condition('cnae', code, dialect) for code in codes]
+            match = ' OR '.join(f'({condition})' for condition, _ in prefixes)
+            params = [p for _, code_params in prefixes for p in code_params]
+        # IN com a chave completa: o índice invertido dirige a busca pela chave primária
+        return f"""(est.cnpj_basico, est.cnpj_ordem, est.cnpj_dv) IN (
+            SELECT cnpj_basico, cnpj_ordem, cnpj_dv FROM estabelecimento_cnae WHERE {match})""", params
+
+    # Sem a preparação: varredura sobre a lista separada por vírgulas
+    principal = _CNAE_DIGITS_SQL.format('est.cnae_fiscal_principal')
+    secundarias = "(',' || " + _CNAE_DIGITS_SQL.format('est.cnae_fiscal_secundaria') + ")"
+    like = like_operator(dialect)
+    conditions, params = [], []
+    for code in codes:
+        if op == 'any':
+            conditions.append(f"({principal} = ? OR {secundarias} || ',' {like} ?)")
+            params.extend([code, f"%,{code},%"])
+        else:
+            conditions.append(f"({principal} {like} ? OR {secundarias} {like} ?)")
+            params.extend([f"{code}%", f"%,{code}%"])
+    return '(' + ' OR '.join(conditions) + ')', params
+
+
+# Flags de contato sem a preparação (contact_columns): aproximação sobre as colunas originais
+CONTACT_FILTERS = {f"est.{flag}" for flag in CONTACT_FLAGS}
+
+# Pontuação removida dos telefones no SQL (normalize_phone remove tudo que não é dígito)
+_PHONE_SEPARATORS = (' ', '-', '.', '(', ')', '/', '+')
+
+
+def _digits_sql(column, dialect):
+    """Dígitos da coluna sem zeros à esquerda, nunca NULL"""
+    digits = f"COALESCE({column}, '')"
+    for separator in _PHONE_SEPARATORS:
+        digits = f"REPLACE({digits}, '{separator}', '')"
+    # LTRIM com caracteres não existe no MySQL
+    if dialect == 'mysql':
+        return f"TRIM(LEADING '0' FROM {digits})"
+    return f"LTRIM({digits}, '0')"
+
+
+def _number_sql(number, first_digits):
+    """Número local de 9 dígitos começando com 9 ou de 8 começando com first_digits"""
+    listed = ', '.join(f"'{digit}'" for digit in first_digits)
+    return (f"((LENGTH({number}) = 9 AND SUBSTR({number}, 1, 1) = '9')"
+            f" OR (LENGTH({number}) = 8 AND SUBSTR({number}, 1, 1) IN ({listed})))")
+
+
+def _phone_sql(ddd_column, number_column, first_digits, dialect):
+    """Mesmas regras de normalize_phone: DDD de 2 dígitos sem zero, ou DDD na frente do número"""
+    ddd = _digits_sql(ddd_column, dialect)
+    number = _digits_sql(number_column, dialect)
+    return (f"((LENGTH({ddd}) = 2 AND {ddd} NOT LIKE '%0%' AND {_number_sql(number, first_digits)})"
+            f" OR ({ddd} = '' AND LENGTH({number}) IN (10, 11) AND SUBSTR({number}, 2, 1) != '0'"
+            f" AND {_number_sql(f'SUBSTR({number}, 3)', first_digits)}))")
+
+
+def _contact_fallback(column, dialect='sqlite'):
+    """Flag de contato calculada das colunas originais, igual à da preparação
+
+    As colunas entram com COALESCE, então a expressão nunca é NULL e o NOT
+    dela seleciona exatamente as linhas sem a flag.
+    """
+    if column == 'est.has_email':
+        # Mesmo formato de normalize_email: um '@', domínio com ponto e sem espaços
+        email = "TRIM(COALESCE(est.correio_eletronico, ''))"
+        return f"({email} LIKE '_%@_%._%' AND {email} NOT LIKE '%@%@%' AND {email} NOT LIKE '% %')"
+    # 8 dígitos com 6 a 9 na frente são celulares sem o nono dígito
+    first_digits = '23456789' if column == 'est.has_phone' else '6789'
+    return (f"({_phone_sql('est.ddd_1', 'est.telefone_1', first_digits, dialect)}"
+            f" OR {_phone_sql('est.ddd_2', 'est.telefone_2', first_digits, dialect)})")
+
+
+_TRUE_VALUES = {'1', 'true', 'sim', 's', 'yes'}
+_FALSE_VALUES = {'0', 'false', 'nao', 'não', 'n', 'no'}
+
+
+def flag_value(value):
+    """Valor de um filtro de flag de contato como bool"""
+    if isinstance(value, str):
+        if value.strip().lower() not in _TRUE_VALUES | _FALSE_VALUES:
+            raise ValueError(f'Valor inválido para flag de contato: {value}')
+        return value.strip().lower() in _TRUE_VALUES
+    return bool(value)
+
+
+def _flag_condition(column, value, features, dialect='sqlite'):
+    """Flag de contato indexada (0/1) ou, sem preparação, a expressão sobre as colunas originais"""
+    wanted = flag_value(value)
+    if 'contact_columns' in features:
+        return f"{column} = ?", [int(wanted)]
+    expression = _contact_fallback(column, dialect)
+    return (expression if wanted else f"NOT {expression}"), []
+
+
+# Filtros de sócios; todos se aplicam ao mesmo sócio
+PARTNER_FILTERS = ('socio_nome', 'socio_documento', 'socio_qualificacao')
+
+_WORDS = re.compile(r'\w+')
+
+
+def _filter_value(value):
+    if isinstance(value, dict):
+        value = value.get('value')
+    if isinstance(value, str):
+        value = value.strip()
+    return value or None
+
+
+def _document_values(document):
+    """Documento do sócio como gravado: CNPJ inteiro ou CPF mascarado pela Receita"""
+    digits = _NON_DIGITS.sub('', document)
+    if len(digits) == 11:
+        return [digits, f"***{digits[3:9]}**"]
+    return [digits or document]
+
+
+def compile_partner_filter(partner_filters, features=frozenset(), key_column='e.cnpj_basico', dialect='sqlite'):
+    """Empresas com algum sócio que atende a todos os filtros de sócio informados
+
+    key_column é a coluna cnpj_basico da tabela que conduz a consulta.
+    """
+    nome = _filter_value(partner_filters.get('socio_nome'))
+    documento = _filter_value(partner_filters.get('socio_documento'))
+    qualificacao = _filter_value(partner_filters.get('socio_qualificacao'))
+
+    conditions, params = [], []
+    if documento:
+        values = _document_values(str(documento))
+        conditions.append(f"cnpj_cpf_socio IN ({', '.join('?' for _ in values)})")
+        params.extend(values)
+    if qualificacao:
+        codes = qualificacao if isinstance(qualificacao, (list, tuple)) else str(qualificacao).split(',')
+        codes = [code.strip() for code in codes if code.strip()]
+        conditions.append(f"qualificacao_socio IN ({', '.join('?' for _ in codes)})")
+        params.extend(codes)
+
+    words = _WORDS.findall(nome) if nome else []
+    if words and 'socios_fts' in features:
+        # Cada palavra vira um prefixo no FTS5 (acentos são ignorados pelo tokenizer)
+        match = ' '.join(f'"{word}"*' for word in words)
+        source = "socios_fts"
+        conditions.insert(0, "socios_fts MATCH ?")
+        params.insert(0, match)
+    else:
+        source = "socios"
+        if nome:
+            conditions.insert(0, f"nome_socio {like_operator(dialect)} ?")
+            params.insert(0, f"%{nome}%")
+
+    if not conditions:
+        return None
+    return f"{key_column} IN (SELECT cnpj_basico FROM {source} WHERE {' AND '.join(conditions)})", params
+
+
+def compile_filter(column, value, features=frozenset(), dialect='sqlite'):
+    """Converte um filtro em (condição SQL, parâmetros) ou None se estiver vazio
+
+    dialect é o da conexão que vai executar a consulta (ver lead_backend).
+    """
+    if isinstance(value, dict):
+        op = value.get('op', 'contains')
+        value = value.get('value')
+    else:
+        op = None
+
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    value = value.strip() if isinstance(value, str) else value
+
+    if column == 'cnae':
+        if op not in ('any', 'prefix'):
+            raise ValueError(f'Operador de filtro inválido para CNAE: {op}')
+        return _cnae_condition(op, value, features, dialect)
+
+    if column in CONTACT_FILTERS:
+        if op not in (None, 'exact'):
+            raise ValueError(f'Operador de filtro inválido para {column}: {op}')
+        return _flag_condition(column, value, features, dialect)
+
+    if op in RANGE_OPS:
+        if column not in _TYPED:
+            raise ValueError(f'Filtro de faixa não suportado para {column}')
+        return _range_condition(column, op, value, features)
+
+    if column == 'cnpj_completo':
+        digits = _NON_DIGITS.sub('', str(value))
+        # Sem operador vale o "contém" de sempre; só o CNPJ inteiro vira igualdade
+        indexed = op in ('exact', 'prefix') or (op is None and len(digits) == 14)
+        if 'cnpj_completo' in features and indexed and 0 < len(digits) <= 14:
+            return _digit_condition('est.cnpj_completo', digits, op != 'prefix', dialect)
+        sql_column = 'est.cnpj_completo' if 'cnpj_completo' in features else CNPJ_COMPLETO_SQL
+        # A coluna só tem dígitos: pontuação do valor digitado não pode impedir o casamento
+        value = digits or value
+    elif column == 'e.cnpj_basico':
+        digits = _NON_DIGITS.sub('', str(value))
+        if op in ('exact', 'prefix') and 0 < len(digits) <= 8:
+            return _digit_condition('e.cnpj_basico', digits, op == 'exact', dialect)
+        sql_column = column
+    else:
+        sql_column = column_expression(column, features)
+
+    if op in (None, 'contains'):
+        return f"{sql_column} {like_operator(dialect)} ?", [f"%{value}%"]
+    if op == 'exact':
+        return f"{sql_column} = ?", [value]
+    if op == 'prefix':
+        return f"{sql_column} {like_operator(dialect)} ?", [f"{value}%"]
+
+    raise ValueError(f'Operador de filtro inválido: {op}')
+
+
+_ALIAS_TABLES = {alias: table for table, alias in TABLE_ALIASES.items()}
+
+# Referência a uma coluna de e, est ou s no SQL gerado
+_ALIAS_REFERENCE = re.compile(r'\b(e|est|s)\.[a-z_]')
+
+# Desempate do laço externo entre tabelas com o mesmo número de filtros
+_DRIVER_PREFERENCE = ('est', 'e', 's')
+
+
+def _referenced_aliases(sql):
+    return set(_ALIAS_REFERENCE.findall(sql))
+
+
+def _plan(filters, selected_columns, features, extra_conditions, from_sample, dialect):
+    """SELECT, condições dos filtros e tabelas (aliases) na ordem do FROM"""
+    select_sql = select_clause(selected_columns, features)
+    conditions = [
+        compile_filter(column, value, features, dialect)
+        for column, value in filters.items()
+        if column not in PARTNER_FILTERS
+    ]
+    conditions = [condition for condition in conditions if condition] + list(extra_conditions)
+
+    filtered = {}
+    for condition, _ in conditions:
+        for alias in _referenced_aliases(condition):
+            filtered[alias] = filtered.get(alias, 0) + 1
+
+    # Uma linha por estabelecimento, mesmo com colunas e filtros só de empresas
+    tables = _referenced_aliases(select_sql) | set(filtered) | {'est'}
+    # A amostra é de estabelecimentos: nela est conduz a junção
+    order = sorted(tables, key=lambda alias: (
+        not (from_sample and alias == 'est'), -filtered.get(alias, 0), _DRIVER_PREFERENCE.index(alias)))
+    return select_sql, conditions, order, filtered
+
+
+# Junção a partir da amostra uniforme (lead_sample): o CROSS JOIN fixa a
+# amostra como laço externo e cada linha vira uma busca na chave primária;
+# a amostra é lida na ordem embaralhada de posicao
+_SAMPLE_KEY = "est.cnpj_basico = ls.cnpj_basico AND est.cnpj_ordem = ls.cnpj_ordem AND est.cnpj_dv = ls.cnpj_dv"
+
+
+def build_query(filters, selected_columns, limit=MAX_RESULTS, features=frozenset(), extra_conditions=(),
+                from_sample=False, dialect='sqlite'):
+    """Monta a query SQL com JOINs e os parâmetros dos filtros
+
+    features são as etapas de preparação já aplicadas na base
+    (ver lead_database.prepared_steps); extra_conditions são pares
+    (condição SQL, parâmetros) somados aos filtros. limit=-1 não limita.
+    from_sample restringe a consulta às linhas da amostra de lead_sample.
+    dialect é o da conexão que vai executar a consulta ('sqlite', 'postgresql'
+    ou 'mysql'); os placeholders continuam '?'.
+    """
+    select_sql, conditions, order, filtered = _plan(
+        filters, selected_columns, features, extra_conditions, from_sample, dialect)
+    driver = order[0]
+
+    if from_sample:
+        joins = ["FROM lead_sample ls", "CROSS JOIN estabelecimento est"]
+    else:
+        joins = [f"FROM {_ALIAS_TABLES[driver]} {driver}"]
+    for alias in order[1:]:
+        # Sem filtro em simples, a falta do registro não pode eliminar a linha
+        join = 'LEFT JOIN' if alias == 's' and not filtered.get('s') else 'JOIN'
+        joins.append(f"{join} {_ALIAS_TABLES[alias]} {alias} ON {alias}.cnpj_basico = {driver}.cnpj_basico")
+
+    query = f"""
+    SELECT {select_sql}
+    {chr(10).join('    ' + join for join in joins).strip()}
+    WHERE {_SAMPLE_KEY if from_sample else '1=1'}
+    """
+
+    params = []
+
+    # Adicionar filtros
+    conditions.append(compile_partner_filter(
+        {column: value for column, value in filters.items() if column in PARTNER_FILTERS}, features,
+        key_column=f"{driver}.cnpj_basico", dialect=dialect))
+
+    for condition in conditions:
+        if condition:
+            query += f" AND {condition[0]}"
+            params.extend(condition[1])
+
+    if from_sample:
+        query += " ORDER BY ls.posicao"
+
+    # Limitar resultados para não sobrecarregar
+    query += f" LIMIT {int(limit)}"
+
+    return query, params
@@ -0,0 +1,205 @@
+"""
+Atualização incremental da base de empresas
+
+Em vez de substituir o arquivo inteiro, a nova importação é comparada com a
+versão ativa pela chave do CNPJ e só as diferenças (inclusões, alterações e
+exclusões) são aplicadas sobre uma cópia. As linhas alteradas ficam
+registradas em lead_changes, e as colunas derivadas, tabelas auxiliares e
+estatísticas são atualizadas só para elas.
+"""
+import sqlite3
+
+from lead_database import REFRESH_STEPS, prepared_steps
+
+# Tabelas com chave de CNPJ: (tabela, colunas da chave)
+KEYED_TABLES = [
+    ('empresas', ('cnpj_basico',)),
+    ('estabelecimento', ('cnpj_basico', 'cnpj_ordem', 'cnpj_dv')),
+    ('simples', ('cnpj_basico',)),
+]
+
+# Sócios não têm chave própria: o grupo de uma empresa é regravado inteiro
+GROUPED_TABLES = [('socios', 'cnpj_basico')]
+
+# Tabelas de referência pequenas, substituídas quando mudam
+REFERENCE_TABLES = ['cnae', 'municipio', 'natureza_juridica', 'qualificacao_socio', 'pais', 'motivo']
+
+# Fração de linhas alteradas a partir da qual as estatísticas da tabela são refeitas
+ANALYZE_THRESHOLD = 0.1
+
+_KEY_COLUMNS = ('cnpj_basico', 'cnpj_ordem', 'cnpj_dv')
+
+
+def _columns(conn, schema, table):
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def _source_columns(conn, table):
+    """Colunas da importação, que precisam existir na versão ativa"""
+    columns = _columns(conn, 'src', table)
+    if not columns:
+        raise ValueError(f'Tabela {table} não encontrada na importação')
+    missing = set(columns) - set(_columns(conn, 'main', table))
+    if missing:
+        raise ValueError(f"Colunas da importação ausentes na base ativa ({table}): {', '.join(sorted(missing))}")
+    return ', '.join(columns)
+
+
+def _record(conn, table, change, key, where, schema='main'):
+    """Registra em lead_changes as linhas de schema.table que atendem a where"""
+    key_values = ', '.join(key + ('NULL',) * (len(_KEY_COLUMNS) - len(key)))
+    conn.execute(f"""
+        INSERT INTO lead_changes (table_name, change, row_id, cnpj_basico, cnpj_ordem, cnpj_dv)
+        SELECT '{table}', '{change}', rowid, {key_values} FROM {schema}.{table} WHERE {where}
+    """)
+
+
+def _update_keyed_table(conn, table, key):
+    """Diferença pela chave: regrava linhas novas ou alteradas e remove as ausentes"""
+    columns = _source_columns(conn, table)
+    key_list = ', '.join(key)
+    conn.execute("DROP TABLE IF EXISTS temp.update_keys")
+    conn.execute(f"CREATE TEMP TABLE update_keys AS SELECT {key_list}, '' AS change FROM src.{table} WHERE 0")
+
+    # Linhas da importação sem cópia idêntica na versão ativa: novas ou alteradas
+    conn.execute(f"""
+        INSERT INTO temp.update_keys
+        SELECT {key_list}, 'U' FROM (
+            SELECT {columns} FROM src.{table}
+            EXCEPT
+            SELECT {columns} FROM main.{table}
+        )
+    """)
+    conn.execute(f"CREATE INDEX temp.idx_update_keys ON update_keys ({key_list})")
+    conn.execute(f"""
+        UPDATE temp.update_keys SET change = 'I'
+        WHERE ({key_list}) NOT IN (SELECT {key_list} FROM main.{table})
+    """)
+    # Chaves da versão ativa que não vieram na importação
+    conn.execute(f"""
+        INSERT INTO temp.update_keys
+        SELECT {key_list}, 'D' FROM (
+            SELECT {key_list} FROM main.{table}
+            EXCEPT
+            SELECT {key_list} FROM src.{table}
+        )
+    """)
+
+    changed = f"({key_list}) IN (SELECT {key_list} FROM temp.update_keys WHERE change = '{{}}')"
+    _record(conn, table, 'D', key, changed.format('D'))
+    conn.execute(f"DELETE FROM main.{table} WHERE ({key_list}) IN (SELECT {key_list} FROM temp.update_keys)")
+    conn.execute(f"""
+        INSERT INTO main.{table} ({columns})
+        SELECT {columns} FROM src.{table}
+        WHERE ({key_list}) IN (SELECT {key_list} FROM temp.update_keys WHERE change != 'D')
+    """)
+    _record(conn, table, 'I', key, changed.format('I'))
+    _record(conn, table, 'U', key, changed.format('U'))
+
+    counts = dict(conn.execute("SELECT change, COUNT(*) FROM temp.update_keys GROUP BY change").fetchall())
+    conn.execute("DROP TABLE temp.update_keys")
+    return {'inserted': counts.get('I', 0), 'updated': counts.get('U', 0), 'deleted': counts.get('D', 0)}
+
+
+def _update_grouped_table(conn, table, group_column):
+    """Regrava o grupo (ex.: sócios de uma empresa) quando alguma linha dele mudou"""
+    columns = _source_columns(conn, table)
+    conn.execute("DROP TABLE IF EXISTS temp.update_groups")
+    conn.execute(f"""
+        CREATE TEMP TABLE update_groups AS
+        SELECT DISTINCT {group_column} FROM (
+            SELECT * FROM (SELECT {columns} FROM src.{table} EXCEPT SELECT {columns} FROM main.{table})
+            UNION ALL
+            SELECT * FROM (SELECT {columns} FROM main.{table} EXCEPT SELECT {columns} FROM src.{table})
+        )
+    """)
+
+    changed = f"{group_column} IN (SELECT {group_column} FROM temp.update_groups)"
+    _record(conn, table, 'D', (group_column,), changed)
+    deleted = conn.execute(f"DELETE FROM main.{table} WHERE {changed}").rowcount
+    inserted = conn.execute(f"INSERT INTO main.{table} ({columns}) SELECT {columns} FROM src.{table} WHERE {changed}").rowcount
+    _record(conn, table, 'I', (group_column,), changed)
+
+    conn.execute("DROP TABLE temp.update_groups")
+    return {'inserted': inserted, 'updated': 0, 'deleted': deleted}
+
+
+def _update_reference_table(conn, table):
+    """Substitui a tabela de referência inteira se ela mudou"""
+    if not _columns(conn, 'src', table):
+        return False
+    columns = _source_columns(conn, table)
+    differs = conn.execute(f"""
+        SELECT 1 FROM (SELECT {columns} FROM src.{table} EXCEPT SELECT {columns} FROM main.{table})
+        UNION ALL
+        SELECT 1 FROM (SELECT {columns} FROM main.{table} EXCEPT SELECT {columns} FROM src.{table})
+        LIMIT 1
+    """).fetchone()
+    if not differs:
+        return False
+    conn.execute(f"DELETE FROM main.{table}")
+    conn.execute(f"INSERT INTO main.{table} ({columns}) SELECT {columns} FROM src.{table}")
+    return True
+
+
+def _analyze_changed_tables(conn, summary):
+    """Refaz as estatísticas só das tabelas com alteração relevante"""
+    for table, counts in summary.items():
+        if not isinstance(counts, dict):
+            continue
+        changed = counts['inserted'] + counts['updated'] + counts['deleted']
+        total = conn.execute(f"SELECT MAX(rowid) FROM main.{table}").fetchone()[0] or 0
+        if changed and changed >= total * ANALYZE_THRESHOLD:
+            conn.execute(f"ANALYZE main.{table}")
+
+
+def apply_update(active_db_path, import_db_path, target_path):
+    """Copia a versão ativa para target_path e aplica a diferença para a importação
+
+    Retorna, por tabela, quantas linhas foram incluídas, alteradas e removidas
+    (tabelas de referência: se foram substituídas).
+    """
+    source = sqlite3.connect(active_db_path)
+    conn = sqlite3.connect(target_path)
+    try:
+        # Cópia por páginas: índices e colunas derivadas vêm prontos
+        source.backup(conn)
+    finally:
+        source.close()
+
+    try:
+        conn.execute("ATTACH DATABASE ? AS src", (import_db_path,))
+        summary = {}
+        with conn:
+            # lead_changes descreve só a diferença para a versão anterior
+            conn.execute("DROP TABLE IF EXISTS lead_changes")
+            conn.execute("""
+                CREATE TABLE lead_changes (
+                    table_name TEXT,
+                    change TEXT,
+                    row_id INTEGER,
+                    cnpj_basico TEXT,
+                    cnpj_ordem TEXT,
+                    cnpj_dv TEXT
+                )
+            """)
+
+            for table, key in KEYED_TABLES:
+                summary[table] = _update_keyed_table(conn, table, key)
+            for table, group_column in GROUPED_TABLES:
+                summary[table] = _update_grouped_table(conn, table, group_column)
+            for table in REFERENCE_TABLES:
+                summary[table] = _update_reference_table(conn, table)
+
+            conn.execute("CREATE INDEX idx_lead_changes ON lead_changes (table_name, change, row_id)")
+
+            done = prepared_steps(conn)
+            for name, refresh in REFRESH_STEPS.items():
+                if name in done:
+                    refresh(conn)
+
+        conn.execute("DETACH DATABASE src")
+        _analyze_changed_tables(conn, summary)
+        return summary
+    finally:
+        conn.close()
@@ -0,0 +1,32 @@
+"""
+Atualização do esquema do banco do sistema sem migrações
+
+Usado pelos dois apps depois do create_all: tabelas já existentes recebem as
+colunas e os índices que foram acrescentados aos modelos.
+"""
+from sqlalchemy import inspect, text
+
+
+def ensure_columns(engine, metadata):
+    """Adiciona colunas novas dos modelos em tabelas já existentes"""
+    inspector = inspect(engine)
+    for table in metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=engine.dialect)
+                with engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+
+def ensure_indexes(engine, metadata):
+    """Cria índices declarados nos modelos que faltam em tabelas já existentes"""
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
+def sync_schema(engine, metadata):
+    """Colunas e depois índices (um índice novo pode usar uma coluna nova)"""
+    ensure_columns(engine, metadata)
+    ensure_indexes(engine, metadata)
@@ -0,0 +1,89 @@
+"""
+Geração de product keys em lote
+
+As keys candidatas são geradas em memória, a unicidade é verificada com uma
+consulta por lote (IN) e a gravação é um INSERT em lote; a restrição UNIQUE
+de key_value cobre gerações simultâneas.
+"""
+import csv
+import io
+import secrets
+import string
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+KEY_CHARACTERS = string.ascii_uppercase + string.digits
+KEY_LENGTH = 16
+
+# Limite de keys por requisição
+MAX_KEYS_PER_REQUEST = 100000
+
+# Keys verificadas e gravadas por vez
+KEY_BATCH_SIZE = 5000
+
+# Tentativas de um lote que esbarra na restrição UNIQUE antes de desistir
+MAX_BATCH_ATTEMPTS = 3
+
+# Linhas do CSV por bloco enviado
+CSV_CHUNK_SIZE = 1000
+
+
+def random_key(grouped=False):
+    """Key aleatória de 16 caracteres; grouped separa em blocos de 4 (XXXX-XXXX-XXXX-XXXX)"""
+    key = ''.join(secrets.choice(KEY_CHARACTERS) for _ in range(KEY_LENGTH))
+    if grouped:
+        return '-'.join(key[i:i + 4] for i in range(0, KEY_LENGTH, 4))
+    return key
+
+
+def bulk_create_keys(session, model, quantity, total_leads, grouped=False):
+    """Cria quantity keys com total_leads cada e retorna os valores gerados
+
+    Um lote recusado pela restrição UNIQUE é refeito com keys novas até
+    MAX_BATCH_ATTEMPTS vezes; depois disso o IntegrityError é repassado
+    (a falha não é colisão de key).
+    """
+    created = []
+    attempts = 0
+    while len(created) < quantity:
+        needed = min(quantity - len(created), KEY_BATCH_SIZE)
+        candidates = set()
+        while len(candidates) < needed:
+            candidates.add(random_key(grouped))
+
+        existing = session.query(model.key_value).filter(model.key_value.in_(candidates))
+        candidates.difference_update(row[0] for row in existing)
+
+        now = datetime.utcnow()
+        rows = [{
+            'key_value': key,
+            'total_leads': total_leads,
+            'remaining_leads': total_leads,
+            'created_at': now
+        } for key in candidates]
+        try:
+            session.execute(model.__table__.insert(), rows)
+            session.commit()
+        except IntegrityError:
+            # Uma geração simultânea gravou a mesma key: o lote é refeito
+            session.rollback()
+            attempts += 1
+            if attempts >= MAX_BATCH_ATTEMPTS:
+                raise
+            continue
+        attempts = 0
+        created.extend(candidates)
+
+    return created
+
+
+def keys_csv(keys, total_leads):
+    """CSV (key, leads) gerado em blocos, para resposta em streaming"""
+    for start in range(0, len(keys), CSV_CHUNK_SIZE):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if start == 0:
+            writer.writerow(['key_value', 'total_leads'])
+        writer.writerows((key, total_leads) for key in keys[start:start + CSV_CHUNK_SIZE])
+        yield buffer.getvalue()
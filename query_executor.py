@@ -0,0 +1,101 @@
+"""
+Executor limitado para consultas na base de empresas
+
+As consultas rodam em um pool fixo de threads com fila limitada; cada uma tem
+um prazo aplicado pelo progress handler do SQLite (ou pelo statement timeout
+do servidor), que interrompe a consulta quando o prazo vence. Assim uma
+consulta pouco seletiva não prende o worker web até o timeout da requisição.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import lead_backend
+
+# Folga para a thread web além do prazo da consulta
+RESULT_GRACE_SECONDS = 2
+
+
+class QueryTimeout(Exception):
+    """A consulta excedeu o prazo e foi cancelada"""
+
+
+class QueryRejected(Exception):
+    """A fila do executor está cheia"""
+
+
+class _QueryState:
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.cancelled = False
+        self.conn = None
+
+    def expired(self):
+        return self.cancelled or time.monotonic() > self.deadline
+
+    def cancel(self):
+        self.cancelled = True
+        conn = self.conn
+        if conn is not None:
+            conn.interrupt()
+
+
+class QueryExecutor:
+    """Pool de threads para consultas com prazo e fila limitada"""
+
+    def __init__(self, max_workers=4, max_pending=16):
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='lead-query')
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+
+    def run(self, source, fn, timeout):
+        """Executa fn(conn) em uma thread do pool e retorna seu resultado
+
+        source é o caminho do arquivo SQLite ou um backend de servidor
+        (ver lead_backend).
+
+        Levanta QueryRejected se a fila estiver cheia e QueryTimeout se o prazo
+        (contado desde a submissão, incluindo a espera na fila) vencer.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise QueryRejected('Servidor ocupado, tente novamente em instantes')
+
+        state = _QueryState(time.monotonic() + timeout)
+        try:
+            future = self._pool.submit(self._execute, source, fn, state)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            return future.result(timeout=timeout + RESULT_GRACE_SECONDS)
+        except FutureTimeout:
+            state.cancel()
+            raise QueryTimeout('A consulta excedeu o tempo limite')
+
+    @staticmethod
+    def _execute(source, fn, state):
+        if state.expired():
+            raise QueryTimeout('A consulta excedeu o tempo limite na fila')
+
+        conn = lead_backend.connect(source, timeout=state.deadline - time.monotonic(), expired=state.expired)
+        state.conn = conn
+        try:
+            return fn(conn)
+        except Exception:
+            # Interrupção pelo prazo chega como erro do banco
+            if state.expired():
+                raise QueryTimeout('A consulta excedeu o tempo limite')
+            raise
+        finally:
+            state.conn = None
+            conn.close()
+
+
+# Executor compartilhado pelas rotas
+lead_executor = QueryExecutor(
+    max_workers=int(os.environ.get('LEAD_QUERY_WORKERS', 4)),
+    max_pending=int(os.environ.get('LEAD_QUERY_QUEUE', 16)),
+)
@@ -0,0 +1,98 @@
+"""
+Cache em memória das tabelas de referência (cnae, municipio, natureza_juridica...)
+
+As tabelas são pequenas e carregadas uma vez por versão do banco; a
+decodificação acontece enquanto as linhas saem do cursor, sem JOINs extras.
+"""
+import threading
+
+import lead_backend
+
+# coluna do resultado -> tabela de referência
+REFERENCE_COLUMNS = {
+    'natureza_juridica': 'natureza_juridica',
+    'qualificacao_responsavel': 'qualificacao_socio',
+    'qualificacao_socio': 'qualificacao_socio',
+    'qualificacao_representante': 'qualificacao_socio',
+    'cnae_fiscal_principal': 'cnae',
+    'municipio': 'municipio',
+    'pais': 'pais',
+    'motivo_situacao_cadastral': 'motivo',
+}
+
+# Versões mantidas em memória ao mesmo tempo (a ativa e a anterior)
+MAX_CACHED_VERSIONS = 2
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def _load_tables(source):
+    conn = lead_backend.connect(source)
+    try:
+        tables = {}
+        for table in set(REFERENCE_COLUMNS.values()):
+            try:
+                tables[table] = dict(conn.execute(f"SELECT codigo, descricao FROM {table}").fetchall())
+            except conn.Error:
+                lead_backend.recover_after_error(conn)
+                tables[table] = {}
+        return tables
+    finally:
+        conn.close()
+
+
+def get_reference_tables(source, version):
+    """Dicionários código -> descrição da versão informada do banco
+
+    source é o caminho do arquivo SQLite ou um backend de servidor.
+    """
+    key = (source, version)
+    with _lock:
+        tables = _cache.get(key)
+    if tables is not None:
+        return tables
+
+    tables = _load_tables(source)
+    with _lock:
+        _cache[key] = tables
+        while len(_cache) > MAX_CACHED_VERSIONS:
+            _cache.pop(next(iter(_cache)))
+    return tables
+
+
+def _decoders(columns, tables):
+    """(índice, dicionário) das colunas do resultado que têm tabela de referência"""
+    return [
+        (i, tables[REFERENCE_COLUMNS[column]])
+        for i, column in enumerate(columns)
+        if column in REFERENCE_COLUMNS and tables.get(REFERENCE_COLUMNS[column])
+    ]
+
+
+def decode_rows(columns, rows, tables):
+    """Troca códigos por descrições; códigos desconhecidos são mantidos"""
+    decoders = _decoders(columns, tables)
+    if not decoders:
+        return list(rows)
+
+    decoded = []
+    for row in rows:
+        row = list(row)
+        for i, mapping in decoders:
+            row[i] = mapping.get(row[i], row[i])
+        decoded.append(tuple(row))
+    return decoded
+
+
+class DecodingCursor:
+    """Envolve um cursor e decodifica os lotes lidos com fetchmany"""
+
+    def __init__(self, cursor, tables):
+        self._cursor = cursor
+        self._tables = tables
+        self.description = cursor.description
+        self._columns = [description[0] for description in cursor.description]
+
+    def fetchmany(self, size):
+        return decode_rows(self._columns, self._cursor.fetchmany(size), self._tables)
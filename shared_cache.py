@@ -0,0 +1,155 @@
+"""
+Cache compartilhado entre instâncias (Redis ou memcached)
+
+Resultados de consultas, estatísticas e saldos de leads ficam num cache
+comum a todas as instâncias do App Engine: o que uma instância calcula serve
+para as outras. As chaves de resultados levam o carimbo de versão da base
+ativa (DatabaseConfig.version); uma nova ativação troca o carimbo e as
+entradas antigas deixam de ser lidas até expirarem pelo TTL.
+
+Os valores vão para o Redis/memcached como JSON (tuplas voltam como
+listas): nada lido da rede é desserializado como objeto Python.
+
+Sem SHARED_CACHE_URL é usado um cache em memória do processo, com a mesma
+interface, para desenvolvimento e testes.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# Entradas mantidas pelo cache em memória
+MEMORY_MAX_ENTRIES = 1024
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':'), default=str).encode('utf-8')
+
+
+def _loads(data):
+    return json.loads(data) if data is not None else None
+
+
+class MemoryCache:
+    """Cache local com TTL e descarte das entradas mais antigas (substituto do Redis)"""
+
+    def __init__(self, max_entries=MEMORY_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+
+class RedisCache:
+    """Redis (ex.: Memorystore) com valores serializados em JSON"""
+
+    def __init__(self, url, prefix='b2b:'):
+        import redis
+        self._client = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+        self.prefix = prefix
+
+    def get(self, key):
+        return _loads(self._client.get(self.prefix + key))
+
+    def set(self, key, value, ttl):
+        self._client.set(self.prefix + key, _dumps(value), ex=max(int(ttl), 1))
+
+    def delete(self, *keys):
+        if keys:
+            self._client.delete(*(self.prefix + key for key in keys))
+
+
+class MemcachedCache:
+    """memcached (memcached://host:11211,host2:11211) com valores serializados em JSON"""
+
+    def __init__(self, url, prefix='b2b:'):
+        from pymemcache.client.hash import HashClient
+        servers = []
+        for server in url.split('://', 1)[1].strip('/').split(','):
+            host, _, port = server.partition(':')
+            servers.append((host, int(port or 11211)))
+        self._client = HashClient(servers, connect_timeout=1, timeout=1)
+        self.prefix = prefix
+
+    def get(self, key):
+        return _loads(self._client.get(self.prefix + key))
+
+    def set(self, key, value, ttl):
+        self._client.set(self.prefix + key, _dumps(value), expire=max(int(ttl), 1))
+
+    def delete(self, *keys):
+        for key in keys:
+            self._client.delete(self.prefix + key)
+
+
+def create_cache(url=None):
+    """Backend a partir da URL: redis://, rediss://, memcached:// ou memory:// (padrão)"""
+    if not url:
+        return MemoryCache()
+    scheme = url.split('://', 1)[0]
+    if scheme in ('redis', 'rediss'):
+        return RedisCache(url)
+    if scheme == 'memcached':
+        return MemcachedCache(url)
+    if scheme == 'memory':
+        return MemoryCache()
+    raise ValueError(f'Cache compartilhado não suportado: {url}')
+
+
+def cache_key(namespace, *parts):
+    """Chave curta e estável (aceita pelo memcached) a partir das partes que definem o valor"""
+    raw = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+    return f"{namespace}:{hashlib.sha1(raw.encode('utf-8')).hexdigest()}"
+
+
+def get_or_compute(cache, key, ttl, compute):
+    """Valor do cache ou compute(), gravado para as próximas requisições
+
+    Falhas do cache viram cache miss: a requisição segue direto no banco.
+    """
+    try:
+        value = cache.get(key)
+    except Exception as e:
+        print(f"Erro ao ler cache compartilhado: {e}")
+        value = None
+    if value is not None:
+        return value
+
+    value = compute()
+    try:
+        cache.set(key, value, ttl)
+    except Exception as e:
+        print(f"Erro ao gravar cache compartilhado: {e}")
+    return value
+
+
+def invalidate(cache, *keys):
+    """Remove chaves sem deixar uma falha do cache derrubar a requisição"""
+    try:
+        cache.delete(*keys)
+    except Exception as e:
+        print(f"Erro ao invalidar cache compartilhado: {e}")
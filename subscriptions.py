@@ -0,0 +1,70 @@
+"""
+Exportações incrementais (delta) de filtros salvos entre versões da base
+
+Ao ativar uma nova versão, cada assinatura recebe só as linhas que passaram
+a atender ao filtro (CNPJ novo ou que antes não era retornado) ou cuja
+situação cadastral mudou em relação à versão anterior.
+"""
+import ast
+import json
+import sqlite3
+
+from export_formats import write_export
+from lead_database import prepared_steps
+from lead_query import build_query, CNPJ_COMPLETO_SQL
+
+# Linhas lidas por vez da versão anterior
+DELTA_BATCH_SIZE = 10000
+
+
+def load_filter_data(text):
+    """Filtro salvo como JSON; filtros antigos foram gravados como repr de dict"""
+    if not text:
+        return {}
+    try:
+        return json.loads(text)
+    except ValueError:
+        try:
+            value = ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            return {}
+        return value if isinstance(value, dict) else {}
+
+
+def _load_previous_matches(conn, previous_db_path, filters):
+    """Copia (CNPJ, situação) das linhas que atendiam ao filtro na versão anterior"""
+    conn.execute("""
+        CREATE TEMP TABLE previous_match (
+            cnpj TEXT PRIMARY KEY,
+            situacao_cadastral TEXT
+        )
+    """)
+
+    previous = sqlite3.connect(previous_db_path)
+    try:
+        query, params = build_query(filters, ['cnpj_completo', 'est.situacao_cadastral'],
+                                    limit=-1, features=prepared_steps(previous))
+        cursor = previous.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(DELTA_BATCH_SIZE)
+            if not rows:
+                break
+            conn.executemany("INSERT OR REPLACE INTO previous_match VALUES (?, ?)", rows)
+    finally:
+        previous.close()
+
+
+def write_delta(conn, previous_db_path, filters, selected_columns, filepath, export_format='csv'):
+    """Grava no arquivo as linhas novas ou alteradas e retorna quantas foram"""
+    try:
+        _load_previous_matches(conn, previous_db_path, filters)
+
+        changed = f"""NOT EXISTS (
+            SELECT 1 FROM previous_match p
+            WHERE p.cnpj = {CNPJ_COMPLETO_SQL}
+            AND p.situacao_cadastral IS est.situacao_cadastral)"""
+        query, params = build_query(filters, selected_columns, limit=-1,
+                                    features=prepared_steps(conn), extra_conditions=[(changed, [])])
+        return write_export(conn.execute(query, params), filepath, export_format)
+    finally:
+        conn.execute("DROP TABLE IF EXISTS temp.previous_match")
@@ -0,0 +1,106 @@
+"""
+Base de empresas mínima (mesmo esquema da Receita usado por create_test_db) para os testes
+"""
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SCHEMA = """
+    CREATE TABLE empresas (
+        cnpj_basico TEXT, razao_social TEXT, natureza_juridica TEXT, qualificacao_responsavel TEXT,
+        capital_social TEXT, porte_empresa TEXT, ente_federativo_responsavel TEXT
+    );
+    CREATE TABLE estabelecimento (
+        cnpj_basico TEXT, cnpj_ordem TEXT, cnpj_dv TEXT, identificador_matriz_filial TEXT,
+        nome_fantasia TEXT, situacao_cadastral TEXT, data_situacao_cadastral TEXT,
+        motivo_situacao_cadastral TEXT, data_inicio_atividade TEXT, cnae_fiscal_principal TEXT,
+        cnae_fiscal_secundaria TEXT, uf TEXT, municipio TEXT, ddd_1 TEXT, telefone_1 TEXT,
+        ddd_2 TEXT, telefone_2 TEXT, correio_eletronico TEXT,
+        PRIMARY KEY (cnpj_basico, cnpj_ordem, cnpj_dv)
+    );
+    CREATE TABLE simples (
+        cnpj_basico TEXT, opcao_simples TEXT, data_opcao_simples TEXT, opcao_mei TEXT
+    );
+    CREATE TABLE socios (
+        cnpj_basico TEXT, nome_socio TEXT, cnpj_cpf_socio TEXT, qualificacao_socio TEXT
+    );
+    CREATE INDEX idx_empresas_cnpj_basico ON empresas (cnpj_basico);
+    CREATE INDEX idx_estabelecimento_cnpj ON estabelecimento (cnpj_basico);
+    CREATE INDEX idx_simples_cnpj_basico ON simples (cnpj_basico);
+"""
+
+
+def make_lead_db(path, empresas=(), estabelecimentos=(), simples=()):
+    """Cria a base com as linhas informadas (dicts com as colunas desejadas)"""
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    for table, rows in (('empresas', empresas), ('estabelecimento', estabelecimentos), ('simples', simples)):
+        for row in rows:
+            columns = ', '.join(row)
+            placeholders = ', '.join('?' for _ in row)
+            conn.execute(f"INSERT INTO {table} ({columns}) VALUES ({placeholders})", list(row.values()))
+    conn.commit()
+    conn.close()
+    return str(path)
+
+
+def empresa(cnpj_basico, razao_social='Empresa', **columns):
+    return {'cnpj_basico': cnpj_basico, 'razao_social': razao_social, **columns}
+
+
+def estabelecimento(cnpj_basico, cnpj_ordem='0001', cnpj_dv='00', uf='SP', **columns):
+    return {'cnpj_basico': cnpj_basico, 'cnpj_ordem': cnpj_ordem, 'cnpj_dv': cnpj_dv, 'uf': uf, **columns}
+
+
+@pytest.fixture
+def lead_db(tmp_path):
+    """Fábrica de bases: lead_db(empresas=[...], estabelecimentos=[...], simples=[...])"""
+    def factory(**rows):
+        return make_lead_db(tmp_path / 'empresas.db', **rows)
+    return factory
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """Módulo app com o banco do sistema e os arquivos exportados em diretório temporário"""
+    root = tmp_path_factory.mktemp('sistema')
+    os.environ['DATABASE_URL'] = f"sqlite:///{root / 'sistema.db'}"
+    os.environ['EXPORT_FOLDER'] = str(root / 'exports')
+    for name in ('SHARED_CACHE_URL', 'LEAD_DATABASE_URL'):
+        os.environ.pop(name, None)
+    import app
+    app.app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture
+def app_client(app_module, lead_db):
+    """Cliente logado de um usuário com product key, sobre uma base de empresas ativa"""
+    app, db = app_module.app, app_module.db
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = app_module.User(username='cliente', email='cliente@empresa.com', password_hash='x')
+        db.session.add(user)
+        db.session.commit()
+        db.session.add(app_module.ProductKey(key_value='KEY1', total_leads=1000, remaining_leads=1000,
+                                             user_id=user.id))
+        db.session.add(app_module.DatabaseConfig(database_path=lead_db(
+            empresas=[empresa('11111111'), empresa('22222222')],
+            estabelecimentos=[estabelecimento('11111111'), estabelecimento('22222222')],
+            simples=[{'cnpj_basico': '11111111'}, {'cnpj_basico': '22222222'}],
+        )))
+        db.session.commit()
+        user_id = user.id
+    app_module.reset_database_version()
+    app_module.shared_cache.delete(*list(app_module.shared_cache._entries))
+
+    client = app.test_client()
+    with client.session_transaction() as flask_session:
+        flask_session['user_id'] = user_id
+    client.user_id = user_id
+    return client
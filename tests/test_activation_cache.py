@@ -0,0 +1,57 @@
+import threading
+
+from conftest import empresa, estabelecimento, make_lead_db
+
+
+def _stats(client):
+    response = client.get('/api/dashboard-stats')
+    assert response.status_code == 200
+    return response.json
+
+
+def _wait_for_deltas():
+    for thread in threading.enumerate():
+        if thread.name == 'subscription-deltas':
+            thread.join(timeout=10)
+
+
+def test_ativacao_troca_as_estatisticas_em_cache(app_module, app_client, tmp_path):
+    assert _stats(app_client)['total_companies'] == 2
+    # Segunda leitura vem do cache compartilhado
+    assert _stats(app_client)['total_companies'] == 2
+
+    basicos = ['33333333', '44444444', '55555555']
+    new_path = make_lead_db(tmp_path / 'nova.db', empresas=[empresa(b) for b in basicos],
+                            estabelecimentos=[estabelecimento(b) for b in basicos])
+    with app_module.app.app_context():
+        old_version = app_module.get_database_version()
+        app_module.activate_database(new_path)
+        assert app_module.get_database_version() != old_version
+    _wait_for_deltas()
+
+    assert _stats(app_client)['total_companies'] == 3
+
+
+def test_alteracao_da_chave_invalida_o_saldo_em_cache(app_module, app_client):
+    assert _stats(app_client)['leads_remaining'] == 1000
+    assert f'entitlements:{app_client.user_id}' in app_module.shared_cache._entries
+
+    with app_module.app.app_context():
+        product_key = app_module.ProductKey.query.filter_by(user_id=app_client.user_id).one()
+        product_key.remaining_leads = 400
+        app_module.db.session.commit()
+
+    assert f'entitlements:{app_client.user_id}' not in app_module.shared_cache._entries
+    assert _stats(app_client)['leads_remaining'] == 400
+
+
+def test_rollback_nao_invalida_o_saldo_em_cache(app_module, app_client):
+    assert _stats(app_client)['leads_remaining'] == 1000
+
+    with app_module.app.app_context():
+        product_key = app_module.ProductKey.query.filter_by(user_id=app_client.user_id).one()
+        product_key.remaining_leads = 400
+        app_module.db.session.flush()
+        app_module.db.session.rollback()
+
+    assert _stats(app_client)['leads_remaining'] == 1000
@@ -0,0 +1,33 @@
+import sqlite3
+
+from admission import estimate_cost
+from conftest import empresa, estabelecimento
+from lead_query import TABLE_ALIASES, build_query
+
+ALIASES = {alias: table for table, alias in TABLE_ALIASES.items()}
+
+
+def _conn(lead_db, size=2000):
+    db_path = lead_db(
+        empresas=[empresa(f'{i:08d}') for i in range(size)],
+        estabelecimentos=[estabelecimento(f'{i:08d}') for i in range(size)],
+    )
+    conn = sqlite3.connect(db_path)
+    conn.execute("ANALYZE")
+    return conn
+
+
+def test_limite_da_consulta_limita_o_custo(lead_db):
+    conn = _conn(lead_db)
+    query, params = build_query({}, ['e.razao_social', 'est.uf'], limit=50)
+
+    assert estimate_cost(conn, query, params, ALIASES) >= 2000
+    # Cada laço do JOIN para depois de 50 linhas
+    assert estimate_cost(conn, query, params, ALIASES, limit=50) <= 50 * len(ALIASES)
+
+
+def test_ordenacao_do_resultado_inteiro_ignora_o_limite(lead_db):
+    conn = _conn(lead_db)
+    query = "SELECT est.uf FROM estabelecimento est ORDER BY est.uf LIMIT 50"
+
+    assert estimate_cost(conn, query, [], ALIASES, limit=50) >= 2000
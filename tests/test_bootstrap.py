@@ -0,0 +1,63 @@
+from datetime import datetime
+
+
+def _bootstrap(client, etag=None):
+    headers = {'If-None-Match': etag} if etag else {}
+    return client.get('/api/bootstrap', headers=headers)
+
+
+def test_revalidacao_sem_mudancas_responde_304(app_client):
+    response = _bootstrap(app_client)
+    assert response.status_code == 200
+    assert response.json['remaining_leads'] == 1000
+
+    again = _bootstrap(app_client, response.headers['ETag'])
+    assert again.status_code == 304
+    assert again.headers['ETag'] == response.headers['ETag']
+
+
+def test_debito_de_leads_troca_o_etag(app_module, app_client):
+    etag = _bootstrap(app_client).headers['ETag']
+
+    with app_module.app.app_context():
+        user = app_module.db.session.get(app_module.User, app_client.user_id)
+        version = user.ledger_version
+        product_key = app_module.ProductKey.query.filter_by(user_id=app_client.user_id).one()
+        product_key.remaining_leads -= 10
+        app_module.db.session.commit()
+        # Versão trocada no mesmo flush do débito
+        assert user.ledger_version == version + 1
+
+    response = _bootstrap(app_client, etag)
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert response.json['remaining_leads'] == 990
+
+
+def test_filtro_salvo_troca_o_etag(app_module, app_client):
+    etag = _bootstrap(app_client).headers['ETag']
+
+    with app_module.app.app_context():
+        app_module.db.session.add(app_module.SavedFilter(user_id=app_client.user_id, filter_name='SP',
+                                                         filter_data='{"est.uf": "SP"}', created_at=datetime.utcnow()))
+        app_module.db.session.commit()
+
+    response = _bootstrap(app_client, etag)
+    assert response.status_code == 200
+    assert [saved['name'] for saved in response.json['filters']] == ['SP']
+
+
+def test_chave_transferida_troca_o_etag_do_dono_anterior(app_module, app_client):
+    etag = _bootstrap(app_client).headers['ETag']
+
+    with app_module.app.app_context():
+        other = app_module.User(username='outro', email='outro@empresa.com', password_hash='x')
+        app_module.db.session.add(other)
+        app_module.db.session.flush()
+        product_key = app_module.ProductKey.query.filter_by(user_id=app_client.user_id).one()
+        product_key.user_id = other.id
+        app_module.db.session.commit()
+
+    response = _bootstrap(app_client, etag)
+    assert response.status_code == 200
+    assert response.json['remaining_leads'] == 0
@@ -0,0 +1,45 @@
+import csv
+import sqlite3
+
+from cnpj_enrichment import enrich_to_file, parse_cnpjs
+from conftest import empresa, estabelecimento
+
+
+def _enrich(db_path, tmp_path, values):
+    lookups, invalid = parse_cnpjs(values)
+    filepath = tmp_path / 'enriquecido.csv'
+    conn = sqlite3.connect(db_path)
+    try:
+        count = enrich_to_file(conn, lookups, ['cnpj_completo', 'e.razao_social'], 1000, filepath, 'csv')
+    finally:
+        conn.close()
+    with open(filepath, newline='', encoding='utf-8') as f:
+        rows = list(csv.reader(f))[1:]
+    return count, rows
+
+
+def test_basico_e_completo_da_mesma_empresa_cobram_cada_estabelecimento_uma_vez(lead_db, tmp_path):
+    db_path = lead_db(
+        empresas=[empresa('11111111'), empresa('22222222')],
+        estabelecimentos=[
+            estabelecimento('11111111', '0001', '01'),
+            estabelecimento('11111111', '0002', '02'),
+            estabelecimento('22222222', '0001', '03'),
+        ],
+        simples=[{'cnpj_basico': '11111111'}, {'cnpj_basico': '22222222'}],
+    )
+
+    count, rows = _enrich(db_path, tmp_path, ['11.111.111/0001-01', '11111111', '22222222000103'])
+
+    assert count == 3
+    assert sorted(row[1] for row in rows) == ['11111111000101', '11111111000202', '22222222000103']
+
+
+def test_parse_cnpjs_descarta_completo_coberto_pelo_basico():
+    lookups, invalid = parse_cnpjs(['11111111000101', '11111111', '11111111000101', 'abc', '22222222000103'])
+
+    assert invalid == 1
+    assert [lookup[1:] for lookup in lookups] == [
+        ('11111111', None, None),
+        ('22222222', '0001', '03'),
+    ]
@@ -0,0 +1,53 @@
+import csv
+import sqlite3
+
+from conftest import empresa, estabelecimento
+from contact_lookup import lookup_to_file, parse_contacts
+from lead_database import prepare_database
+
+
+def _lookup(db_path, tmp_path, values, limit=100):
+    lookups, _ = parse_contacts(values)
+    filepath = tmp_path / 'busca.csv'
+    conn = sqlite3.connect(db_path)
+    try:
+        count = lookup_to_file(conn, lookups, ['e.razao_social', 'est.cnpj_ordem'], limit, filepath, 'csv')
+    finally:
+        conn.close()
+    with open(filepath, newline='', encoding='utf-8') as f:
+        return count, list(csv.DictReader(f))
+
+
+def test_estabelecimento_encontrado_por_telefone_e_dominio_sai_uma_vez(lead_db, tmp_path):
+    db_path = lead_db(
+        empresas=[empresa('55555555', 'Gama')],
+        estabelecimentos=[
+            estabelecimento('55555555', '0001', '01', ddd_1='11', telefone_1='33334444',
+                            correio_eletronico='vendas@gama.com.br'),
+            estabelecimento('55555555', '0002', '02', correio_eletronico='filial@gama.com.br'),
+        ],
+    )
+    prepare_database(db_path)
+
+    count, rows = _lookup(db_path, tmp_path, ['(11) 3333-4444', 'contato@gama.com.br'])
+
+    # A matriz casa com os dois contatos e é cobrada uma vez, pelo primeiro da lista
+    assert count == len(rows) == 2
+    assert [(row['contato_informado'], row['cnpj_ordem']) for row in rows] == [
+        ('(11) 3333-4444', '0001'),
+        ('contato@gama.com.br', '0002'),
+    ]
+
+
+def test_telefone_repetido_nas_duas_colunas_sai_uma_vez(lead_db, tmp_path):
+    db_path = lead_db(
+        empresas=[empresa('66666666', 'Delta')],
+        estabelecimentos=[estabelecimento('66666666', ddd_1='21', telefone_1='22223333',
+                                          ddd_2='21', telefone_2='22223333')],
+    )
+    prepare_database(db_path)
+
+    count, rows = _lookup(db_path, tmp_path, ['21 2222-3333'])
+
+    assert count == 1
+    assert rows[0]['razao_social'] == 'Delta'
@@ -0,0 +1,64 @@
+import sqlite3
+
+import pytest
+
+import count_estimates
+import lead_database
+from conftest import empresa, estabelecimento
+from count_estimates import approximate_count
+from lead_database import prepare_database, prepared_steps
+from lead_query import build_query
+
+
+@pytest.fixture
+def sampled_db(lead_db, monkeypatch):
+    """1000 estabelecimentos com amostra de 100: só 2 em MG, metade ativos"""
+    monkeypatch.setattr(lead_database, 'COUNT_SAMPLE_SIZE', 100)
+    basicos = [f'{i:08d}' for i in range(1000)]
+    db_path = lead_db(
+        empresas=[empresa(b) for b in basicos],
+        estabelecimentos=[estabelecimento(b, uf='MG' if i < 2 else 'SP', situacao_cadastral='02' if i % 2 else '08')
+                          for i, b in enumerate(basicos)],
+        simples=[{'cnpj_basico': b} for b in basicos],
+    )
+    prepare_database(db_path)
+    conn = sqlite3.connect(db_path)
+    yield conn
+    conn.close()
+
+
+def _estimate(conn, filters):
+    return approximate_count(conn, filters, prepared_steps(conn))
+
+
+def test_poucas_linhas_da_amostra_usam_a_contagem_exata(sampled_db):
+    assert _estimate(sampled_db, {'est.uf': 'MG', 'est.situacao_cadastral': '02'}) is None
+
+
+def test_estimativa_pela_amostra(sampled_db):
+    estimate = _estimate(sampled_db, {'est.uf': 'SP', 'est.situacao_cadastral': '02'})
+    assert estimate['method'] == 'sample'
+    assert 0 < estimate['count'] < 1000 and estimate['error'] > 0
+
+
+@pytest.mark.parametrize('filters', [{}, {'est.uf': 'SP'}, {'est.uf': 'SP', 'est.situacao_cadastral': '02'}])
+def test_estimativa_limitada_a_max_results(sampled_db, monkeypatch, filters):
+    monkeypatch.setattr(count_estimates, 'MAX_RESULTS', 200)
+    assert _estimate(sampled_db, filters)['count'] == 200
+
+
+def test_estabelecimento_sem_empresa_entra_no_total(lead_db):
+    # A consulta sem colunas de empresas não junta empresas: o total também não pode juntar
+    db_path = lead_db(
+        empresas=[empresa('00000001')],
+        estabelecimentos=[estabelecimento('00000001'), estabelecimento('00000002'), estabelecimento('00000003')],
+    )
+    prepare_database(db_path)
+    conn = sqlite3.connect(db_path)
+    try:
+        query, params = build_query({}, ['est.uf'], features=prepared_steps(conn))
+        exact = len(conn.execute(query, params).fetchall())
+        assert exact == 3
+        assert _estimate(conn, {}) == {'count': exact, 'error': 0, 'method': 'total'}
+    finally:
+        conn.close()
@@ -0,0 +1,22 @@
+import sqlite3
+
+import pytest
+
+from export_formats import EXPORT_FORMATS, copy_export_rows, write_export
+
+
+@pytest.mark.parametrize('export_format', list(EXPORT_FORMATS))
+def test_copia_parcial_mantem_formato_e_linhas(tmp_path, export_format):
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE t (cnpj TEXT, nome TEXT)")
+    conn.executemany("INSERT INTO t VALUES (?, ?)", [(f'{i:014d}', f'Empresa, "{i}"\nfilial') for i in range(50)])
+    source = str(tmp_path / 'completo')
+    assert write_export(conn.execute("SELECT * FROM t ORDER BY cnpj"), source, export_format) == 50
+
+    target = str(tmp_path / 'parcial')
+    assert copy_export_rows(source, target, export_format, 20) == 20
+
+    # Relendo a cópia: mesmo cabeçalho e as 20 primeiras linhas
+    again = str(tmp_path / 'releitura')
+    assert copy_export_rows(target, again, export_format, 100) == 20
+    assert copy_export_rows(source, again, export_format, 100) == 50
@@ -0,0 +1,70 @@
+import os
+import time
+
+import pytest
+
+from export_store import ExportStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ExportStore(str(tmp_path / 'exports'))
+
+
+def _write(store, content, filename='dados.csv'):
+    path = store.new_path(filename)
+    with open(path, 'w') as f:
+        f.write(content)
+    return path
+
+
+def _age(path, seconds):
+    old = time.time() - seconds
+    os.utime(path, (old, old))
+
+
+def test_conteudo_igual_ocupa_um_arquivo(store):
+    first, size = store.commit(_write(store, 'a,b\n1,2\n'))
+    second, _ = store.commit(_write(store, 'a,b\n1,2\n'))
+    other, _ = store.commit(_write(store, 'a,b\n3,4\n'))
+
+    assert first == second != other
+    assert size == 8
+    assert store.disk_usage() == (2, 16)
+    assert store.counters['stored'] == 2 and store.counters['deduplicated'] == 1
+    # Temporários descartados depois do commit
+    assert os.listdir(store.tmp_dir) == []
+
+
+def test_descarte_respeita_referencias_e_carencia(store):
+    kept, _ = store.commit(_write(store, 'referenciado'))
+    orphan, _ = store.commit(_write(store, 'sem artefato'))
+    recent, _ = store.commit(_write(store, 'recém-gravado'))
+    for content_hash in (kept, orphan):
+        _age(store.path(content_hash), 3600)
+
+    deleted = store.delete_unreferenced({kept}, tmp_max_age=3600, grace=300)
+
+    assert deleted == 1 and store.counters['evicted'] == 1
+    assert store.exists(kept) and not store.exists(orphan)
+    # O artefato do objeto recém-gravado pode ainda não estar no banco
+    assert store.exists(recent)
+
+
+def test_commit_de_conteudo_existente_renova_a_carencia(store):
+    content_hash, _ = store.commit(_write(store, 'repetido'))
+    _age(store.path(content_hash), 3600)
+    store.commit(_write(store, 'repetido'))
+
+    assert store.delete_unreferenced(set(), tmp_max_age=3600, grace=300) == 0
+    assert store.exists(content_hash)
+
+
+def test_temporarios_abandonados_sao_apagados(store):
+    abandoned = _write(store, 'interrompido')
+    current = _write(store, 'em andamento')
+    _age(os.path.dirname(abandoned), 7200)
+
+    store.delete_unreferenced(set(), tmp_max_age=3600)
+
+    assert not os.path.exists(abandoned) and os.path.exists(current)
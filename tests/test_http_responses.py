@@ -0,0 +1,40 @@
+import gzip
+
+import pytest
+from flask import Flask
+
+from http_responses import json_response, make_etag, not_modified
+
+PAYLOAD = {'rows': [['x' * 20] for _ in range(200)]}
+ETAG = make_etag('preview', 1)
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+
+    @app.route('/dados')
+    def dados():
+        return not_modified(ETAG) or json_response(PAYLOAD, etag=ETAG)
+
+    return app.test_client()
+
+
+@pytest.mark.parametrize('encoding', ['identity', 'gzip'])
+def test_etag_fraco_para_qualquer_codificacao(client, encoding):
+    response = client.get('/dados', headers={'Accept-Encoding': encoding})
+    assert response.headers['ETag'] == f'W/"{ETAG}"'
+    if encoding == 'gzip':
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(response.data).startswith(b'{')
+
+
+@pytest.mark.parametrize('header', [f'W/"{ETAG}"', f'"{ETAG}"'])
+def test_if_none_match_responde_304(client, header):
+    response = client.get('/dados', headers={'If-None-Match': header, 'Accept-Encoding': 'gzip'})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == f'W/"{ETAG}"'
+
+
+def test_etag_diferente_devolve_o_corpo(client):
+    assert client.get('/dados', headers={'If-None-Match': 'W/"outro"'}).status_code == 200
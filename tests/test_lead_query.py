@@ -0,0 +1,131 @@
+import sqlite3
+
+import pytest
+
+from conftest import empresa, estabelecimento
+from lead_database import prepare_database, prepared_steps
+from lead_query import build_query
+
+
+@pytest.fixture
+def cnpj_db(lead_db):
+    return lead_db(
+        empresas=[empresa('11111111'), empresa('22111111')],
+        estabelecimentos=[
+            estabelecimento('11111111', '0001', '01'),
+            estabelecimento('22111111', '0001', '02'),
+        ],
+        simples=[{'cnpj_basico': '11111111'}, {'cnpj_basico': '22111111'}],
+    )
+
+
+def _cnpjs(db_path, filters):
+    conn = sqlite3.connect(db_path)
+    try:
+        query, params = build_query(filters, ['cnpj_completo'], features=prepared_steps(conn))
+        return sorted(row[0] for row in conn.execute(query, params))
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize('filters, expected', [
+    # Sem operador: "contém", inclusive no meio do CNPJ
+    ({'cnpj_completo': '111111'}, ['11111111000101', '22111111000102']),
+    ({'cnpj_completo': '11.111.111/0001-01'}, ['11111111000101']),
+    ({'cnpj_completo': {'op': 'prefix', 'value': '2211'}}, ['22111111000102']),
+    ({'cnpj_completo': {'op': 'exact', 'value': '22111111000102'}}, ['22111111000102']),
+])
+def test_filtro_de_cnpj_igual_com_e_sem_preparacao(cnpj_db, filters, expected):
+    assert _cnpjs(cnpj_db, filters) == expected
+    prepare_database(cnpj_db)
+    assert _cnpjs(cnpj_db, filters) == expected
+
+
+@pytest.fixture
+def grain_db(lead_db):
+    """Empresa com matriz e filial, sem registro no Simples, e uma empresa optante"""
+    return lead_db(
+        empresas=[empresa('33333333', 'Alfa'), empresa('44444444', 'Beta')],
+        estabelecimentos=[
+            estabelecimento('33333333', '0001', '01'),
+            estabelecimento('33333333', '0002', '02'),
+            estabelecimento('44444444', '0001', '03'),
+        ],
+        simples=[{'cnpj_basico': '44444444', 'opcao_simples': 'S'}],
+    )
+
+
+@pytest.mark.parametrize('filters, columns, expected', [
+    # Só colunas e filtros de empresas: ainda uma linha por estabelecimento (exportada e cobrada)
+    ({'e.razao_social': 'Alfa'}, ['e.razao_social'], [('Alfa',), ('Alfa',)]),
+    ({}, ['e.cnpj_basico'], [('33333333',), ('33333333',), ('44444444',)]),
+    # simples sem filtro não elimina empresas fora do Simples
+    ({}, ['e.razao_social', 's.opcao_simples'], [('Alfa', None), ('Alfa', None), ('Beta', 'S')]),
+    ({'s.opcao_simples': {'op': 'exact', 'value': 'S'}}, ['e.razao_social'], [('Beta',)]),
+])
+def test_uma_linha_por_estabelecimento(grain_db, filters, columns, expected):
+    conn = sqlite3.connect(grain_db)
+    try:
+        query, params = build_query(filters, columns)
+        assert sorted(conn.execute(query, params).fetchall(), key=str) == sorted(expected, key=str)
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize('filters', [
+    {'cnpj_completo': {'op': 'prefix', 'value': '2211'}},
+    {'e.cnpj_basico': {'op': 'prefix', 'value': '2211'}},
+    {'cnae': {'op': 'prefix', 'value': '4751'}},
+])
+@pytest.mark.parametrize('dialect', ['postgresql', 'mysql'])
+def test_prefixo_no_servidor_nao_depende_da_collation(filters, dialect):
+    # A faixa até prefixo + ':' só vale na ordem por bytes do SQLite
+    features = {'cnpj_completo', 'cnae_index'}
+    query, params = build_query(filters, ['cnpj_completo'], features=features, dialect=dialect)
+    assert any(param.endswith('%') for param in params if isinstance(param, str))
+    assert not any(param.endswith(':') for param in params if isinstance(param, str))
+
+    query, params = build_query(filters, ['cnpj_completo'], features=features)
+    assert any(param.endswith(':') for param in params if isinstance(param, str))
+
+
+@pytest.mark.parametrize('dialect, operator', [('sqlite', ' LIKE '), ('mysql', ' LIKE '), ('postgresql', ' ILIKE ')])
+def test_contem_sem_diferenciar_maiusculas_em_cada_dialeto(dialect, operator):
+    query, _ = build_query({'e.razao_social': 'ltda', 'socio_nome': 'silva'}, ['cnpj_completo'], dialect=dialect)
+    assert query.count(operator) == 2
+
+
+# (ddd_1, telefone_1, ddd_2, telefone_2, email) de cada estabelecimento
+CONTACTS = [
+    ('11', '981234567', None, None, 'contato@empresa.com.br'),
+    ('11', '81234567', None, None, None),          # ganha o nono dígito: celular
+    ('011', '33334444', '', '', 'sem-arroba.com'),  # zero à esquerda do DDD
+    (None, '11987654321', None, None, ' Vendas@Loja.com '),  # DDD na frente do número
+    ('10', '33334444', None, None, 'a@b@c.com'),    # DDD com zero: inválido
+    ('11', '12345678', '21', '3333-4444', 'x y@z.com'),
+    ('11', '1234', None, None, ''),
+    (None, None, None, None, None),
+]
+
+
+@pytest.fixture
+def contact_db(lead_db):
+    basicos = [f'{i:08d}' for i in range(len(CONTACTS))]
+    return lead_db(
+        empresas=[empresa(b) for b in basicos],
+        estabelecimentos=[
+            estabelecimento(b, ddd_1=ddd_1, telefone_1=tel_1, ddd_2=ddd_2, telefone_2=tel_2, correio_eletronico=email)
+            for b, (ddd_1, tel_1, ddd_2, tel_2, email) in zip(basicos, CONTACTS)
+        ],
+    )
+
+
+@pytest.mark.parametrize('flag', ['est.has_phone', 'est.has_email', 'est.has_mobile'])
+@pytest.mark.parametrize('value', ['sim', 'nao'])
+def test_flags_de_contato_iguais_com_e_sem_preparacao(contact_db, flag, value):
+    before = _cnpjs(contact_db, {flag: value})
+    prepare_database(contact_db)
+    assert _cnpjs(contact_db, {flag: value}) == before
+    # As duas respostas da flag cobrem todos os estabelecimentos
+    other = 'nao' if value == 'sim' else 'sim'
+    assert len(before) + len(_cnpjs(contact_db, {flag: other})) == len(CONTACTS)
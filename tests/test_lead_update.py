@@ -0,0 +1,84 @@
+import sqlite3
+
+from conftest import empresa, estabelecimento, make_lead_db
+from lead_database import prepare_database
+from lead_update import apply_update
+
+ACTIVE = dict(
+    empresas=[empresa('11111111'), empresa('22222222'), empresa('33333333')],
+    estabelecimentos=[
+        estabelecimento('11111111', cnae_fiscal_principal='4751201', ddd_1='11', telefone_1='33334444'),
+        estabelecimento('22222222', cnae_fiscal_principal='4711301', data_inicio_atividade='20100101'),
+        estabelecimento('33333333', situacao_cadastral='02'),
+    ],
+    simples=[{'cnpj_basico': '11111111', 'opcao_simples': 'S'}],
+)
+
+# 11111111 igual, 22222222 alterado, 33333333 removido, 44444444 novo
+IMPORT = dict(
+    empresas=[empresa('11111111'), empresa('22222222', razao_social='Nova Razão'), empresa('44444444')],
+    estabelecimentos=[
+        estabelecimento('11111111', cnae_fiscal_principal='4751201', ddd_1='11', telefone_1='33334444'),
+        estabelecimento('22222222', cnae_fiscal_principal='6201501', cnae_fiscal_secundaria='6204000',
+                        data_inicio_atividade='20200315', ddd_1='21', telefone_1='81234567',
+                        correio_eletronico='Vendas@Empresa.com'),
+        estabelecimento('44444444', uf='RJ', situacao_cadastral='02'),
+    ],
+    simples=[{'cnpj_basico': '11111111', 'opcao_simples': 'N'}],
+)
+
+ORDERED = {
+    'estabelecimento': 'cnpj_basico, cnpj_ordem, cnpj_dv',
+    'empresas': 'cnpj_basico',
+    'simples': 'cnpj_basico',
+    'estabelecimento_cnae': 'cnae, cnpj_basico',
+    'lead_histogram': 'column_name, value',
+}
+
+
+def _dump(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return {table: conn.execute(f"SELECT * FROM {table} ORDER BY {order}").fetchall()
+                for table, order in ORDERED.items()}
+    finally:
+        conn.close()
+
+
+def test_diferenca_aplicada_e_colunas_derivadas_atualizadas(tmp_path):
+    active = make_lead_db(tmp_path / 'ativa.db', **ACTIVE)
+    prepare_database(active)
+    imported = make_lead_db(tmp_path / 'importacao.db', **IMPORT)
+    target = str(tmp_path / 'nova.db')
+
+    summary = apply_update(active, imported, target)
+
+    assert summary['empresas'] == {'inserted': 1, 'updated': 1, 'deleted': 1}
+    assert summary['estabelecimento'] == {'inserted': 1, 'updated': 1, 'deleted': 1}
+    assert summary['simples'] == {'inserted': 0, 'updated': 1, 'deleted': 0}
+
+    conn = sqlite3.connect(target)
+    try:
+        changes = conn.execute("""
+            SELECT change, cnpj_basico FROM lead_changes WHERE table_name = 'estabelecimento' ORDER BY 1, 2
+        """).fetchall()
+    finally:
+        conn.close()
+    assert changes == [('D', '33333333'), ('I', '44444444'), ('U', '22222222')]
+
+    # Mesmo resultado de preparar a importação do zero
+    prepare_database(imported)
+    assert _dump(target) == _dump(imported)
+
+
+def test_importacao_sem_mudancas_nao_altera_nada(tmp_path):
+    active = make_lead_db(tmp_path / 'ativa.db', **ACTIVE)
+    prepare_database(active)
+    imported = make_lead_db(tmp_path / 'importacao.db', **ACTIVE)
+    target = str(tmp_path / 'nova.db')
+
+    summary = apply_update(active, imported, target)
+
+    assert all(counts == {'inserted': 0, 'updated': 0, 'deleted': 0} for counts in summary.values()
+               if isinstance(counts, dict))
+    assert _dump(target) == _dump(active)
@@ -0,0 +1,23 @@
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, create_engine, inspect
+
+from model_schema import sync_schema
+
+
+def test_colunas_e_indices_novos_em_tabela_existente():
+    engine = create_engine('sqlite://')
+    old = MetaData()
+    Table('delta_export', old, Column('id', Integer, primary_key=True), Column('row_count', Integer))
+    old.create_all(engine)
+
+    new = MetaData()
+    Table('delta_export', new, Column('id', Integer, primary_key=True), Column('row_count', Integer),
+          Column('content_hash', String(64), index=True), Column('expires_at', DateTime, index=True))
+    sync_schema(engine, new)
+    # Segunda execução não faz nada
+    sync_schema(engine, new)
+
+    inspector = inspect(engine)
+    assert {column['name'] for column in inspector.get_columns('delta_export')} == \
+        {'id', 'row_count', 'content_hash', 'expires_at'}
+    assert {index['name'] for index in inspector.get_indexes('delta_export')} == \
+        {'ix_delta_export_content_hash', 'ix_delta_export_expires_at'}
@@ -0,0 +1,94 @@
+import csv
+import io
+import itertools
+
+import pytest
+from sqlalchemy import Column, Integer, String, DateTime, create_engine, event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, declarative_base
+
+import product_keys
+from product_keys import bulk_create_keys, keys_csv
+
+Base = declarative_base()
+
+
+class ProductKey(Base):
+    __tablename__ = 'product_key'
+    id = Column(Integer, primary_key=True)
+    key_value = Column(String(19), unique=True, nullable=False)
+    total_leads = Column(Integer, nullable=False)
+    remaining_leads = Column(Integer, nullable=False)
+    created_at = Column(DateTime)
+
+
+class OwnedKey(Base):
+    """Coluna obrigatória que bulk_create_keys não preenche: todo INSERT falha"""
+    __tablename__ = 'owned_key'
+    id = Column(Integer, primary_key=True)
+    key_value = Column(String(19), unique=True, nullable=False)
+    total_leads = Column(Integer, nullable=False)
+    remaining_leads = Column(Integer, nullable=False)
+    created_at = Column(DateTime)
+    owner = Column(String(20), nullable=False)
+
+
+@pytest.fixture
+def session():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+def test_keys_unicas_e_gravadas(session, monkeypatch):
+    monkeypatch.setattr(product_keys, 'KEY_BATCH_SIZE', 7)
+    keys = bulk_create_keys(session, ProductKey, 20, 100, grouped=True)
+    assert len(set(keys)) == 20
+    assert session.query(ProductKey).filter(ProductKey.remaining_leads == 100).count() == 20
+    assert all(len(key) == 19 and key.count('-') == 3 for key in keys)
+
+
+def test_key_existente_nao_e_regravada(session, monkeypatch):
+    session.add(ProductKey(key_value='AAAA', total_leads=1, remaining_leads=1))
+    session.commit()
+    values = itertools.cycle(['AAAA', 'BBBB', 'CCCC'])
+    monkeypatch.setattr(product_keys, 'random_key', lambda grouped=False: next(values))
+    assert sorted(bulk_create_keys(session, ProductKey, 2, 10)) == ['BBBB', 'CCCC']
+
+
+def test_colisao_simultanea_refaz_o_lote(session, monkeypatch):
+    values = iter(['AAAA', 'BBBB'])
+    monkeypatch.setattr(product_keys, 'random_key', lambda grouped=False: next(values))
+    engine = session.get_bind()
+
+    # Outra geração grava a mesma key entre a verificação e o INSERT
+    def concurrent_insert(conn, clauseelement, multiparams, params, execution_options):
+        if clauseelement.is_insert and not concurrent_insert.done:
+            concurrent_insert.done = True
+            conn.exec_driver_sql("INSERT INTO product_key (key_value, total_leads, remaining_leads) "
+                                 "VALUES ('AAAA', 1, 1)")
+    concurrent_insert.done = False
+    event.listen(engine, 'before_execute', concurrent_insert)
+
+    assert bulk_create_keys(session, ProductKey, 1, 10) == ['BBBB']
+    assert session.query(ProductKey).count() == 1
+
+
+def test_integrity_error_persistente_e_repassado(session):
+    inserts = []
+    event.listen(session.get_bind(), 'before_execute',
+                 lambda conn, clauseelement, *args: clauseelement.is_insert and inserts.append(1))
+    with pytest.raises(IntegrityError):
+        bulk_create_keys(session, OwnedKey, 5, 10)
+    assert len(inserts) == product_keys.MAX_BATCH_ATTEMPTS
+
+
+def test_keys_csv_em_blocos(monkeypatch):
+    monkeypatch.setattr(product_keys, 'CSV_CHUNK_SIZE', 3)
+    keys = [f'K{i}' for i in range(7)]
+    chunks = list(keys_csv(keys, 50))
+    assert len(chunks) == 3
+    rows = list(csv.reader(io.StringIO(''.join(chunks))))
+    assert rows[0] == ['key_value', 'total_leads']
+    assert rows[1:] == [[key, '50'] for key in keys]
@@ -0,0 +1,69 @@
+import threading
+import time
+
+import pytest
+
+from conftest import empresa, estabelecimento
+from query_executor import QueryExecutor, QueryRejected, QueryTimeout
+
+# Sem fim até o progress handler interromper
+ENDLESS_QUERY = """
+    WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n)
+    SELECT COUNT(*) FROM n
+"""
+
+
+@pytest.fixture
+def db_path(lead_db):
+    return lead_db(empresas=[empresa('11111111')], estabelecimentos=[estabelecimento('11111111')])
+
+
+@pytest.fixture
+def executor():
+    executor = QueryExecutor(max_workers=1, max_pending=1)
+    yield executor
+    executor._pool.shutdown(wait=True)
+
+
+def test_resultado_dentro_do_prazo(executor, db_path):
+    count = executor.run(db_path, lambda conn: conn.execute("SELECT COUNT(*) FROM empresas").fetchone()[0], 5)
+    assert count == 1
+
+
+def test_prazo_interrompe_a_consulta_e_libera_o_worker(executor, db_path):
+    started = time.monotonic()
+    with pytest.raises(QueryTimeout):
+        executor.run(db_path, lambda conn: conn.execute(ENDLESS_QUERY).fetchone(), 0.2)
+    # Cancelada pelo progress handler, não pela espera da thread web
+    assert time.monotonic() - started < 2
+
+    assert executor.run(db_path, lambda conn: 'livre', 5) == 'livre'
+
+
+def test_fila_cheia_recusa_e_prazo_conta_a_espera(executor, db_path):
+    release = threading.Event()
+    blocker = threading.Thread(target=executor.run, args=(db_path, lambda conn: release.wait(5), 10))
+    blocker.start()
+    time.sleep(0.1)
+
+    # Um worker ocupado e uma vaga na fila
+    errors = []
+
+    def queued_run():
+        try:
+            executor.run(db_path, lambda conn: 'tarde', 0.2)
+        except QueryTimeout as e:
+            errors.append(e)
+
+    queued = threading.Thread(target=queued_run)
+    queued.start()
+    time.sleep(0.1)
+    with pytest.raises(QueryRejected):
+        executor.run(db_path, lambda conn: 'recusada', 5)
+
+    # O prazo da consulta na fila vence antes de um worker ficar livre
+    time.sleep(0.3)
+    release.set()
+    blocker.join()
+    queued.join()
+    assert len(errors) == 1
@@ -0,0 +1,60 @@
+import pickle
+
+import pytest
+
+from shared_cache import MemcachedCache, MemoryCache, RedisCache, get_or_compute
+
+
+class FakeClient:
+    """Guarda os bytes como o servidor guardaria"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, expire=None):
+        assert isinstance(value, bytes)
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+
+@pytest.fixture(params=[RedisCache, MemcachedCache])
+def network_cache(request):
+    cache = request.param.__new__(request.param)
+    cache._client = FakeClient()
+    cache.prefix = 'b2b:'
+    return cache
+
+
+def test_valores_em_json(network_cache):
+    network_cache.set('preview', (['cnpj'], [('123', None)], 1, None), 60)
+    assert network_cache._client.data['b2b:preview'] == b'[["cnpj"],[["123",null]],1,null]'
+    columns, rows, count, estimate = network_cache.get('preview')
+    assert rows == [['123', None]] and count == 1
+    network_cache.delete('preview')
+    assert network_cache.get('preview') is None
+
+
+def test_pickle_no_cache_nao_e_desserializado(network_cache):
+    network_cache._client.data['b2b:x'] = pickle.dumps({'a': 1})
+    with pytest.raises(ValueError):
+        network_cache.get('x')
+    # Para as rotas, um valor ilegível é só um cache miss
+    assert get_or_compute(network_cache, 'x', 60, lambda: {'a': 2}) == {'a': 2}
+
+
+def test_memory_cache_ttl_e_descarte(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('shared_cache.time.monotonic', lambda: now[0])
+    cache = MemoryCache(max_entries=2)
+    cache.set('a', 1, 10)
+    cache.set('b', 2, 10)
+    cache.set('c', 3, 10)
+    assert cache.get('a') is None and cache.get('c') == 3
+    now[0] += 11
+    assert cache.get('b') is None